@@ -124,15 +124,50 @@ class MobileUseExecutor(TextOnlyExecutor):
             return note
         else:
             raise ValueError(f"Unknown action: {action.name}")
-        time.sleep(2)       # wait action ready
+        # The environment waits for the screen to settle, see `AndroidLabEnvironment.execute_action`.
         return answer
 
 
+class ControllerSignature:
+    """Screen signature for the settle loop, the frame is hashed on the device."""
+
+    def __init__(self, controller: AndroidController):
+        self.controller = controller
+
+    def signature(self) -> str:
+        return self.controller.execute_adb('adb shell "screencap | md5sum"', type=self.controller.type)
+
+    def invalidate(self):
+        pass
+
+
 class AndroidLabEnvironment(Environment):
-    def __init__(self, controller: AndroidController, config, page_executor: MobileUseExecutor):
+    def __init__(
+            self,
+            controller: AndroidController,
+            config,
+            page_executor: MobileUseExecutor,
+            wait_after_action_seconds: float=2.0,
+            settle_mode: str='adaptive',
+            settle_min_seconds: float=0.3,
+            settle_max_seconds: float=None,
+            settle_stable_samples: int=2,
+            settle_interval_seconds: float=0.2,
+        ):
+        """The settle arguments are those of `Environment`, 'fixed' sleeps
+        `wait_after_action_seconds` after every action as the executor used to."""
+        if settle_mode not in ('fixed', 'adaptive'):
+            raise ValueError(f"Unknown settle mode: {settle_mode}")
         self.config = config
         self.controller = controller
         self.executor = page_executor
+        self._capture = ControllerSignature(controller)
+        self.wait_after_action_seconds = wait_after_action_seconds
+        self.settle_mode = settle_mode
+        self.settle_min_seconds = settle_min_seconds
+        self.settle_max_seconds = wait_after_action_seconds if settle_max_seconds is None else settle_max_seconds
+        self.settle_stable_samples = settle_stable_samples
+        self.settle_interval_seconds = settle_interval_seconds
 
     def reset(self, go_home: bool = False):
         if go_home:
@@ -154,7 +189,12 @@ class AndroidLabEnvironment(Environment):
         return re
     
     def execute_action(self, action):
-        return self.executor.execute_action(action=action)
+        answer = self.executor.execute_action(action=action)
+        if action.name == 'take_note':
+            self.last_settle_duration = 0.0
+        else:
+            self.last_settle_duration = self._wait_for_settle()
+        return answer
 
     # def execute_action(self, action: Action):
     #     print_with_color(f"Execute Action {action}", "green")
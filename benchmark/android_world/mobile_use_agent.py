@@ -23,6 +23,8 @@ class MobileUse(base_agent.EnvironmentInteractingAgent):
   def reset(self, go_home: bool = False) -> None:
     super().reset(go_home)
     self.env.hide_automation_ui()
+    self.agent.env.invalidate_state()
+    self.agent.env.invalidate_clock()
     self.agent.reset()
 
   def step(self, goal: str) -> base_agent.AgentInteractionResult:
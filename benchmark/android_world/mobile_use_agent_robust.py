@@ -46,6 +46,8 @@ class MobileUse(base_agent.EnvironmentInteractingAgent):
   def reset(self, go_home: bool = False) -> None:
     super().reset(go_home)
     self.env.hide_automation_ui()
+    self.agent.env.invalidate_state()
+    self.agent.env.invalidate_clock()
     self.agent.reset()
 
     time.sleep(7)
@@ -0,0 +1,81 @@
+"""Compare `diff_image` with its downscaled fast path on pairs of screenshots.
+
+    python benchmark/diff_image/run.py [screenshot.png] --repeat 20 --level 2
+"""
+import os
+import time
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from mobile_use.scheme import EnvState
+from mobile_use.utils import diff_image, diff_image_fast
+
+
+DEFAULT_SCREENSHOT = os.path.join(os.path.dirname(__file__), '..', 'android_world', 'ref_image.png')
+
+
+def pairs(image: Image.Image):
+    """(name, before, after) pairs: no change, a small and a large change, a new screen."""
+    small = image.copy()
+    ImageDraw.Draw(small).rectangle((image.width // 4, image.height // 3, image.width // 2, image.height // 3 + 60), fill=(30, 120, 220))
+    large = image.copy()
+    ImageDraw.Draw(large).rectangle((0, image.height // 2, image.width, image.height * 3 // 4), fill=(250, 250, 250))
+    new_screen = Image.new('RGB', image.size, (20, 20, 20))
+    return [('identical', image, image.copy()), ('small', image, small), ('large', image, large), ('new screen', image, new_screen)]
+
+
+def timeit(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def changed_box(result, after: Image.Image):
+    """The bounding box of the drawn highlights, None if nothing is highlighted."""
+    if result[0] is None:
+        return None
+    ys, xs = np.nonzero(np.any(np.asarray(result[1]) != np.asarray(after.convert('RGB')), axis=2))
+    return (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())) if len(xs) else None
+
+
+def state_diff(s1: EnvState, s2: EnvState, level: int):
+    """As the Reflector does: the hash and grayscale levels are cached on the EnvStates."""
+    if s1.digest == s2.digest:
+        return None, None
+    return diff_image_fast(s1.pixels, s2.pixels, level=level, gray1=s1.gray(level), gray2=s2.gray(level))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('screenshot', nargs='?', default=DEFAULT_SCREENSHOT)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--level', type=int, default=2)
+    args = parser.parse_args()
+
+    image = Image.open(args.screenshot).convert('RGB')
+    print(f"{image.width}x{image.height}, level {args.level} ({image.width >> args.level}x{image.height >> args.level})")
+    print(f"{'change':<11} {'diff_image ms':>14} {'fast ms':>8} {'cold ms':>8} {'cached ms':>10} {'speedup':>12}  boxes (diff_image / fast)")
+    level = args.level
+    for name, before, after in pairs(image):
+        baseline = timeit(lambda: diff_image(before, after), args.repeat)
+        fast = timeit(lambda: diff_image_fast(before, after, level=level), args.repeat)
+        # The first diff of new states pays for the hashes and the grayscale levels,
+        # the cached diff is what a state costs when it is compared again.
+        cold = timeit(lambda: state_diff(EnvState(pixels=before, package=''), EnvState(pixels=after, package=''), level), args.repeat)
+        s1, s2 = EnvState(pixels=before, package=''), EnvState(pixels=after, package='')
+        state_diff(s1, s2, level)
+        warm = timeit(lambda: state_diff(s1, s2, level), args.repeat)
+
+        boxes = (changed_box(diff_image(before, after), after), changed_box(state_diff(s1, s2, level), after))
+        speedup = f"{baseline / cold:.1f}x/{baseline / warm:.1f}x"
+        print(f"{name:<11} {baseline:>14.1f} {fast:>8.1f} {cold:>8.1f} {warm:>10.1f} {speedup:>12}  {boxes[0]} / {boxes[1]}")
+    print("speedup: diff_image over the cold / cached diff.")
+
+if __name__ == '__main__':
+    main()
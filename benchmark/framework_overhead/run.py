@@ -0,0 +1,105 @@
+"""Measure the overhead of the agent framework against a local mock VLM server.
+
+The agents run on a static in-memory screen, so the time of a step is the
+framework overhead plus the simulated model latency. Example:
+
+    python benchmark/framework_overhead/run.py --agents MultiAgent Qwen --episodes 8 --concurrency 4 --latency 0.2
+"""
+import time
+import logging
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from mobile_use import VLMWrapper
+from mobile_use.agents import Agent
+from mobile_use.scheme import EnvState
+from mobile_use.mock_vlm import MockVLMServer, parse_latency
+
+
+# Scripted responses matching the output format of each agent, a click per step.
+RESPONSES = {
+    'ReAct': "Thought: Open the app.\nAction: click(point=[100, 200])",
+    'Qwen': '<thinking>Open the app.</thinking>\n<tool_call>\n{"name": "mobile_use", "arguments": {"action": "click", "coordinate": [100, 200]}}\n</tool_call>\n<conclusion>Clicked.</conclusion>',
+    'UITARSAgent': "Thought: Open the app.\nAction: click(start_box='(100,200)')",
+    'MultiAgent': """Thought: Open the app.
+Action: Click the icon.
+{"name": "mobile_use", "arguments": {"action": "click", "coordinate": [100, 200]}}
+### Outcome ###
+A
+### Error Description ###
+None
+### Important Notes ###
+Nothing.
+### Completed contents ###
+Opened the app.""",
+}
+
+AGENT_KWARGS = {
+    'MultiAgent': dict(use_reflector=True, use_processor=True, include_time=False),
+}
+
+
+class StaticEnvironment:
+    """A screen that never changes, actions are only recorded."""
+
+    last_settle_duration = 0.0
+
+    def __init__(self, width: int=1080, height: int=2400):
+        self.pixels = Image.new('RGB', (width, height), (255, 255, 255))
+        self.num_actions = 0
+
+    def get_state(self):
+        return EnvState(pixels=self.pixels, package='com.example')
+
+    def execute_action(self, action):
+        self.num_actions += 1
+
+    def get_time(self):
+        return time.strftime('%a %b %d %H:%M:%S %Z %Y')
+
+
+def run_episode(agent_name: str, base_url: str, max_steps: int) -> list:
+    vlm = VLMWrapper(model_name='mock', api_key='EMPTY', base_url=base_url)
+    agent = Agent.from_params(dict(type=agent_name, env=StaticEnvironment(), vlm=vlm, max_steps=max_steps, **AGENT_KWARGS.get(agent_name, {})))
+    agent.reset(goal='Open the app')
+    durations = []
+    for step_idx in range(max_steps):
+        agent.curr_step_idx = step_idx
+        start = time.time()
+        agent.step()
+        durations.append(time.time() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--agents', nargs='+', default=list(RESPONSES))
+    parser.add_argument('--episodes', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--latency', default='0', help="Seconds to the first token, or a distribution, e.g. lognormal:-2,0.3")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.getLogger('mobile_use').setLevel(logging.ERROR)
+
+    print(f"{'agent':<12} {'steps':>6} {'requests':>9} {'step p50':>9} {'step p95':>9} {'model/step':>11} {'overhead/step':>14} {'peak':>5}")
+    for agent_name in args.agents:
+        with MockVLMServer(responses=[RESPONSES[agent_name]], latency=parse_latency(args.latency), error_rate=args.error_rate, seed=0) as server:
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                futures = [executor.submit(run_episode, agent_name, server.base_url, args.steps) for _ in range(args.episodes)]
+                durations = [d for future in futures for d in future.result()]
+            wall = time.time() - start
+            quantiles = statistics.quantiles(durations, n=20) if len(durations) > 1 else durations * 19
+            # Time the server spent answering, spread over the steps.
+            model_time = server.total_latency / len(durations)
+            overhead = statistics.mean(durations) - model_time
+            print(f"{agent_name:<12} {len(durations):>6} {server.num_requests:>9} {quantiles[9]:>9.3f} {quantiles[18]:>9.3f} "
+                  f"{model_time:>11.3f} {overhead:>14.3f} {server.max_in_flight:>5}   ({len(durations) / wall:.1f} steps/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Compare the payload size and encode time of the image codecs on screenshots.
+
+    python benchmark/image_codec/run.py [screenshot.png ...] --repeat 5
+"""
+import io
+import os
+import time
+import base64
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image
+
+from mobile_use.utils import ImageCodec, encode_image_url, smart_resize
+from mobile_use.agents.sub_agent import RESIZED_MAX_PIXELS
+
+
+DEFAULT_SCREENSHOT = os.path.join(os.path.dirname(__file__), '..', 'android_world', 'ref_image.png')
+
+CODECS = {
+    'png': ImageCodec('png'),
+    'png-fast': ImageCodec('png', compress_level=1),
+    'jpeg-95': ImageCodec('jpeg', quality=95, subsampling=0),
+    'jpeg-85': ImageCodec('jpeg', quality=85),
+    'jpeg-75-420': ImageCodec('jpeg', quality=75, subsampling=2),
+    'webp-85': ImageCodec('webp', quality=85),
+    'webp-lossless': ImageCodec('webp', lossless=True),
+}
+# Encoded after resizing to the `smart_resize` target, as with `send_resized_images`.
+RESIZED_CODECS = {
+    'png-resized': ImageCodec('png'),
+    'jpeg-85-resized': ImageCodec('jpeg', quality=85),
+}
+
+
+def resize(image: Image.Image) -> Image.Image:
+    height, width = smart_resize(height=image.height, width=image.width, max_pixels=RESIZED_MAX_PIXELS)
+    return image.resize((width, height), Image.Resampling.BICUBIC)
+
+
+def psnr(image: Image.Image, url: str) -> float:
+    """The PSNR of the decoded image against the original, at the `smart_resize` default size."""
+    decoded = Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1]))).convert('RGB')
+    height, width = smart_resize(height=image.height, width=image.width)
+    a = np.asarray(image.convert('RGB').resize((width, height)), dtype=np.float64)
+    b = np.asarray(decoded.resize((width, height)), dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('screenshots', nargs='*', default=[DEFAULT_SCREENSHOT])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert('RGB') for path in args.screenshots]
+    print(f"{len(images)} screenshot(s), {images[0].width}x{images[0].height}")
+    print(f"{'codec':<15} {'payload KiB':>12} {'vs png':>7} {'encode ms':>10} {'PSNR dB':>8}")
+    baseline = None
+    rows = [(name, codec, False) for name, codec in CODECS.items()]
+    rows += [(name, codec, True) for name, codec in RESIZED_CODECS.items()]
+    for name, codec, resized in rows:
+        sizes, times, quality = [], [], []
+        for image in images:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                url = encode_image_url(resize(image) if resized else image, codec=codec)
+                times.append(time.perf_counter() - start)
+            sizes.append(len(url))
+            quality.append(psnr(image, url))
+        size = statistics.mean(sizes)
+        baseline = baseline or size
+        print(f"{name:<15} {size / 1024:>12.1f} {size / baseline:>7.2f} {statistics.median(times) * 1000:>10.1f} {statistics.mean(quality):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
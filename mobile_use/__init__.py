@@ -1,4 +1,11 @@
 from mobile_use.environ import Environment
+from mobile_use.async_environ import AsyncEnvironment
+from mobile_use.device_pool import DevicePool
+from mobile_use.device_clock import DeviceClock
 from mobile_use.vlm import VLMWrapper
+from mobile_use.vlm_cache import VLMCache
+from mobile_use.vlm_router import VLMRouter
+from mobile_use.vlm_batcher import VLMBatcher
+from mobile_use.vlm_client import pool_stats
 from mobile_use.agents import *
 from .scheme import *
@@ -14,8 +14,10 @@
 
 """Utilties to interact with the environment using adb."""
 
+import functools
 import os
 import re
+import threading
 import time
 from typing import Any, Callable, Collection, Iterable, Literal, Optional, TypeVar
 import unicodedata
@@ -130,27 +132,114 @@ _DEFAULT_URIS: dict[str, str] = {
 }
 
 
+# All patterns of _PATTERN_TO_ACTIVITY in one alternation. Alternatives are
+# tried in order, so the first matching pattern wins, as with a linear scan.
+_APP_ACTIVITIES = tuple(_PATTERN_TO_ACTIVITY.values())
+_APP_PATTERN = re.compile('|'.join(
+    f'(?P<_{i}>{pattern.lower()})'
+    for i, pattern in enumerate(_PATTERN_TO_ACTIVITY)
+))
+
+
+@functools.lru_cache(maxsize=1024)
 def get_adb_activity(app_name: str) -> Optional[str]:
   """Get a mapping of regex patterns to ADB activities top Android apps."""
-  for pattern, activity in _PATTERN_TO_ACTIVITY.items():
-    if re.match(pattern.lower(), app_name.lower()):
-      return activity
+  m = _APP_PATTERN.match(app_name.lower())
+  if m is None:
+    return None
+  return _APP_ACTIVITIES[int(m.lastgroup[1:])]
 
 
+# Lists the launcher activity of every launchable app, one component per line.
+LAUNCHER_QUERY = [
+    'cmd',
+    'package',
+    'query-activities',
+    '--brief',
+    '-a',
+    'android.intent.action.MAIN',
+    '-c',
+    'android.intent.category.LAUNCHER',
+]
+_COMPONENT_RE = re.compile(r'^\s*([A-Za-z][\w.]*)/([\w.$]+)\s*$', re.MULTILINE)
+_PACKAGE_RE = re.compile(r'^package:([\w.]+)\s*$', re.MULTILINE)
 
-def _launch_default_app(
-    app_key: str,
-    device: AdbDevice,
-    timeout_sec: Optional[float] = _DEFAULT_TIMEOUT_SECS,
-):
-  """Launches a default application with a predefined data URI."""
+# (ADB server host, port, device serial) to the index of its installed apps.
+# Several ADB servers can each have their own `emulator-5554`.
+_INSTALLED_APPS: dict[tuple[str, int, str], dict[str, str]] = {}
+_INSTALLED_APPS_LOCK = threading.Lock()
+
+
+def _normalize_app_name(name: str) -> str:
+  return re.sub(r'[^0-9a-z]', '', name.lower())
+
+
+def build_installed_app_index(output: str) -> dict[str, str]:
+  """Builds an app name index from the output of LAUNCHER_QUERY or `pm list packages`.
+
+  Each app is indexed by its package name and, when no other app shares it, by
+  the last segment of its package name (e.g. `markor` for
+  `net.gsantner.markor`), both normalized with _normalize_app_name.
+
+  Args:
+    output: The output of the device command.
+
+  Returns:
+    A mapping of normalized names to launcher components, or to package names
+    when the launcher activity is unknown.
+  """
+  targets = {}
+  for package, activity in _COMPONENT_RE.findall(output):
+    targets.setdefault(package, f'{package}/{activity}')
+  for package in _PACKAGE_RE.findall(output):
+    targets.setdefault(package, package)
+
+  index = {}
+  segments = {}
+  for package, target in targets.items():
+    index[_normalize_app_name(package)] = target
+    segment = _normalize_app_name(package.rsplit('.', 1)[-1])
+    segments.setdefault(segment, []).append(target)
+  for segment, candidates in segments.items():
+    if len(candidates) == 1:
+      index.setdefault(segment, candidates[0])
+  return index
+
+
+def _device_key(device: AdbDevice) -> tuple[str, int, str]:
+  client = getattr(device, '_client', None)
+  return getattr(client, 'host', None), getattr(client, 'port', None), device.serial
+
+
+def get_installed_app_index(
+    device: AdbDevice, refresh: bool = False
+) -> dict[str, str]:
+  """Returns the installed app index of a device, queried once per ADB server and serial."""
+  key = _device_key(device)
+  with _INSTALLED_APPS_LOCK:
+    if not refresh and key in _INSTALLED_APPS:
+      return _INSTALLED_APPS[key]
+  output = device.shell(LAUNCHER_QUERY)
+  if not _COMPONENT_RE.search(output):
+    # `cmd package query-activities` is not available on old devices.
+    output = device.shell(['pm', 'list', 'packages'])
+  index = build_installed_app_index(output)
+  with _INSTALLED_APPS_LOCK:
+    _INSTALLED_APPS[key] = index
+  logger.info(f'Indexed {len(index)} installed app names on {device.serial}.')
+  return index
+
+
+
+def _default_app_command(app_key: str) -> list[str]:
+  """Returns the command that opens a default application with its data URI."""
   if app_key not in _DEFAULT_URIS:
     raise ValueError(
         f'Unrecognized app key: {app_key}. Must be one of'
         f' {list(_DEFAULT_URIS.keys())}'
     )
   data_uri = _DEFAULT_URIS[app_key]
-  adb_command = [
+  return [
       'am',
       'start',
       '-a',
@@ -158,10 +247,45 @@ def _launch_default_app(
       '-d',
       data_uri,
   ]
+
+
+def _launch_default_app(
+    app_key: str,
+    device: AdbDevice,
+    timeout_sec: Optional[float] = _DEFAULT_TIMEOUT_SECS,
+):
+  """Launches a default application with a predefined data URI."""
+  adb_command = _default_app_command(app_key)
   logger.info(f'Launche default app: {app_key}')
   device.shell(adb_command)
 
 
+def get_launch_command(
+    app_name: str, installed_apps: Optional[dict[str, str]] = None
+) -> list[str]:
+  """Returns the shell command that launches an app.
+
+  Args:
+    app_name: The name of the app, a key of _DEFAULT_URIS or
+      _PATTERN_TO_ACTIVITY, or a package name.
+    installed_apps: The installed app index of the device, see
+      get_installed_app_index. Used when the name is not in
+      _PATTERN_TO_ACTIVITY.
+
+  Returns:
+    The command as a list of arguments.
+  """
+  if app_name in _DEFAULT_URIS:
+    return _default_app_command(app_name)
+  activity = get_adb_activity(app_name)
+  if activity is None and installed_apps:
+    activity = installed_apps.get(_normalize_app_name(app_name))
+  if activity is None or '/' not in activity:
+    #  If the app name is not in the mapping, assume it is a package name.
+    return ['monkey', '-p', activity or app_name, '1']
+  return ['am', 'start', '-n', activity]
+
+
 def launch_app(
     app_name: str,
     device: AdbDevice,
@@ -176,18 +300,9 @@ def launch_app(
   Returns:
     The name of the app that is launched.
   """
-
-  if app_name in _DEFAULT_URIS:
-    _launch_default_app(app_name, device)
-    return app_name
-
-  activity = get_adb_activity(app_name)
-  if activity is None:
-    #  If the app name is not in the mapping, assume it is a package name.
-    device.shell(['monkey', '-p', app_name, '1'])
-    logger.info(f'Launch app {app_name} by package name.')
-    return app_name
-  # use adbtutils to start the activity
-  device.shell(['am', 'start', '-n', activity])
-  logger.info(f'Launch app {app_name} by activity.')
+  installed_apps = None
+  if get_adb_activity(app_name) is None and app_name not in _DEFAULT_URIS:
+    installed_apps = get_installed_app_index(device)
+  device.shell(get_launch_command(app_name, installed_apps))
+  logger.info(f'Launch app {app_name}.')
   return app_name
@@ -222,6 +222,7 @@ class QwenAgent(Agent):
 
                 try:
                     self.env.execute_action(action)
+                    step_data.settle_duration = self.env.last_settle_duration
                 except Exception as e:
                     logger.warning(f"Failed to execute the action: {action}. Error: {e}")
                     action = None
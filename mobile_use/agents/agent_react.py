@@ -275,6 +275,7 @@ class ReActAgent(Agent):
         else:
             logger.info(f"Execute the action: {action}")
             self.env.execute_action(action)
+            step_data.settle_duration = self.env.last_settle_duration
             step_data.exec_env_state = self.env.get_state()
 
         return step_data
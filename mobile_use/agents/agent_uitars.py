@@ -1,5 +1,5 @@
 import logging
-from typing import Iterator
+from typing import Dict, Iterator, List, Union
 import os
 import pickle
 import gzip
@@ -8,10 +8,10 @@ import io
 from mobile_use.scheme import *
 from mobile_use.environ import Environment
 from mobile_use.vlm import VLMWrapper
-from mobile_use.utils import encode_image_url, smart_resize, remove_img_placeholder
+from mobile_use.utils import ImageCodec, remove_img_placeholder
 from mobile_use.agents import Agent
 
-from mobile_use.agents.sub_agent import Planner, UITARSOperator, Reflector, NoteTaker, Processor, Evolutor
+from mobile_use.agents.sub_agent import Planner, UITARSOperator, Reflector, NoteTaker, Processor, Evolutor, apply_image_codecs, apply_image_resize
 
 
 logger = logging.getLogger(__name__)
@@ -103,7 +103,19 @@ class UITARSAgent(Agent):
             use_processor: bool=False,
             use_evolutor: bool=False,
             log_dir: str=None,
+            image_codecs: Dict[str, Union[ImageCodec, dict, str]]=None,
+            send_resized_images: Union[bool, List[str]]=False,
+            max_pixels: int=None,
         ):
+        """
+        Args:
+            image_codecs: The `ImageCodec` of the screenshots sent by each sub-agent,
+                e.g. {'Operator': 'webp'}. PNG by default.
+            send_resized_images: Resize the screenshots to the `smart_resize` target on
+                the client, True for every sub-agent or a list of sub-agent names.
+            max_pixels: The pixel budget of `smart_resize`, None for `RESIZED_MAX_PIXELS`
+                with `send_resized_images` and the `smart_resize` default otherwise.
+        """
         super().__init__(env=env, vlm=vlm, max_steps=max_steps)
         self.num_latest_screenshot = num_latest_screenshot
         self.num_histories = num_histories
@@ -118,6 +130,9 @@ class UITARSAgent(Agent):
         self.use_note_taker = use_note_taker
         self.use_processor = use_processor
         self.use_evolutor = use_evolutor
+        self.image_codecs = image_codecs
+        self.send_resized_images = send_resized_images
+        self.max_pixels = max_pixels
 
         self.enable_multi_model = False
         if self.use_planner or self.use_reflector or self.use_note_taker or self.use_processor or self.use_evolutor:
@@ -129,6 +144,7 @@ class UITARSAgent(Agent):
         self.note_taker = NoteTaker()
         self.processor = Processor()
         self.evolutor = Evolutor()
+        self._apply_image_codecs()
 
         self.tips = recover_tips(self.log_dir)
 
@@ -142,6 +158,19 @@ class UITARSAgent(Agent):
         self.note_taker = NoteTaker()
         self.processor = Processor()
         self.evolutor = Evolutor()
+        self._apply_image_codecs()
+
+    def _apply_image_codecs(self):
+        sub_agents = {
+            'Planner': self.planner,
+            'Operator': self.operator,
+            'Reflector': self.reflector,
+            'NoteTaker': self.note_taker,
+            'Processor': self.processor,
+            'Evolutor': self.evolutor,
+        }
+        apply_image_codecs(sub_agents, self.image_codecs)
+        apply_image_resize(sub_agents, self.send_resized_images, self.max_pixels)
 
     def _get_curr_step_data(self) -> StepData:
         if len(self.trajectory) > self.curr_step_idx:
@@ -163,7 +192,7 @@ class UITARSAgent(Agent):
         # Get the current environment screen
         env_state = self.env.get_state()
         pixels = env_state.pixels
-        resized_height, resized_width = smart_resize(height=pixels.height, width=pixels.width)
+        resized_height, resized_width = self.operator.resized_size(pixels)
 
         # Add new step data
         if len(self.trajectory) == 0:
@@ -233,6 +262,7 @@ class UITARSAgent(Agent):
                 logger.info(f"Execute the action: {action}")
                 try:
                     self.env.execute_action(action)
+                    step_data.settle_duration = self.env.last_settle_duration
                 except Exception as e:
                     logger.warning(f"Failed to execute the action: {action}. Error: {e}")
                     action = None
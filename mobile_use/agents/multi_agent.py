@@ -1,19 +1,22 @@
 import logging
-from typing import Iterator
+from typing import Dict, Iterator, List, Union
 import os
 import pickle
 import gzip
 import io
 import json
 import time
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 
 from mobile_use.scheme import *
 from mobile_use.environ import Environment
 from mobile_use.vlm import VLMWrapper
-from mobile_use.utils import encode_image_url, smart_resize
+from mobile_use.utils import ImageCodec
 from mobile_use.agents import Agent
 
 from mobile_use.agents.sub_agent import *
+from mobile_use.agents.sub_agent import apply_image_codecs, apply_image_resize
 
 
 logger = logging.getLogger(__name__)
@@ -127,7 +130,51 @@ class MultiAgent(Agent):
             logprob_threshold: float=-0.01,
             include_time: bool=True,
             log_dir: str=None,
+            concurrent_sub_agents: bool=False,
+            stream_operator: bool=False,
+            prompt_layout: str='default',
+            speculative_operator: bool=False,
+            image_codecs: Dict[str, Union[ImageCodec, dict, str]]=None,
+            send_resized_images: Union[bool, List[str]]=False,
+            max_pixels: int=None,
+            fast_diff: bool=False,
+            screen_hash_threshold: int=None,
         ):
+        """
+        Args:
+            concurrent_sub_agents: Call the Reflector, NoteTaker, Processor and
+                LongReflector of a step concurrently instead of one after another.
+                The Processor and LongReflector then do not see the reflection and
+                progress of the current step.
+            stream_operator: Stream the Operator response and execute the action as
+                soon as its tool call is complete, without waiting for the rest of
+                the generation.
+            prompt_layout: The prompt layout of the Operator, 'prefix_cache' keeps a
+                stable prompt prefix that the prefix cache of the server can reuse.
+                See `Operator`.
+            speculative_operator: Send the Operator request of the next step as soon
+                as the screenshot after the action is taken, concurrently with the
+                post-action sub-agents, assuming the action succeeded and the progress
+                and memory are unchanged. The next step uses the speculative response
+                only if its Operator messages turn out identical, otherwise it sends
+                the request again. Not used with the Planner, nor on the last step.
+                Call `close` to stop the speculation thread.
+            image_codecs: The `ImageCodec` of the screenshots sent by each sub-agent,
+                e.g. {'Operator': {'format': 'jpeg', 'quality': 90}, 'default': 'webp'}.
+                PNG by default.
+            send_resized_images: Resize the screenshots to the `smart_resize` target on
+                the client, once per frame, instead of leaving it to the server. True for
+                every sub-agent or a list of sub-agent names, e.g. ['Operator'].
+            max_pixels: The pixel budget of `smart_resize`. None is `RESIZED_MAX_PIXELS`
+                for the sub-agents sending resized screenshots, and the `smart_resize`
+                default, which does not shrink phone screenshots, for the others. Without
+                `send_resized_images` it should match the image processor of the server.
+            fast_diff: Let the Reflector find the changes between the screenshots on
+                downscaled grayscale copies, see `Reflector`.
+            screen_hash_threshold: Let the LongReflector count screens whose perceptual
+                hashes differ by at most this many bits as repeated, e.g. 4 to ignore
+                the clock. None only counts identical screenshots.
+        """
         super().__init__(env=env, vlm=vlm, max_steps=max_steps)
         self.num_latest_screenshot = num_latest_screenshot
         self.num_histories = num_histories
@@ -148,17 +195,29 @@ class MultiAgent(Agent):
         self.reflect_on_demand = reflect_on_demand
         self.logprob_threshold = logprob_threshold
         self.include_time = include_time
+        self.concurrent_sub_agents = concurrent_sub_agents
+        self.stream_operator = stream_operator
+        self.prompt_layout = prompt_layout
+        self.speculative_operator = speculative_operator
+        self.image_codecs = image_codecs
+        self.send_resized_images = send_resized_images
+        self.max_pixels = max_pixels
+        self.fast_diff = fast_diff
+        self.screen_hash_threshold = screen_hash_threshold
+        self._speculation = None
+        self._speculation_executor = None
 
         self.planner = Planner()
-        self.operator = Operator()
-        self.reflector = Reflector()
-        self.long_reflector = LongReflector()
+        self.operator = Operator(prompt_layout=self.prompt_layout)
+        self.reflector = Reflector(fast_diff=self.fast_diff)
+        self.long_reflector = LongReflector(screen_hash_threshold=self.screen_hash_threshold)
         self.note_taker = NoteTaker()
         self.processor = Processor()
         self.evaluator = Evaluator()
         self.evolutor = Evolutor()
         self.task_summarizer = TaskSummarizer()
         self.experience_extractor = ExperienceExtractor()
+        self._apply_image_codecs()
 
         if self.use_evolutor:
             self.tips = recover_tips(self.log_dir)
@@ -173,18 +232,36 @@ class MultiAgent(Agent):
         """Reset the state of the agent.
         """
         self._init_data(goal=goal)
+        self.close()
         self.device_time = None
         if self.include_time:
             self.device_time = self._get_device_time()
         self.planner = Planner()
-        self.operator = Operator()
-        self.reflector = Reflector()
-        self.long_reflector = LongReflector()
+        self.operator = Operator(prompt_layout=self.prompt_layout)
+        self.reflector = Reflector(fast_diff=self.fast_diff)
+        self.long_reflector = LongReflector(screen_hash_threshold=self.screen_hash_threshold)
         self.note_taker = NoteTaker()
         self.processor = Processor()
         self.evolutor = Evolutor()
         self.task_summarizer = TaskSummarizer()
         self.experience_extractor = ExperienceExtractor()
+        self._apply_image_codecs()
+
+    def _apply_image_codecs(self):
+        sub_agents = {
+            'Planner': self.planner,
+            'Operator': self.operator,
+            'Reflector': self.reflector,
+            'LongReflector': self.long_reflector,
+            'NoteTaker': self.note_taker,
+            'Processor': self.processor,
+            'Evaluator': self.evaluator,
+            'Evolutor': self.evolutor,
+            'TaskSummarizer': self.task_summarizer,
+            'ExperienceExtractor': self.experience_extractor,
+        }
+        apply_image_codecs(sub_agents, self.image_codecs)
+        apply_image_resize(sub_agents, self.send_resized_images, self.max_pixels)
     
     def _get_device_time(self) -> str:
         date_str = self.env.get_time()
@@ -214,7 +291,7 @@ class MultiAgent(Agent):
         evaluator_messages = self.evaluator.get_message(episodedata)
         show_message(evaluator_messages, "Evaluator")
         logger.info("Evaluating...")
-        response = self.vlm.predict(evaluator_messages)
+        response = self.vlm.predict(evaluator_messages, role='Evaluator', call_stats=self.episode_data.vlm_call_stats)
         result, reason, tips = None, None, None
         try:
             content = response.choices[0].message.content
@@ -231,7 +308,7 @@ class MultiAgent(Agent):
             logger.info("Summarizing...")
             summary_messages = self.task_summarizer.get_message(episodedata, result)
             show_message(summary_messages, "TaskSummarizer")
-            response = self.vlm.predict(summary_messages)
+            response = self.vlm.predict(summary_messages, role='TaskSummarizer', call_stats=self.episode_data.vlm_call_stats)
             try:
                 content = response.choices[0].message.content
                 logger.info("Task Summary from VLM:\n%s" % content)
@@ -320,7 +397,7 @@ class MultiAgent(Agent):
             experience_extract_message = self.experience_extractor.get_message(goal, retrieved_task['goal'], retrieved_task['summary'])
             show_message(experience_extract_message, "ExperienceExtractor")
             logger.info("Extracting experience...")
-            response = self.vlm.predict(experience_extract_message)
+            response = self.vlm.predict(experience_extract_message, role='ExperienceExtractor', call_stats=self.episode_data.vlm_call_stats)
             try:
                 content = response.choices[0].message.content
                 logger.info("Experience from VLM:\n%s" % content)
@@ -353,6 +430,156 @@ class MultiAgent(Agent):
                 logger.info("Action type logprobs: %s" % action_type_logprobs)
         return action_type_tokens, action_type_logprobs
 
+    def _get_reflection_messages(self):
+        reflection_messages = self.reflector.get_message(self.episode_data)
+        if self.curr_step_idx in [0, 4]:
+            show_message(reflection_messages, "Reflector")
+        return reflection_messages
+
+    def _parse_reflection(self, step_data: StepData, response):
+        try:
+            content = response.choices[0].message.content
+            logger.info("Reflection from VLM:\n%s" % content)
+            outcome, error_description = self.reflector.parse_response(content)
+            if outcome in self.reflector.valid_options:
+                logger.info("Outcome: %s" % outcome)
+                logger.info("Error Description: %s" % error_description)
+                step_data.reflection_outcome = outcome
+                step_data.reflection_error = error_description
+        except Exception as e:
+            logger.warning(f"Failed to parse the reflection. Error: {e}")
+
+    def _get_note_messages(self):
+        note_messages = self.note_taker.get_message(self.episode_data)
+        if self.curr_step_idx in [0, 4]:
+            show_message(note_messages, "NoteTaker")
+        return note_messages
+
+    def _parse_note(self, step_data: StepData, response):
+        try:
+            content = response.choices[0].message.content
+            logger.info("Memory from VLM:\n%s" % content)
+            memory = self.note_taker.parse_response(content)
+            logger.info("Memory: %s" % memory)
+            step_data.memory = memory
+        except Exception as e:
+            logger.warning(f"Failed to parse the memory. Error: {e}")
+
+    def _get_processor_messages(self):
+        processor_messages = self.processor.get_message(self.episode_data)
+        if self.curr_step_idx in [0, 4]:
+            show_message(processor_messages, "Processor")
+        return processor_messages
+
+    def _parse_progress(self, step_data: StepData, response):
+        try:
+            content = response.choices[0].message.content
+            logger.info("Progress from VLM:\n%s" % content)
+            progress = self.processor.parse_response(content)
+            logger.info("Progress: %s" % progress)
+            step_data.progress = progress
+        except Exception as e:
+            logger.warning(f"Failed to parse the progress. Error: {e}")
+
+    def _get_long_reflection_messages(self):
+        long_reflection_messages = self.long_reflector.get_message(self.episode_data)
+        if long_reflection_messages is not None and self.curr_step_idx in [4, 9]:
+            show_message(long_reflection_messages, "LongReflector")
+        return long_reflection_messages
+
+    def _parse_long_reflection(self, step_data: StepData, response):
+        try:
+            content = response.choices[0].message.content
+            logger.info("Long Reflection from VLM:\n%s" % content)
+            outcome, error_description = self.long_reflector.parse_response(content)
+            if outcome in self.long_reflector.valid_options:
+                logger.info("Long Outcome: %s" % outcome)
+                logger.info("Long Error Description: %s" % error_description)
+                step_data.long_reflection_outcome = outcome
+                step_data.long_reflection_error = error_description
+        except Exception as e:
+            logger.warning(f"Failed to parse the long reflection. Error: {e}")
+
+    def _call_sub_agents(self, sub_agent_calls: list, step_data: StepData):
+        """Call the post-action sub-agents, given as (role, get_messages, parse_response) tuples.
+
+        In sequential mode each sub-agent sees the outputs of the previous ones.
+        In concurrent mode all messages are built first and sent at once.
+        """
+        if not self.concurrent_sub_agents:
+            for role, get_messages, parse_response in sub_agent_calls:
+                messages = get_messages()
+                if messages is not None:
+                    parse_response(step_data, self.vlm.predict(messages, role=role, call_stats=step_data.vlm_call_stats))
+            return
+
+        pending = []
+        for role, get_messages, parse_response in sub_agent_calls:
+            messages = get_messages()
+            if messages is not None:
+                pending.append((role, messages, parse_response))
+        responses = self.vlm.predict_many(
+            [messages for _, messages, _ in pending],
+            roles=[role for role, _, _ in pending],
+            call_stats=step_data.vlm_call_stats,
+        )
+        for (_, _, parse_response), response in zip(pending, responses):
+            parse_response(step_data, response)
+
+    def _predict_operator(self, operator_messages: list, step_data: StepData, role: str='Operator'):
+        kwargs = dict(stop=['Summary'], logprobs=self.reflect_on_demand, role=role, call_stats=step_data.vlm_call_stats)
+        if self.stream_operator:
+            stream_parser = self.operator.stream_parser()
+            return self.vlm.predict_until(operator_messages, stream_parser.feed, **kwargs)
+        return self.vlm.predict(operator_messages, **kwargs)
+
+    def _speculate(self, step_data: StepData, skip_reflector: bool):
+        """Send the Operator request of the next step before the sub-agents of this step return."""
+        previous_step = self.trajectory[-2] if len(self.trajectory) > 1 else None
+        guess = dataclasses.replace(step_data)
+        if self.use_reflector and not skip_reflector:
+            guess.reflection_outcome = 'A'
+        if self.use_processor:
+            guess.progress = previous_step.progress if previous_step is not None else None
+        if self.use_note_taker:
+            guess.memory = previous_step.memory if previous_step is not None else None
+        next_step = StepData(step_idx=step_data.step_idx + 1, curr_env_state=step_data.exec_env_state, vlm_call_history=[])
+        episode_data = dataclasses.replace(self.episode_data, trajectory=self.trajectory[:-1] + [guess, next_step])
+        messages = self.operator.get_message(episode_data, device_time=self.device_time)
+        if self._speculation_executor is None:
+            self._speculation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SpeculativeOperator")
+        self._speculation = (messages, self._speculation_executor.submit(self._predict_operator, messages, step_data, 'SpeculativeOperator'))
+
+    def _take_speculation(self, operator_messages: list, step_data: StepData):
+        """Return the speculative Operator response if it was sent with the same messages."""
+        if self._speculation is None:
+            return None
+        messages, future = self._speculation
+        self._speculation = None
+        step_data.speculative_hit = messages == operator_messages
+        if not step_data.speculative_hit:
+            logger.info("Discard the speculative Operator response, the messages changed.")
+            future.cancel()
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"The speculative Operator request failed. Error: {e}")
+            return None
+
+    def _drop_speculation(self):
+        """Cancel the pending speculation, it will not be used."""
+        if self._speculation is not None:
+            self._speculation[1].cancel()
+            self._speculation = None
+
+    def close(self):
+        """Drop a pending speculation and stop the speculation thread."""
+        self._drop_speculation()
+        if self._speculation_executor is not None:
+            self._speculation_executor.shutdown(wait=False, cancel_futures=True)
+            self._speculation_executor = None
+
     def step(self):
         """Execute the task with maximum number of steps.
 
@@ -366,7 +593,8 @@ class MultiAgent(Agent):
         # Get the current environment screen
         env_state = self.env.get_state()
         pixels = env_state.pixels
-        resized_height, resized_width = smart_resize(height=pixels.height, width=pixels.width)
+        # The coordinate space of the Operator, the same size its prompt states.
+        resized_height, resized_width = self.operator.resized_size(pixels)
 
         # Add new step data
         if len(self.trajectory) == 0:
@@ -379,7 +607,8 @@ class MultiAgent(Agent):
         self.trajectory.append(StepData(
             step_idx=self.curr_step_idx,
             curr_env_state=env_state,
-            vlm_call_history=[]
+            vlm_call_history=[],
+            vlm_call_stats=[],
         ))
         step_data = self.trajectory[-1]
 
@@ -388,7 +617,7 @@ class MultiAgent(Agent):
             plan_messages = self.planner.get_message(self.episode_data)
             if self.curr_step_idx in show_step:
                 show_message(plan_messages, "Planner")
-            response = self.vlm.predict(plan_messages)
+            response = self.vlm.predict(plan_messages, role='Planner', call_stats=step_data.vlm_call_stats)
             try:
                 raw_plan = response.choices[0].message.content
                 logger.info("Plan from VLM:\n%s" % raw_plan)
@@ -406,9 +635,13 @@ class MultiAgent(Agent):
         skip_reflector = False
         # operator_messages = self.operator.get_message(self.episode_data)
         operator_messages = self.operator.get_message(self.episode_data, device_time=self.device_time)
+        step_data.prompt_prefix_length = self.operator.prefix_length
+        step_data.prompt_prefix_hash = self.operator.prefix_hash
         if self.curr_step_idx in show_step:
             show_message(operator_messages, "Operator")
-        response = self.vlm.predict(operator_messages, stop=['Summary'], logprobs=self.reflect_on_demand)
+        response = self._take_speculation(operator_messages, step_data)
+        if response is None:
+            response = self._predict_operator(operator_messages, step_data)
 
         for counter in range(self.max_reflection_action):
             try:
@@ -428,7 +661,7 @@ class MultiAgent(Agent):
                     'text': f"Failed to parse the action.\nError is {e.args}\nPlease follow the output format to provide a valid action:"
                 }
                 operator_messages[-1]['content'].append(msg)
-                response = self.vlm.predict(operator_messages, stop=['Summary'])
+                response = self.vlm.predict(operator_messages, stop=['Summary'], role='Operator', call_stats=step_data.vlm_call_stats)
         if counter > 0:
             operator_messages[-1]['content'] = operator_messages[-1]['content'][:-counter]
 
@@ -463,6 +696,7 @@ class MultiAgent(Agent):
                         start_exec_time = time.time()
                         self.env.execute_action(action)
                         step_data.exec_duration = time.time() - start_exec_time
+                        step_data.settle_duration = self.env.last_settle_duration
                     except Exception as e:
                         logger.warning(f"Failed to execute the action: {action}. Error: {e}")
                         action = None
@@ -491,38 +725,14 @@ class MultiAgent(Agent):
         step_data.exec_env_state = self.env.get_state()
 
         if self.status not in [AgentStatus.FINISHED, AgentStatus.FAILED] and action is not None:
+            sub_agent_calls = []
             # Call Reflector
             if self.use_reflector and not skip_reflector:
-                reflection_messages = self.reflector.get_message(self.episode_data)
-                if self.curr_step_idx in show_step:
-                    show_message(reflection_messages, "Reflector")
-                response = self.vlm.predict(reflection_messages)
-                try:
-                    content = response.choices[0].message.content
-                    logger.info("Reflection from VLM:\n%s" % content)
-                    outcome, error_description = self.reflector.parse_response(content)
-                    if outcome in self.reflector.valid_options:
-                        logger.info("Outcome: %s" % outcome)
-                        logger.info("Error Description: %s" % error_description)
-                        step_data.reflection_outcome = outcome
-                        step_data.reflection_error = error_description
-                except Exception as e:
-                    logger.warning(f"Failed to parse the reflection. Error: {e}")
+                sub_agent_calls.append(('Reflector', self._get_reflection_messages, self._parse_reflection))
 
             # Call NoteTaker
             if self.use_note_taker:
-                note_messages = self.note_taker.get_message(self.episode_data)
-                if self.curr_step_idx in show_step:
-                    show_message(note_messages, "NoteTaker")
-                response = self.vlm.predict(note_messages)
-                try:
-                    content = response.choices[0].message.content
-                    logger.info("Memory from VLM:\n%s" % content)
-                    memory = self.note_taker.parse_response(content)
-                    logger.info("Memory: %s" % memory)
-                    step_data.memory = memory
-                except Exception as e:
-                    logger.warning(f"Failed to parse the memory. Error: {e}")
+                sub_agent_calls.append(('NoteTaker', self._get_note_messages, self._parse_note))
 
             # Call Processor
             if self.use_processor:
@@ -535,37 +745,16 @@ class MultiAgent(Agent):
                     if len(self.trajectory) > 1:
                         step_data.progress = self.trajectory[-2].progress
                 else:
-                    processor_messages = self.processor.get_message(self.episode_data)
-                    if self.curr_step_idx in show_step:
-                        show_message(processor_messages, "Processor")
-                    response = self.vlm.predict(processor_messages)
-                    try:
-                        content = response.choices[0].message.content
-                        logger.info("Progress from VLM:\n%s" % content)
-                        progress = self.processor.parse_response(content)
-                        logger.info("Progress: %s" % progress)
-                        step_data.progress = progress
-                    except Exception as e:
-                        logger.warning(f"Failed to parse the progress. Error: {e}")
+                    sub_agent_calls.append(('Processor', self._get_processor_messages, self._parse_progress))
 
             # Call LongReflector
             if self.use_long_reflector:
-                long_reflection_messages = self.long_reflector.get_message(self.episode_data)
-                if long_reflection_messages is not None:
-                    if self.curr_step_idx in [4,9]:
-                        show_message(long_reflection_messages, "LongReflector")
-                    response = self.vlm.predict(long_reflection_messages)
-                    try:
-                        content = response.choices[0].message.content
-                        logger.info("Long Reflection from VLM:\n%s" % content)
-                        outcome, error_description = self.long_reflector.parse_response(content)
-                        if outcome in self.long_reflector.valid_options:
-                            logger.info("Long Outcome: %s" % outcome)
-                            logger.info("Long Error Description: %s" % error_description)
-                            step_data.long_reflection_outcome = outcome
-                            step_data.long_reflection_error = error_description
-                    except Exception as e:
-                        logger.warning(f"Failed to parse the long reflection. Error: {e}")
+                sub_agent_calls.append(('LongReflector', self._get_long_reflection_messages, self._parse_long_reflection))
+
+            # No next step once the step budget is spent.
+            if self.speculative_operator and not self.use_planner and len(self.trajectory) < self.max_steps:
+                self._speculate(step_data, skip_reflector)
+            self._call_sub_agents(sub_agent_calls, step_data)
 
         if self.status == AgentStatus.FINISHED:
             # Answer
@@ -578,7 +767,7 @@ class MultiAgent(Agent):
             # answer_messages = self.operator.get_message(self.episode_data, is_answer=True)
             answer_messages = self.operator.get_message(self.episode_data, device_time=self.device_time, is_answer=True)
             show_message(answer_messages, "Answer")
-            response = self.vlm.predict(answer_messages)
+            response = self.vlm.predict(answer_messages, role='Answer', call_stats=step_data.vlm_call_stats)
             try:
                 content = response.choices[0].message.content
                 logger.info("Answer from VLM:\n%s" % content)
@@ -594,7 +783,7 @@ class MultiAgent(Agent):
                 evaluator_messages = self.evaluator.get_message(self.episode_data)
                 show_message(evaluator_messages, "Evaluator")
                 logger.info("Evaluating...")
-                response = self.vlm.predict(evaluator_messages)
+                response = self.vlm.predict(evaluator_messages, role='Evaluator', call_stats=step_data.vlm_call_stats)
                 result, reason, tips = None, None, None
                 try:
                     content = response.choices[0].message.content
@@ -615,7 +804,7 @@ class MultiAgent(Agent):
             if self.use_evolutor:
                 evolutor_messages = self.evolutor.get_message(self.episode_data)
                 show_message(evolutor_messages, "Evolutor")
-                response = self.vlm.predict(evolutor_messages)
+                response = self.vlm.predict(evolutor_messages, role='Evolutor', call_stats=step_data.vlm_call_stats)
                 try:
                     content = response.choices[0].message.content
                     logger.info("Updated tips from VLM:\n%s" % content)
@@ -652,6 +841,7 @@ class MultiAgent(Agent):
                 self.step()
                 yield self._get_curr_step_data()
             except Exception as e:
+                self._drop_speculation()
                 self.status = AgentStatus.FAILED
                 self.episode_data.status = self.status
                 self.episode_data.message = str(e)
@@ -668,6 +858,7 @@ class MultiAgent(Agent):
                 return
             elif self.state == AgentState.CALLUSER:
                 logger.info("Agent indicates to ask user for help.")
+                self._drop_speculation()
                 yield self._get_curr_step_data()
                 return
             else:
@@ -1,10 +1,13 @@
 from abc import ABC, abstractmethod
 import re
 import json
+import hashlib
 import logging
+from typing import Union
 
 from mobile_use.scheme import *
-from mobile_use.utils import encode_image_url, smart_resize, remove_img_placeholder, is_same_image, diff_image
+from PIL import Image
+from mobile_use.utils import ImageCodec, encode_image_url, smart_resize, remove_img_placeholder, diff_image, diff_image_fast
 
 __all__ = ['Planner', 'Operator', 'Reflector', 'LongReflector', 'NoteTaker', 'Processor', 'Evaluator', 'TaskSummarizer', 'ExperienceExtractor', 'Evolutor', 'UITARSOperator']
 
@@ -14,6 +17,10 @@ logger = logging.getLogger(__name__)
 # If you are using QwenAPI from 'dashscope.aliyuncs.com', replace IMAGE_PLACEHOLDER with ''
 IMAGE_PLACEHOLDER = '<|vision_start|><|image_pad|><|vision_end|>'
 
+# The default `smart_resize` budget of the sub-agents sending resized screenshots.
+# The `smart_resize` default does not shrink phone screenshots.
+RESIZED_MAX_PIXELS = 1280 * 28 * 28
+
 ACTION_SPACE = ["key", "click", "left_click", "long_press", "swipe", "scroll", "type", "clear_text", "answer", "system_button", "open", "wait", "terminate", "take_note"]
 
 
@@ -42,7 +49,89 @@ def get_history(trajectory: List[StepData], num_histories=None):
     return history
 
 
+class ToolCallScanner:
+    """Incrementally find the end of the `{"name": "mobile_use", ...}` tool call in a streamed response.
+
+    Feed the response chunk by chunk; `feed` returns True once the JSON object
+    of the tool call is closed. Each character is scanned once.
+    """
+
+    START = '{"name": "mobile_use",'
+
+    def __init__(self):
+        self.text = ''
+        self._start = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, delta: str) -> bool:
+        if self.done:
+            return True
+        self.text += delta
+        if self._start is None:
+            # The start marker may be split across chunks.
+            idx = self.text.find(self.START, max(0, self._pos - len(self.START)))
+            if idx < 0:
+                self._pos = len(self.text)
+                return False
+            self._start = self._pos = idx
+        for i in range(self._pos, len(self.text)):
+            c = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == '{':
+                self._depth += 1
+            elif c == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                    self._pos = i + 1
+                    return True
+        self._pos = len(self.text)
+        return False
+
+
 class SubAgent(ABC):
+    # How screenshots are encoded, see `ImageCodec`. None sends PNG.
+    image_codec: Optional[ImageCodec] = None
+    # The pixel budget of `smart_resize`, None for its default. It should match
+    # the image processor of the server unless `send_resized_images` is set.
+    max_pixels: Optional[int] = None
+    # Resize the screenshots to the `smart_resize` target before sending them.
+    send_resized_images: bool = False
+
+    def resized_size(self, image: Image.Image) -> Tuple[int, int]:
+        """The (height, width) the model sees the image at."""
+        if self.max_pixels is None:
+            return smart_resize(height=image.height, width=image.width)
+        return smart_resize(height=image.height, width=image.width, max_pixels=self.max_pixels)
+
+    def send_size(self, image: Image.Image) -> Optional[Tuple[int, int]]:
+        """The (width, height) to resize a screenshot to before sending it, None to send it as is.
+
+        Screenshots are only resized if `send_resized_images`, and never upscaled.
+        """
+        if not self.send_resized_images:
+            return None
+        height, width = self.resized_size(image)
+        if width >= image.width and height >= image.height:
+            return None
+        return width, height
+
+    def frame_url(self, env_state: EnvState) -> str:
+        """The data URL of a screenshot, resized if `send_resized_images`."""
+        return env_state.image_url(self.image_codec, size=self.send_size(env_state.pixels))
+
     @abstractmethod
     def get_message(self, episodedata: EpisodeData) -> list:
         pass
@@ -51,6 +140,38 @@ class SubAgent(ABC):
         pass
 
 
+def apply_image_codecs(sub_agents: Dict[str, SubAgent], image_codecs: Optional[Dict[str, Any]]):
+    """Set the image codec of each sub-agent from a mapping of role name to codec.
+
+    The codecs are `ImageCodec`s, their keyword arguments or format names. The
+    'default' entry applies to the roles without their own codec.
+    """
+    image_codecs = {role: ImageCodec.from_params(codec) for role, codec in (image_codecs or {}).items()}
+    unknown = set(image_codecs) - set(sub_agents) - {'default'}
+    if unknown:
+        raise ValueError(f"Unknown sub-agents in image_codecs: {sorted(unknown)}, should be among {sorted(sub_agents)}")
+    for role, sub_agent in sub_agents.items():
+        sub_agent.image_codec = image_codecs.get(role, image_codecs.get('default'))
+
+
+def apply_image_resize(sub_agents: Dict[str, SubAgent], send_resized_images: Union[bool, List[str]], max_pixels: Optional[int]=None):
+    """Set the `smart_resize` budget of every sub-agent and which of them send resized screenshots.
+
+    `send_resized_images` is True or False for every sub-agent, or a list of role names.
+    Without `max_pixels`, the sub-agents sending resized screenshots use `RESIZED_MAX_PIXELS`.
+    """
+    if isinstance(send_resized_images, bool):
+        roles = set(sub_agents) if send_resized_images else set()
+    else:
+        roles = set(send_resized_images)
+        unknown = roles - set(sub_agents)
+        if unknown:
+            raise ValueError(f"Unknown sub-agents in send_resized_images: {sorted(unknown)}, should be among {sorted(sub_agents)}")
+    for role, sub_agent in sub_agents.items():
+        sub_agent.send_resized_images = role in roles
+        sub_agent.max_pixels = RESIZED_MAX_PIXELS if max_pixels is None and role in roles else max_pixels
+
+
 """
 Call in the beginning of each step.
 """
@@ -60,8 +181,8 @@ class Planner(SubAgent):
         trajectory = episodedata.trajectory
         current_step = trajectory[-1]
 
-        pixels = current_step.curr_env_state.pixels.copy()
-        resized_height, resized_width = smart_resize(height=pixels.height, width=pixels.width)
+        pixels = current_step.curr_env_state.pixels
+        resized_height, resized_width = self.resized_size(pixels)
         
         # Add system prompt
         messages.append({
@@ -126,7 +247,7 @@ class Planner(SubAgent):
             "role": "user",
             "content": [
                 {"type": "text","text": prompt},
-                {"type": "image_url","image_url": {"url": encode_image_url(pixels)}, "resized_height": resized_height, "resized_width": resized_width}
+                {"type": "image_url","image_url": {"url": self.frame_url(current_step.curr_env_state)}, "resized_height": resized_height, "resized_width": resized_width}
             ]
         })
 
@@ -140,17 +261,36 @@ class Planner(SubAgent):
 
 
 class Operator(SubAgent):
-    def __init__(self, num_histories: int = None):
+    """The sub-agent that decides the next action.
+
+    Args:
+        num_histories: The number of latest operations in the prompt, None for all.
+        prompt_layout: 'default', or 'prefix_cache' to put the instruction, tips and
+            response requirements before the history and the screenshot. The prompt
+            then starts with a prefix that stays byte-identical across the steps of an
+            episode (and, up to the goal, across episodes on the same resolution),
+            which the prefix cache of servers like vLLM can reuse.
+    """
+
+    PROMPT_LAYOUTS = ('default', 'prefix_cache')
+
+    def __init__(self, num_histories: int = None, prompt_layout: str = 'default'):
         super().__init__()
+        if prompt_layout not in self.PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout: {prompt_layout}, should be one of {self.PROMPT_LAYOUTS}")
         self.num_histories = num_histories
+        self.prompt_layout = prompt_layout
+        # Characters and hash of the stable prefix of the last message, see `get_message`.
+        self.prefix_length = None
+        self.prefix_hash = None
 
     def get_message(self, episodedata: EpisodeData, device_time: str = None, is_answer: bool = False) -> list:
         messages = []
         trajectory = episodedata.trajectory
         current_step = trajectory[-1]
         
-        pixels = current_step.curr_env_state.pixels.copy()
-        resized_height, resized_width = smart_resize(height=pixels.height, width=pixels.width)
+        pixels = current_step.curr_env_state.pixels
+        resized_height, resized_width = self.resized_size(pixels)
 
         if not is_answer:
             # Add system prompt
@@ -222,6 +362,7 @@ You are provided with function signatures within <tools></tools> XML tags:
         # Add user prompt
         prompt = "### User Instruction ###\n"
         prompt += f"{episodedata.goal}\n\n"
+        head_end = len(prompt)
 
         if device_time is not None:
             prompt += "### Current Time ###\n"
@@ -293,6 +434,7 @@ You are provided with function signatures within <tools></tools> XML tags:
         prompt += "### Observation ###\n"
         prompt += f"This is the current screenshot of the phone. The screen's resolution is {resized_width}x{resized_height}."
         prompt += f"{IMAGE_PLACEHOLDER}\n\n"
+        context_end = len(prompt)
 
 #         prompt += "### Guidance ###\n"
 #         prompt += """Here are some useful guidelines you need to follow:
@@ -336,16 +478,34 @@ Answer with the following format:
 {{"name": "mobile_use", "arguments": {{"action": "answer", "text": <your-answer>}}}}
 </tool_call>""".format(goal=episodedata.goal)
 
+        head, context, instructions = prompt[:head_end], prompt[head_end:context_end], prompt[context_end:]
+        if self.prompt_layout == 'prefix_cache':
+            # Stable parts first, the parts that change every step last.
+            prompt = head + instructions + "\n\n" + context
+            prefix = head + instructions
+        else:
+            prefix = head
+        prefix = messages[0]["content"][0]["text"] + prefix
+        self.prefix_length = len(prefix)
+        self.prefix_hash = hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:16]
+
         messages.append({
             "role": "user",
             "content": [
                 {"type": "text","text": prompt},
-                {"type": "image_url","image_url": {"url": encode_image_url(pixels)}, "resized_height": resized_height, "resized_width": resized_width}
+                {"type": "image_url","image_url": {"url": self.frame_url(current_step.curr_env_state)}, "resized_height": resized_height, "resized_width": resized_width}
             ]
         })
 
         return messages
     
+    def stream_parser(self) -> ToolCallScanner:
+        """A parser for a streamed response, which tells when the action is complete.
+
+        The content received up to that point can be passed to `parse_response`.
+        """
+        return ToolCallScanner()
+
     def parse_response(self, content: str, size: tuple[float, float], raw_size: tuple[float, float]):
         thought = re.search(r"Thought:(.*?)(?=\n|Action:|<tool_call>|\{\"name\": \"mobile_use\",)", content, flags=re.DOTALL)
         if thought:
@@ -385,24 +545,51 @@ Answer with the following format:
 Call after executing each action.
 """
 class Reflector(SubAgent):
-    def __init__(self):
+    """The sub-agent that judges the outcome of the last action.
+
+    Args:
+        fast_diff: Find the changes to highlight on grayscale screenshots downscaled
+            by 2**`diff_level`, cached on the `EnvState`s, and skip identical frames
+            by their hash. See `diff_image_fast`.
+    """
+
+    def __init__(self, fast_diff: bool=False, diff_level: int=2):
         super().__init__()
         self.valid_options = ['A', 'B', 'C', 'D']
+        self.fast_diff = fast_diff
+        self.diff_level = diff_level
+
+    def diff(self, before: EnvState, after: EnvState):
+        """The screenshots with their differences highlighted, or (None, None)."""
+        if not self.fast_diff:
+            return diff_image(before.pixels, after.pixels)
+        if before.digest == after.digest:
+            logger.info("DIFF IMAGE: The two images are identical.")
+            return None, None
+        return diff_image_fast(before.pixels, after.pixels, level=self.diff_level,
+                               gray1=before.gray(self.diff_level), gray2=after.gray(self.diff_level))
 
     def get_message(self, episodedata: EpisodeData) -> list:
         messages = []
         trajectory = episodedata.trajectory
         current_step = trajectory[-1]
 
-        pixels_before = current_step.curr_env_state.pixels.copy()
-        resized_height, resized_width = smart_resize(height=pixels_before.height, width=pixels_before.width)
-        pixels_after = current_step.exec_env_state.pixels.copy()
+        resized_height, resized_width = self.resized_size(current_step.curr_env_state.pixels)
 
         diff_flag = False
-        new_img1, new_img2 = diff_image(pixels_before, pixels_after)
+        new_img1, new_img2 = self.diff(current_step.curr_env_state, current_step.exec_env_state)
         if new_img1 is not None:
-            pixels_before, pixels_after = new_img1, new_img2
             diff_flag = True
+            size = self.send_size(new_img1)
+            if size is not None:
+                new_img1 = new_img1.resize(size, Image.Resampling.BICUBIC)
+                new_img2 = new_img2.resize(size, Image.Resampling.BICUBIC)
+            url_before = encode_image_url(new_img1, codec=self.image_codec)
+            url_after = encode_image_url(new_img2, codec=self.image_codec)
+        else:
+            # The full frames, shared with the other sub-agents.
+            url_before = self.frame_url(current_step.curr_env_state)
+            url_after = self.frame_url(current_step.exec_env_state)
         
         # Add system prompt
         messages.append({
@@ -459,8 +646,8 @@ class Reflector(SubAgent):
             "role": "user",
             "content": [
                 {"type": "text","text": prompt},
-                {"type": "image_url","image_url": {"url": encode_image_url(pixels_before)}, "resized_height": resized_height, "resized_width": resized_width},
-                {"type": "image_url","image_url": {"url": encode_image_url(pixels_after)}, "resized_height": resized_height, "resized_width": resized_width}
+                {"type": "image_url","image_url": {"url": url_before}, "resized_height": resized_height, "resized_width": resized_width},
+                {"type": "image_url","image_url": {"url": url_after}, "resized_height": resized_height, "resized_width": resized_width}
             ]
         })
 
@@ -473,13 +660,22 @@ class Reflector(SubAgent):
 
 
 class LongReflector(SubAgent):
+    """The sub-agent that reflects on the latest steps and detects loops.
+
+    Args:
+        screen_hash_threshold: How `detect` finds repeated screens: None for
+            identical screenshots, otherwise the largest Hamming distance between
+            their perceptual hashes, see `EnvState.near_duplicate`.
+    """
+
     def __init__(
         self,
         evoke_every_steps: int = 5,
         cold_steps: int = 3,
         detect_error: bool = True,
         num_histories = 'auto',
-        num_latest_screenshots: int = 0
+        num_latest_screenshots: int = 0,
+        screen_hash_threshold: Optional[int] = None,
     ):
         super().__init__()
         self.valid_options = ['A', 'B']
@@ -492,6 +688,7 @@ class LongReflector(SubAgent):
         else:
             self.num_histories = num_histories
         self.num_latest_screenshots = num_latest_screenshots
+        self.screen_hash_threshold = screen_hash_threshold
     
     def detect(
         self, 
@@ -530,7 +727,8 @@ class LongReflector(SubAgent):
         # detect repeated screenshots
         repeat_screen = 1
         for step in trajectory[:-1][::-1]:
-            if is_same_image(step.exec_env_state.pixels.copy(), current_step.exec_env_state.pixels.copy()):
+            # Compares the fingerprints cached on the states, not the pixels.
+            if step.exec_env_state.near_duplicate(current_step.exec_env_state, self.screen_hash_threshold):
                 repeat_screen += 1
             else:
                 break
@@ -576,8 +774,8 @@ class LongReflector(SubAgent):
 
         num_latest_screenshots = min(self.num_latest_screenshots, len(trajectory))
         if num_latest_screenshots > 0:
-            screenshots = [step.exec_env_state.pixels.copy() for step in trajectory[-num_latest_screenshots:]]
-            resized_height, resized_width = smart_resize(height=screenshots[0].height, width=screenshots[0].width)
+            screenshots = [step.exec_env_state.pixels for step in trajectory[-num_latest_screenshots:]]
+            resized_height, resized_width = self.resized_size(screenshots[0])
 
         # Add system prompt
         messages.append({
@@ -637,8 +835,8 @@ class LongReflector(SubAgent):
 
         message_content = [{"type": "text","text": prompt}]
         if num_latest_screenshots > 0:
-            for screenshot in screenshots:
-                message_content.append({"type": "image_url","image_url": {"url": encode_image_url(screenshot)}, "resized_height": resized_height, "resized_width": resized_width})
+            for step in trajectory[-num_latest_screenshots:]:
+                message_content.append({"type": "image_url","image_url": {"url": self.frame_url(step.exec_env_state)}, "resized_height": resized_height, "resized_width": resized_width})
         messages.append({"role": "user","content": message_content})
 
         return messages
@@ -658,8 +856,8 @@ class NoteTaker(SubAgent):
         trajectory = episodedata.trajectory
         current_step = trajectory[-1]
 
-        pixels = current_step.exec_env_state.pixels.copy()
-        resized_height, resized_width = smart_resize(height=pixels.height, width=pixels.width)
+        pixels = current_step.exec_env_state.pixels
+        resized_height, resized_width = self.resized_size(pixels)
 
         # Add system prompt
         messages.append({
@@ -709,7 +907,7 @@ class NoteTaker(SubAgent):
             "role": "user",
             "content": [
                 {"type": "text","text": prompt},
-                {"type": "image_url","image_url": {"url": encode_image_url(pixels)}, "resized_height": resized_height, "resized_width": resized_width}
+                {"type": "image_url","image_url": {"url": self.frame_url(current_step.exec_env_state)}, "resized_height": resized_height, "resized_width": resized_width}
             ]
         })
 
@@ -885,8 +1083,8 @@ class Evaluator(SubAgent):
         last_step = trajectory[-1]
 
         num_latest_screenshots = min(self.num_latest_screenshots, len(trajectory))
-        screenshots = [step.exec_env_state.pixels.copy() for step in trajectory[-num_latest_screenshots:]]
-        resized_height, resized_width = smart_resize(height=screenshots[0].height, width=screenshots[0].width)
+        screenshots = [step.exec_env_state.pixels for step in trajectory[-num_latest_screenshots:]]
+        resized_height, resized_width = self.resized_size(screenshots[0])
         
         # Add system prompt
         messages.append({
@@ -941,8 +1139,8 @@ class Evaluator(SubAgent):
         prompt += "Provide reason for your answer.\n"
 
         message_content = [{"type": "text","text": prompt}]
-        for screenshot in screenshots:
-            message_content.append({"type": "image_url","image_url": {"url": encode_image_url(screenshot)}, "resized_height": resized_height, "resized_width": resized_width})
+        for step in trajectory[-num_latest_screenshots:]:
+            message_content.append({"type": "image_url","image_url": {"url": self.frame_url(step.exec_env_state)}, "resized_height": resized_height, "resized_width": resized_width})
         messages.append({"role": "user","content": message_content})
 
         return messages
@@ -1183,8 +1381,6 @@ finished(content='') # Submit the task regardless of whether it succeeds or fail
         trajectory = episodedata.trajectory
         current_step = trajectory[-1]
         
-        pixels = current_step.curr_env_state.pixels.copy()
-
         if len(trajectory) == 1:
             self.messages.append({
                 "role": "user",
@@ -1233,7 +1429,7 @@ finished(content='') # Submit the task regardless of whether it succeeds or fail
                 prompt += f"{episodedata.input_tips}\n\n"
 
         self.messages.append({ "role": "user", "content": [{"type": "text","text": IMAGE_PLACEHOLDER}]})
-        self.messages.append({ "role": "user", "content": [{"type": "image_url","image_url": {"url": encode_image_url(pixels)}}]})
+        self.messages.append({ "role": "user", "content": [{"type": "image_url","image_url": {"url": self.frame_url(current_step.curr_env_state)}}]})
 
         messages = remove_img_placeholder(self.messages, num_latest_screenshot=self.num_latest_screenshot)
 
@@ -0,0 +1,271 @@
+import re
+import time
+import base64
+import shlex
+import asyncio
+import logging
+from typing import List, Optional, Tuple, Union
+
+from adbutils import AdbError
+
+from .scheme import Action, EnvState
+from .device_clock import DeviceClock
+from .capture import _FOCUS_PROBE, _STATE_MARKER, parse_focused_package, decode_raw_screencap
+from .environ import ADB_KEYBOARD_IME, _IME_NEUTRAL_ACTIONS
+from .adb_utils import LAUNCHER_QUERY, build_installed_app_index, get_adb_activity, get_launch_command
+from mobile_use.utils import contains_chinese
+
+logger = logging.getLogger(__name__)
+
+_RESUMED_ACTIVITY_RE = re.compile(r"(?:mResumedActivity|topResumedActivity)[:=].*?ActivityRecord\{\w+ \w+ (?P<package>[^\s/]+)/")
+_WM_SIZE_RE = re.compile(r"(?:Physical|Override) size: (\d+)x(\d+)")
+
+
+class AsyncAdbDevice:
+    """A minimal asyncio client of the ADB server, bound to one device.
+
+    Every command opens its own connection to the ADB server, so commands of
+    many devices can be in flight on a single event loop.
+    """
+
+    def __init__(self, serial: str=None, host: str="127.0.0.1", port: int=5037, timeout: float=10.0):
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    @staticmethod
+    async def _request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, service: str):
+        payload = service.encode('utf-8')
+        writer.write(b"%04x" % len(payload) + payload)
+        await writer.drain()
+        status = await reader.readexactly(4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            length = int(await reader.readexactly(4), 16)
+            message = await reader.readexactly(length)
+            raise AdbError(message.decode('utf-8', errors='replace'))
+        raise AdbError(f"Unexpected response from the adb server: {status!r}")
+
+    async def _run(self, service: str) -> bytes:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            transport = f"host:transport:{self.serial}" if self.serial else "host:transport-any"
+            await self._request(reader, writer, transport)
+            await self._request(reader, writer, service)
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def exec_out(self, cmd: str) -> bytes:
+        """Run `cmd` without a pty and return its raw output."""
+        return await asyncio.wait_for(self._run("exec:" + cmd), self.timeout)
+
+    async def shell(self, cmd: Union[str, List[str]]) -> str:
+        """Run a shell command, list arguments are quoted like `adbutils` does."""
+        if isinstance(cmd, (list, tuple)):
+            cmd = ' '.join(map(shlex.quote, cmd))
+        output = await asyncio.wait_for(self._run("shell:" + cmd), self.timeout)
+        return output.decode('utf-8', errors='replace').rstrip()
+
+    async def keyevent(self, key: str):
+        await self.shell(["input", "keyevent", key])
+
+    async def window_size(self) -> Tuple[int, int]:
+        """Return the portrait (width, height) of the screen, like `AdbDevice.window_size(landscape=False)`."""
+        sizes = _WM_SIZE_RE.findall(await self.shell("wm size"))
+        if not sizes:
+            raise AdbError("Failed to get the window size.")
+        w, h = map(int, sizes[-1])
+        return min(w, h), max(w, h)
+
+
+class AsyncAdbKeyboardSession:
+    """The asyncio counterpart of `AdbKeyboardSession`."""
+
+    def __init__(self, device: AsyncAdbDevice):
+        self._d = device
+        self._original = None
+        self.active = False
+
+    async def activate(self) -> bool:
+        if self.active:
+            return False
+        self._original = (await self._d.shell(["settings", "get", "secure", "default_input_method"])).strip()
+        self.active = True
+        if self._original == ADB_KEYBOARD_IME:
+            return False
+        await self._d.shell(f"ime enable {ADB_KEYBOARD_IME}; ime set {ADB_KEYBOARD_IME}")
+        return True
+
+    async def restore(self):
+        if not self.active:
+            return
+        self.active = False
+        if self._original == ADB_KEYBOARD_IME:
+            return
+        cmd = f"ime disable {ADB_KEYBOARD_IME}"
+        if self._original and self._original != 'null':
+            cmd = f"ime set {self._original}; {cmd}"
+        await self._d.shell(cmd)
+
+
+class AsyncEnvironment:
+    """An `Environment` whose device I/O runs on an asyncio event loop.
+
+    It talks to the ADB server over non-blocking sockets, so a single event
+    loop can drive many devices alongside async VLM calls. Screenshots are
+    taken with the fused raw state query of the 'raw' capture backend.
+    The screen settles with a fixed `wait_after_action_seconds` wait.
+
+    Use `AsyncEnvironment.create(...)` to build and initialize one.
+    """
+
+    def __init__(
+            self,
+            serial_no: str=None,
+            host: str="127.0.0.1",
+            port: int=5037,
+            wait_after_action_seconds: float=2.0,
+            timeout: float=10.0,
+            clock_refresh_seconds: float=300.0,
+        ):
+        self.port = port
+        self.wait_after_action_seconds = wait_after_action_seconds
+        self._d = AsyncAdbDevice(serial_no, host=host, port=port, timeout=timeout)
+        self._ime = AsyncAdbKeyboardSession(self._d)
+        self._clock = DeviceClock(refresh_seconds=clock_refresh_seconds)
+        self._installed_apps = None
+        self.window_size = None
+
+    @classmethod
+    async def create(cls, *args, go_home: bool=True, **kwargs) -> 'AsyncEnvironment':
+        env = cls(*args, **kwargs)
+        env.window_size = await env._d.window_size()
+        await env.reset(go_home=go_home)
+        return env
+
+    async def reset(self, go_home: bool=True):
+        await self._ime.restore()
+        if go_home:
+            await self._d.keyevent("HOME")
+
+    async def close(self):
+        await self._ime.restore()
+
+    async def get_state(self) -> EnvState:
+        cmd = f"{_FOCUS_PROBE}; echo {_STATE_MARKER.decode().strip()}; screencap"
+        try:
+            data = await self._d.exec_out(cmd)
+            idx = data.find(_STATE_MARKER)
+            if idx < 0:
+                raise ValueError("Unexpected output of the state query.")
+            # Decoding a full frame takes a few milliseconds, keep it off the event loop.
+            pixels = await asyncio.to_thread(decode_raw_screencap, memoryview(data)[idx + len(_STATE_MARKER):])
+        except Exception as e:
+            logger.error(f"Failed to get screenshot: {e}.")
+            raise(e)
+        package = parse_focused_package(data[:idx].decode('utf-8', errors='ignore'))
+        if package is None:
+            package = await self._resumed_package()
+        return EnvState(pixels=pixels, package=package)
+
+    async def _resumed_package(self) -> Optional[str]:
+        output = await self._d.shell("dumpsys activity activities | grep -E 'mResumedActivity|topResumedActivity'")
+        m = _RESUMED_ACTIVITY_RE.search(output)
+        return m.group('package') if m else None
+
+    def invalidate_clock(self):
+        self._clock.invalidate()
+
+    async def get_time(self) -> str:
+        if self._clock.needs_refresh():
+            sent_at = time.time()
+            output = await self._d.shell(DeviceClock.PROBE)
+            try:
+                self._clock.update(output, sent_at, time.time())
+            except ValueError as e:
+                logger.warning(f"Failed to sample the device clock: {e}.")
+                return await self._d.shell('date')
+        return self._clock.format()
+
+    async def _swipe(self, x1, y1, x2, y2, duration: float):
+        await self._d.shell(["input", "swipe", str(x1), str(y1), str(x2), str(y2), str(int(duration * 1000))])
+
+    async def execute_action(self, action: Action):
+        if action.name not in _IME_NEUTRAL_ACTIONS:
+            await self._ime.restore()
+        answer = None
+        if action.name == 'open_app':
+            package_name = action.parameters['package_name']
+            await self._d.shell(['monkey', '-p', package_name, '-c', 'android.intent.category.LAUNCHER', '1'])
+        elif action.name == 'open':
+            text = action.parameters['text']
+            if self._installed_apps is None and get_adb_activity(text) is None:
+                self._installed_apps = build_installed_app_index(await self._d.shell(LAUNCHER_QUERY))
+            await self._d.shell(get_launch_command(text, self._installed_apps))
+        elif action.name in ('click', 'left_click', 'long_press'):
+            if 'coordinate' in action.parameters:       # QwenAgent
+                x, y = action.parameters['coordinate']
+            elif 'start_box' in action.parameters:
+                x, y = action.parameters['start_box']
+            else:
+                x, y = action.parameters['point']
+            if action.name == 'long_press':
+                await self._swipe(x, y, x, y, duration=action.parameters.get('time', 2.0))
+            else:
+                await self._d.shell(["input", "tap", str(x), str(y)])
+        elif action.name == 'type':
+            if 'content' in action.parameters:
+                text = action.parameters['content']
+            else:
+                text = action.parameters['text']
+            if contains_chinese(text):
+                charsb64 = base64.b64encode(text.encode('utf-8')).decode('ascii')
+                await self._ime.activate()
+                await self._d.shell(["am", "broadcast", "-a", "ADB_INPUT_B64", "--es", "msg", charsb64])
+            else:
+                await self._d.shell(["input", "text", text])
+        elif action.name == 'key':
+            await self._d.keyevent(action.parameters['text'])
+        elif action.name == 'scroll':
+            if 'start_box' in action.parameters:
+                x1, y1 = action.parameters['start_box']
+                x2, y2 = action.parameters['end_box']
+            else:
+                x1, y1 = action.parameters['start_point']
+                x2, y2 = action.parameters['end_point']
+            await self._swipe(x1, y1, x2, y2, duration=0.5)
+        elif action.name == 'swipe':       # QwenAgent
+            x1, y1 = action.parameters['coordinate']
+            x2, y2 = action.parameters['coordinate2']
+            await self._swipe(x1, y1, x2, y2, duration=0.5)
+        elif action.name == 'press_home':
+            await self._d.keyevent("HOME")
+        elif action.name == 'press_back':
+            await self._d.keyevent("BACK")
+        elif action.name == 'wait':
+            duration = action.parameters.get('time', 5.0)
+            await asyncio.sleep(duration)
+        elif action.name == 'answer':
+            answer = action.parameters['text']
+            await self._d.shell(["am", "broadcast", "com.example.ACTION_UPDATE_OVERLAY", "--es", "task_type_string", "Agent answered:", "--es", "goal_string", answer])
+        elif action.name == 'system_button':
+            button = action.parameters['button']
+            key = {'Back': "BACK", 'Home': "HOME", 'Menu': "MENU", 'Enter': "ENTER"}.get(button)
+            if key is not None:
+                await self._d.keyevent(key)
+        elif action.name == 'clear_text':
+            if await self._ime.activate():
+                # Give the keyboard time to bind to the focused field.
+                await asyncio.sleep(1)
+            await self._d.shell(["am", "broadcast", "-a", "ADB_CLEAR_TEXT"])
+            await self._d.shell(["input", "text", " "])
+        elif action.name == 'take_note':
+            note = action.parameters['text']
+            return note
+        else:
+            raise ValueError(f"Unknown action: {action.name}")
+        await asyncio.sleep(self.wait_after_action_seconds)
+        return answer
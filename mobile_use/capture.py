@@ -0,0 +1,295 @@
+import io
+import re
+import time
+import struct
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+from PIL import Image
+from pyregister import Registrable
+from adbutils import AdbDevice
+
+logger = logging.getLogger(__name__)
+
+
+# screencap raw output: width, height, format (+ dataspace since Android 9), then pixels.
+# Maps the android PixelFormat to (bytes per pixel, PIL raw mode).
+_RAW_PIXEL_FORMATS = {
+    1: (4, 'RGBX'),     # RGBA_8888, alpha is dropped
+    2: (4, 'RGBX'),     # RGBX_8888
+    3: (3, 'RGB'),      # RGB_888
+    4: (2, 'BGR;16'),   # RGB_565
+    5: (4, 'BGRX'),     # BGRA_8888
+}
+
+
+def parse_raw_header(data: bytes, size: int = None) -> Tuple[int, int, int, int]:
+    """Parse the header of a raw `screencap` frame.
+
+    Args:
+        data: The raw frame, or at least its first 12 bytes.
+        size: The total size of the frame, used to tell the 12-byte header of
+            old devices from the 16-byte header with dataspace. Defaults to `len(data)`.
+
+    Returns:
+        (width, height, pixel format, header size)
+    """
+    width, height, fmt = struct.unpack_from('<III', data, 0)
+    if fmt not in _RAW_PIXEL_FORMATS:
+        raise NotImplementedError(f"Unsupported screencap pixel format: {fmt}")
+    bpp, _ = _RAW_PIXEL_FORMATS[fmt]
+    size = len(data) if size is None else size
+    header_size = size - width * height * bpp
+    if header_size not in (12, 16):
+        raise ValueError(f"Unexpected screencap output size {size} for {width}x{height}")
+    return width, height, fmt, header_size
+
+
+def decode_raw_screencap(data: bytes, header_size: int = None) -> Image.Image:
+    """Decode the output of `screencap` without `-p` into a RGB image.
+
+    The pixel payload is handed to PIL as a view of `data`, so the only copy
+    is the unpacking into the image itself.
+    """
+    if header_size is None:
+        width, height, fmt, header_size = parse_raw_header(data)
+    else:
+        width, height, fmt = struct.unpack_from('<III', data, 0)
+    _, raw_mode = _RAW_PIXEL_FORMATS[fmt]
+    return Image.frombytes('RGB', (width, height), memoryview(data)[header_size:], 'raw', raw_mode)
+
+
+# Prints the focused window and the focused activity, much cheaper to ship than `dumpsys window windows`.
+_FOCUS_PROBE = "dumpsys window | grep -E 'mCurrentFocus|mFocusedApp'"
+_STATE_MARKER = b"--mobile-use-frame--\n"
+_FOCUS_PATTERNS = [
+    re.compile(r"mCurrentFocus=Window\{.*\s+(?P<package>[^\s/]+)/[^\s]+\}"),
+    re.compile(r"mFocusedApp=.*ActivityRecord\{\w+ \w+ (?P<package>[^\s/]+)/"),
+]
+
+
+def parse_focused_package(output: str) -> Optional[str]:
+    """Extract the foreground package from the output of `_FOCUS_PROBE`.
+
+    Falls back to the focused activity when the focused window is not an app
+    window (e.g. the notification shade). Returns None if neither is found.
+    """
+    for pattern in _FOCUS_PATTERNS:
+        m = pattern.search(output)
+        if m:
+            return m.group('package')
+    return None
+
+
+def _raw_screencap_command(device: AdbDevice, display_id: Optional[int]) -> str:
+    """Build the raw `screencap` command, mapping the display index to the physical display id."""
+    if display_id is None:
+        return "screencap"
+    output = device.shell("dumpsys SurfaceFlinger --display-id")
+    ids = re.findall(r"Display (\d+) ", output)
+    if not ids:
+        return "screencap"
+    return f"screencap -d {ids[display_id]}"
+
+
+def _open_exec(device: AdbDevice, cmd: str):
+    """Open an `exec:` connection, which carries binary output without pty mangling."""
+    c = device.open_transport()
+    c.send_command("exec:" + cmd)
+    c.check_okay()
+    return c
+
+
+class ScreenCapture(ABC, Registrable):
+    """Grab frames from the device screen.
+
+    Backends are registered by name and selected through
+    `Environment(capture_backend=...)`.
+    """
+
+    def __init__(self, device: AdbDevice, display_id: Optional[int] = -1):
+        self._d = device
+        self.display_id = display_id
+        self._screencap_cmd = None
+
+    @property
+    def screencap_cmd(self) -> str:
+        """The raw `screencap` command for the selected display."""
+        if self._screencap_cmd is None:
+            self._screencap_cmd = _raw_screencap_command(self._d, self.display_id)
+        return self._screencap_cmd
+
+    @abstractmethod
+    def capture(self) -> Image.Image:
+        """Return the current screen as a RGB image."""
+
+    def capture_state(self) -> Tuple[Image.Image, Optional[str]]:
+        """Return the current screen and the foreground package.
+
+        The package is None when the backend cannot tell it, the caller then
+        has to query it separately.
+        """
+        return self.capture(), None
+
+    def _capture_with_focus(self, screencap_cmd: str, decode) -> Tuple[Image.Image, Optional[str]]:
+        """Run the focus probe and `screencap_cmd` in a single exec and split the output."""
+        cmd = f"{_FOCUS_PROBE}; echo {_STATE_MARKER.decode().strip()}; {screencap_cmd}"
+        with _open_exec(self._d, cmd) as c:
+            data = c.read_until_close(encoding=None)
+        idx = data.find(_STATE_MARKER)
+        if idx < 0:
+            raise ValueError("Unexpected output of the state query.")
+        package = parse_focused_package(data[:idx].decode('utf-8', errors='ignore'))
+        return decode(memoryview(data)[idx + len(_STATE_MARKER):]), package
+
+    def signature(self) -> str:
+        """Return a cheap digest of the current screen.
+
+        The frame is hashed on the device, only the digest is transferred.
+        Used to detect when the screen stops changing after an action.
+        """
+        return self._d.shell(f"{self.screencap_cmd} | md5sum")
+
+    def invalidate(self):
+        """Called after the screen is changed by an action."""
+
+    def close(self):
+        pass
+
+
+@ScreenCapture.register('screencap')
+class ScreencapCapture(ScreenCapture):
+    """One `screencap -p` round trip per frame. This is the default backend."""
+
+    def capture(self) -> Image.Image:
+        # 多个屏幕需要指定ID
+        return self._d.screenshot(display_id=self.display_id, error_ok=False)
+
+    def capture_state(self) -> Tuple[Image.Image, Optional[str]]:
+        return self._capture_with_focus(
+            f"{self.screencap_cmd} -p",
+            lambda data: Image.open(io.BytesIO(data)).convert('RGB'),
+        )
+
+
+@ScreenCapture.register('raw')
+class RawScreencapCapture(ScreenCapture):
+    """One raw `screencap` round trip per frame.
+
+    Skips the PNG encode on the device and the PNG decode on the host, which
+    dominate `screencap -p` on emulators, at the cost of a larger transfer.
+    """
+
+    def capture(self) -> Image.Image:
+        with _open_exec(self._d, self.screencap_cmd) as c:
+            data = c.read_until_close(encoding=None)
+        return decode_raw_screencap(data)
+
+    def capture_state(self) -> Tuple[Image.Image, Optional[str]]:
+        return self._capture_with_focus(self.screencap_cmd, decode_raw_screencap)
+
+
+@ScreenCapture.register('stream')
+class StreamCapture(ScreenCapture):
+    """Keep one device-side capture loop open and decode frames in a background thread.
+
+    The device runs raw `screencap` (no PNG encoding) in a shell loop over a single
+    long-lived connection. The reader thread keeps only the latest frame, so
+    `capture` returns in a few milliseconds instead of a full round trip.
+
+    Args:
+        display_id: The display index, same as `ScreencapCapture`.
+        interval: Seconds to sleep on the device between two frames.
+        max_frame_age: Frames older than this are not served, `capture` waits for a new one.
+        timeout: Seconds to wait for a frame before giving up.
+    """
+
+    def __init__(
+            self,
+            device: AdbDevice,
+            display_id: Optional[int] = -1,
+            interval: float = 0.0,
+            max_frame_age: float = 1.0,
+            timeout: float = 10.0,
+        ):
+        super().__init__(device, display_id)
+        self.interval = interval
+        self.max_frame_age = max_frame_age
+        self.timeout = timeout
+
+        self._header_size, self._frame_size = self._probe()
+
+        self._frame: Optional[Image.Image] = None
+        self._frame_time = 0.0
+        self._seq = 0
+        self._min_seq = 0
+        self._error: Optional[Exception] = None
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._conn = None
+        self._thread = threading.Thread(target=self._run, name=f"StreamCapture-{device.serial}", daemon=True)
+        self._thread.start()
+
+    def _probe(self) -> Tuple[int, int]:
+        """Take one raw frame to learn the header and frame layout of this device."""
+        with _open_exec(self._d, self.screencap_cmd) as c:
+            data = c.read_until_close(encoding=None)
+        _, _, _, header_size = parse_raw_header(data)
+        return header_size, len(data)
+
+    def _run(self):
+        loop = f"while true; do {self.screencap_cmd}; sleep {self.interval}; done"
+        try:
+            self._conn = _open_exec(self._d, loop)
+            self._conn.conn.settimeout(self.timeout)
+            while not self._stopped.is_set():
+                data = self._conn.read_exact(self._frame_size)
+                frame = decode_raw_screencap(data, self._header_size)
+                with self._cond:
+                    self._frame = frame
+                    self._frame_time = time.time()
+                    self._seq += 1
+                    self._cond.notify_all()
+        except Exception as e:
+            if not self._stopped.is_set():
+                logger.error(f"Screen stream stopped: {e}.")
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+
+    def capture(self) -> Image.Image:
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while (
+                self._frame is None
+                or self._seq < self._min_seq
+                or time.time() - self._frame_time > self.max_frame_age
+            ):
+                if self._error is not None:
+                    raise self._error
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("No frame received from the screen stream.")
+                self._cond.wait(remaining)
+            return self._frame
+
+    def signature(self) -> str:
+        # Hash a downscaled copy of a frame newer than the previous sample.
+        frame = self.capture()
+        with self._cond:
+            self._min_seq = self._seq + 1
+        return hashlib.md5(frame.reduce(8).tobytes()).hexdigest()
+
+    def invalidate(self):
+        # The frame in flight may have been taken before the action, skip it.
+        with self._cond:
+            self._min_seq = self._seq + 2
+
+    def close(self):
+        self._stopped.set()
+        if self._conn is not None:
+            self._conn.close()
+        self._thread.join(timeout=1.0)
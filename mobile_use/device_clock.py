@@ -0,0 +1,72 @@
+import re
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceClock:
+    """Track the device clock from the host clock.
+
+    The device is sampled once with `PROBE` to learn its offset to the host clock
+    and its timezone; the device time is then computed locally, without a round
+    trip. The owner samples the device again when `needs_refresh` is True.
+
+    Args:
+        refresh_seconds: Sample the device again after this many seconds.
+            None samples it only once, until `invalidate` is called.
+    """
+
+    # Seconds since the epoch, UTC offset and timezone abbreviation.
+    PROBE = "date +%s%n%z%n%Z"
+
+    def __init__(self, refresh_seconds: float=300.0):
+        self.refresh_seconds = refresh_seconds
+        self._offset = None
+        self._tz = None
+        self._sampled_at = None
+
+    def needs_refresh(self) -> bool:
+        if self._sampled_at is None:
+            return True
+        if self.refresh_seconds is None:
+            return False
+        return time.time() - self._sampled_at >= self.refresh_seconds
+
+    def invalidate(self):
+        """Sample the device again on the next read, e.g. after its time was changed."""
+        self._sampled_at = None
+
+    def update(self, output: str, sent_at: float, received_at: float):
+        """Update the clock from the output of `PROBE`.
+
+        Args:
+            output: The output of `PROBE` on the device.
+            sent_at, received_at: Host time around the probe, the device is assumed
+                to have answered halfway.
+        """
+        lines = output.strip().splitlines()
+        if len(lines) < 2 or not lines[0].strip().isdigit():
+            raise ValueError(f"Unexpected output of the device clock probe: {output!r}")
+        m = re.fullmatch(r"([+-])(\d{2}):?(\d{2})", lines[1].strip())
+        if not m:
+            raise ValueError(f"Unexpected timezone offset: {lines[1]!r}")
+        sign = -1 if m.group(1) == '-' else 1
+        utc_offset = timedelta(hours=int(m.group(2)), minutes=int(m.group(3))) * sign
+        tz_name = lines[2].strip() if len(lines) > 2 else ''
+        self._tz = timezone(utc_offset, tz_name) if tz_name else timezone(utc_offset)
+        # `date` truncates to the second, so it is on average half a second behind.
+        self._offset = int(lines[0]) + 0.5 - (sent_at + received_at) / 2
+        self._sampled_at = received_at
+
+    def now(self) -> datetime:
+        """The current device time."""
+        if self._sampled_at is None:
+            raise RuntimeError("The device clock has not been sampled.")
+        return datetime.fromtimestamp(time.time() + self._offset, self._tz)
+
+    def format(self) -> str:
+        """The current device time in the default format of `date`, e.g. `Sat Oct 18 09:05:31 CST 2026`."""
+        d = self.now()
+        return f"{d:%a %b} {d.day:2d} {d:%H:%M:%S} {d.tzname()} {d.year}"
@@ -0,0 +1,195 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import adbutils
+
+from .environ import Environment
+
+logger = logging.getLogger(__name__)
+
+# (host, port, serial)
+DeviceKey = Tuple[str, int, str]
+
+
+class DevicePool:
+    """Lease `Environment`s on the devices of one or more ADB servers.
+
+    Each device is leased to at most one episode at a time. The `Environment` of
+    a device is created on its first lease and reused by the following ones; it
+    is reset to the home screen whenever it is returned to the pool.
+
+    Example:
+        pool = DevicePool(servers=[("127.0.0.1", 5037), ("10.0.0.2", 5037)])
+        with pool.lease() as env:
+            agent = Agent.from_params(dict(type='MultiAgent', env=env, vlm=vlm))
+            agent.run(goal)
+
+    Args:
+        servers: (host, port) of the ADB servers to discover devices from.
+        serials: Only use these devices. Defaults to every device in the `device` state.
+        env_kwargs: Extra arguments of `Environment`, e.g. `capture_backend`.
+        environment_cls: The environment class to build for each device.
+        health_check: Run a trivial shell command on a device before adding it to the pool.
+    """
+
+    def __init__(
+            self,
+            servers: Sequence[Tuple[str, int]]=(("127.0.0.1", 5037),),
+            serials: Sequence[str]=None,
+            env_kwargs: Dict[str, Any]=None,
+            environment_cls: type=Environment,
+            health_check: bool=True,
+        ):
+        self.servers = list(servers)
+        self.serials = None if serials is None else set(serials)
+        self.env_kwargs = env_kwargs or {}
+        self.environment_cls = environment_cls
+        self.health_check = health_check
+
+        self._cond = threading.Condition()
+        self._idle: List[DeviceKey] = []
+        self._leased: set = set()
+        self._envs: Dict[DeviceKey, Environment] = {}
+        self._closed = False
+        self.refresh()
+
+    def discover(self) -> List[DeviceKey]:
+        """List the online devices of all ADB servers."""
+        devices = []
+        for host, port in self.servers:
+            try:
+                infos = adbutils.AdbClient(host=host, port=port).list()
+            except Exception as e:
+                logger.warning(f"Failed to list devices of the adb server {host}:{port}: {e}.")
+                continue
+            for info in infos:
+                if info.state != 'device':
+                    continue
+                if self.serials is not None and info.serial not in self.serials:
+                    continue
+                devices.append((host, port, info.serial))
+        return devices
+
+    def check_health(self, key: DeviceKey) -> bool:
+        """Return True if the device answers a shell command."""
+        host, port, serial = key
+        try:
+            device = adbutils.AdbClient(host=host, port=port).device(serial)
+            return device.shell("echo ok", timeout=10).strip() == "ok"
+        except Exception as e:
+            logger.warning(f"Device {serial}@{host}:{port} failed the health check: {e}.")
+            return False
+
+    def refresh(self) -> int:
+        """Add newly discovered healthy devices to the pool. Returns the number of added devices."""
+        with self._cond:
+            known = set(self._idle) | self._leased
+        added = []
+        for key in self.discover():
+            if key in known:
+                continue
+            if self.health_check and not self.check_health(key):
+                continue
+            added.append(key)
+        with self._cond:
+            self._idle.extend(added)
+            self._cond.notify_all()
+        if added:
+            logger.info(f"Added {len(added)} devices to the pool: {[k[2] for k in added]}.")
+        return len(added)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._idle) + len(self._leased)
+
+    @property
+    def available(self) -> int:
+        """Number of devices that can be leased right now."""
+        with self._cond:
+            return len(self._idle)
+
+    def _acquire(self, timeout: Optional[float]) -> DeviceKey:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._idle:
+                if self._closed:
+                    raise RuntimeError("The device pool is closed.")
+                if not self._leased:
+                    raise RuntimeError("The device pool has no healthy device.")
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No device became available in time.")
+                self._cond.wait(remaining)
+            key = self._idle.pop(0)
+            self._leased.add(key)
+            return key
+
+    def _drop(self, key: DeviceKey):
+        with self._cond:
+            env = self._envs.pop(key, None)
+        if env is not None:
+            try:
+                env.close()
+            except Exception:
+                pass
+        with self._cond:
+            self._leased.discard(key)
+            self._cond.notify_all()
+
+    def _release(self, key: DeviceKey):
+        with self._cond:
+            env = self._envs[key]
+        try:
+            # Also drops the cached state of the environment.
+            env.reset(go_home=True)
+        except Exception as e:
+            logger.error(f"Failed to reset the device {key[2]}, removing it from the pool: {e}.")
+            self._drop(key)
+            return
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                self._leased.discard(key)
+                self._idle.append(key)
+                self._cond.notify_all()
+        if closed:
+            self._drop(key)
+
+    @contextmanager
+    def lease(self, timeout: float=None) -> Iterator[Environment]:
+        """Lease the environment of an idle device, waiting up to `timeout` seconds for one.
+
+        The device returns to the pool after `reset(go_home=True)` when the
+        context exits. A device that cannot be connected or reset is removed.
+        """
+        key = self._acquire(timeout)
+        with self._cond:
+            env = self._envs.get(key)
+        if env is None:
+            # Only the lessee of the device creates its environment, outside the lock.
+            host, port, serial = key
+            try:
+                env = self.environment_cls(serial_no=serial, host=host, port=port, **self.env_kwargs)
+            except Exception as e:
+                logger.error(f"Failed to create the environment of {serial}, removing it from the pool: {e}.")
+                self._drop(key)
+                raise e
+            with self._cond:
+                self._envs[key] = env
+        try:
+            yield env
+        finally:
+            self._release(key)
+
+    def close(self):
+        """Close the environments of all idle devices. Leased ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            self._idle = []
+            unleased = [key for key in self._envs if key not in self._leased]
+            self._cond.notify_all()
+        for key in unleased:
+            self._drop(key)
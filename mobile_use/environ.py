@@ -1,16 +1,63 @@
-import os
 import base64
 import time
 import logging
 import adbutils
+from typing import Any, Dict
 from .scheme import Action, EnvState
+from .capture import ScreenCapture
+from .device_clock import DeviceClock
 from mobile_use.utils import contains_chinese
 from .adb_utils import launch_app
 
 logger = logging.getLogger(__name__)
 
+ADB_KEYBOARD_IME = 'com.android.adbkeyboard/.AdbIME'
+
+# Actions that do not need the original IME back.
+_IME_NEUTRAL_ACTIONS = ('type', 'clear_text', 'wait', 'take_note')
+
+
+class AdbKeyboardSession:
+    """Keep the ADB keyboard selected across consecutive text actions.
+
+    The IME is switched once for a run of text actions, and the original IME
+    is restored lazily, before the next action that needs it.
+    """
+
+    def __init__(self, device: adbutils.AdbDevice):
+        self._d = device
+        self._original = None
+        self.active = False
+
+    def activate(self) -> bool:
+        """Select the ADB keyboard. Returns True if the IME was actually switched."""
+        if self.active:
+            return False
+        self._original = self._d.shell(["settings", "get", "secure", "default_input_method"]).strip()
+        self.active = True
+        if self._original == ADB_KEYBOARD_IME:
+            return False
+        re = self._d.shell(f"ime enable {ADB_KEYBOARD_IME}; ime set {ADB_KEYBOARD_IME}")
+        logger.info(re)
+        return True
+
+    def restore(self):
+        """Restore the IME selected before `activate`."""
+        if not self.active:
+            return
+        self.active = False
+        if self._original == ADB_KEYBOARD_IME:
+            return
+        cmd = f"ime disable {ADB_KEYBOARD_IME}"
+        if self._original and self._original != 'null':
+            cmd = f"ime set {self._original}; {cmd}"
+        re = self._d.shell(cmd)
+        logger.info(re)
+
 
 class Environment:
+    # Seconds spent waiting for the screen after the latest action.
+    last_settle_duration: float = None
 
     def __init__(
             self,
@@ -18,13 +65,61 @@ class Environment:
             host: str="127.0.0.1",
             port: int=5037,
             go_home: bool = True,
-            wait_after_action_seconds: float=2.0
+            wait_after_action_seconds: float=2.0,
+            capture_backend: str='screencap',
+            capture_kwargs: Dict[str, Any]=None,
+            state_cache_seconds: float=0.0,
+            settle_mode: str='fixed',
+            settle_min_seconds: float=0.3,
+            settle_max_seconds: float=None,
+            settle_stable_samples: int=2,
+            settle_interval_seconds: float=0.2,
+            clock_refresh_seconds: float=300.0,
         ):
+        """
+        Args:
+            capture_backend: The name of a registered `ScreenCapture` backend.
+                'screencap' takes one PNG screenshot per call, 'raw' takes one
+                unencoded screenshot per call, 'stream' keeps a long-lived raw
+                frame stream open and serves the latest frame.
+            capture_kwargs: Extra arguments of the capture backend.
+            state_cache_seconds: `get_state` returns the last captured state if it
+                is younger than this and no action has been executed since. The
+                post-action capture is then reused as the next step's state.
+                0 disables the cache.
+            settle_mode: How to wait for the screen after an action. 'fixed' sleeps
+                `wait_after_action_seconds`. 'adaptive' samples a screen signature
+                and returns as soon as `settle_stable_samples` consecutive samples
+                are identical, after at least `settle_min_seconds` and at most
+                `settle_max_seconds` (defaults to `wait_after_action_seconds`).
+            settle_interval_seconds: Seconds between two adaptive samples.
+            clock_refresh_seconds: `get_time` computes the device time from the host
+                clock and only queries the device again after this many seconds.
+                None queries it once, until `invalidate_clock` is called.
+        """
+        # Checked before connecting, an invalid setting must not touch the device.
+        if settle_mode not in ('fixed', 'adaptive'):
+            raise ValueError(f"Unknown settle mode: {settle_mode}")
+        if settle_stable_samples < 1:
+            raise ValueError(f"settle_stable_samples must be at least 1, got {settle_stable_samples}")
+        if settle_interval_seconds <= 0:
+            raise ValueError(f"settle_interval_seconds must be positive, got {settle_interval_seconds}")
         self.port = port
+        self.state_cache_seconds = state_cache_seconds
+        self._cached_state = None
+        self._cached_state_time = 0.0
+        self._clock = DeviceClock(refresh_seconds=clock_refresh_seconds)
         self._d = self._setup_device(serial_no, host, port)
+        self._capture = ScreenCapture.by_name(capture_backend)(self._d, **(capture_kwargs or {}))
+        self._ime = AdbKeyboardSession(self._d)
         self.reset(go_home=go_home)
         self.window_size = self._d.window_size(landscape=False)
         self.wait_after_action_seconds = wait_after_action_seconds
+        self.settle_mode = settle_mode
+        self.settle_min_seconds = settle_min_seconds
+        self.settle_max_seconds = wait_after_action_seconds if settle_max_seconds is None else settle_max_seconds
+        self.settle_stable_samples = settle_stable_samples
+        self.settle_interval_seconds = settle_interval_seconds
 
     def _setup_device(self, serial_no: str, host: str, port: int):
         try:
@@ -36,29 +131,79 @@ class Environment:
         return device
 
     def close(self):
+        self._ime.restore()
+        self._capture.close()
         self._d.close()
 
     def reset(self, go_home: bool = True):
+        self._ime.restore()
         if go_home:
+            self.invalidate_state()
             self._d.keyevent("HOME")
 
+    def invalidate_state(self):
+        """Drop the cached state, the next `get_state` captures the screen again."""
+        self._cached_state = None
+
     def get_state(self):
+        if self._cached_state is not None and time.time() - self._cached_state_time < self.state_cache_seconds:
+            return self._cached_state
         try:
-            # 多个屏幕需要指定ID
-            pixels = self._d.screenshot(display_id=-1, error_ok=False)
+            pixels, package = self._capture.capture_state()
         except Exception as e:
             logger.error(f"Failed to get screenshot: {e}.")
             raise(e)
-        package = self._d.app_current().package
+        if package is None:
+            package = self._d.app_current().package
         state = EnvState(pixels=pixels, package=package)
+        if self.state_cache_seconds > 0:
+            self._cached_state = state
+            self._cached_state_time = time.time()
         return state
     
+    def _wait_for_settle(self) -> float:
+        """Wait for the screen to settle after an action and return the waited seconds."""
+        start = time.time()
+        if self.settle_mode == 'fixed':
+            time.sleep(self.wait_after_action_seconds)
+            return time.time() - start
+
+        time.sleep(self.settle_min_seconds)
+        deadline = start + self.settle_max_seconds
+        last_signature, stable = None, 0
+        while True:
+            try:
+                signature = self._capture.signature()
+            except Exception as e:
+                logger.warning(f"Failed to sample the screen signature: {e}.")
+                time.sleep(max(0.0, deadline - time.time()))
+                break
+            stable = stable + 1 if signature == last_signature else 1
+            last_signature = signature
+            if stable >= self.settle_stable_samples or time.time() >= deadline:
+                break
+            time.sleep(min(self.settle_interval_seconds, max(0.0, deadline - time.time())))
+        return time.time() - start
+
+    def invalidate_clock(self):
+        """Query the device clock again on the next `get_time`, e.g. after the device time was changed."""
+        self._clock.invalidate()
+
     def get_time(self) -> str:
-        re = self._d.shell('date')
-        time.sleep(2)
-        return re
+        if self._clock.needs_refresh():
+            sent_at = time.time()
+            output = self._d.shell(DeviceClock.PROBE)
+            try:
+                self._clock.update(output, sent_at, time.time())
+            except ValueError as e:
+                logger.warning(f"Failed to sample the device clock: {e}.")
+                return self._d.shell('date')
+        return self._clock.format()
 
     def execute_action(self, action: Action):
+        self.invalidate_state()
+        if action.name not in _IME_NEUTRAL_ACTIONS:
+            self._ime.restore()
         answer = None
         if action.name == 'open_app':
             package_name = action.parameters['package_name']
@@ -91,12 +236,9 @@ class Environment:
             # self._d.send_keys(text)
             if contains_chinese(text):
                 print("TYPE: Chinese detected.")
-                charsb64 = str(base64.b64encode(text.encode('utf-8')))[1:]
-                re = self._d.shell(["ime", "enable", 'com.android.adbkeyboard/.AdbIME'])
-                print(re)
-                self._d.shell(["ime", "set", 'com.android.adbkeyboard/.AdbIME'])
-                os.system(f"adb -P {self.port} -s {self._d.get_serialno()} shell am broadcast -a ADB_INPUT_B64 --es msg %s" %charsb64)
-                self._d.shell(["ime", "disable", 'com.android.adbkeyboard/.AdbIME'])
+                charsb64 = base64.b64encode(text.encode('utf-8')).decode('ascii')
+                self._ime.activate()
+                self._d.shell(["am", "broadcast", "-a", "ADB_INPUT_B64", "--es", "msg", charsb64])
             else:
                 self._d.shell(["input", "text", text])
             # # Press Enter key
@@ -125,7 +267,7 @@ class Environment:
             time.sleep(duration)
         elif action.name == 'answer':
             answer = action.parameters['text']
-            os.system(f'adb -P {self.port} -s {self._d.get_serialno()} shell am broadcast com.example.ACTION_UPDATE_OVERLAY --es task_type_string "Agent answered:" --es goal_string "{answer}"')
+            self._d.shell(["am", "broadcast", "com.example.ACTION_UPDATE_OVERLAY", "--es", "task_type_string", "Agent answered:", "--es", "goal_string", answer])
         elif action.name == 'system_button':
             button = action.parameters['button']
             if button == 'Back':
@@ -137,20 +279,19 @@ class Environment:
             elif button == 'Enter':
                 self._d.keyevent("ENTER")
         elif action.name == 'clear_text':
-            re = self._d.shell(["ime", "enable", 'com.android.adbkeyboard/.AdbIME'])
-            logger.info(re)
-            re = self._d.shell(["ime", "set", 'com.android.adbkeyboard/.AdbIME'])
-            logger.info(re)
-            time.sleep(1)
-            os.system(f"adb -P {self.port} -s {self._d.get_serialno()} shell am broadcast -a ADB_CLEAR_TEXT")
-            re = self._d.shell(["ime", "disable", 'com.android.adbkeyboard/.AdbIME'])
+            if self._ime.activate():
+                # Give the keyboard time to bind to the focused field.
+                time.sleep(1)
+            re = self._d.shell(["am", "broadcast", "-a", "ADB_CLEAR_TEXT"])
             logger.info(re)
             re = self._d.shell(["input", "text", " "])
             logger.info(re)
         elif action.name == 'take_note':
             note = action.parameters['text']
+            self.last_settle_duration = 0.0
             return note
         else:
             raise ValueError(f"Unknown action: {action.name}")
-        time.sleep(self.wait_after_action_seconds)
+        self._capture.invalidate()
+        self.last_settle_duration = self._wait_for_settle()
         return answer
@@ -0,0 +1,332 @@
+"""A local stand-in for an OpenAI-compatible VLM server.
+
+Run the agents offline, e.g. to benchmark the framework overhead or its
+concurrency behaviour, or to replay the responses recorded in a `VLMCache`:
+
+    python -m mobile_use.mock_vlm --port 8000 --rules rules.jsonl --latency lognormal:0.0,0.3
+"""
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Tuple, Union
+
+from .vlm_cache import VLMCache
+
+logger = logging.getLogger(__name__)
+
+
+Latency = Union[float, Callable[[random.Random], float]]
+
+
+def parse_latency(spec: str) -> Latency:
+    """Parse a latency distribution: `0.5`, `uniform:a,b`, `normal:mu,sigma`, `lognormal:mu,sigma` or `exponential:mean`."""
+    if ':' not in spec:
+        return float(spec)
+    kind, args = spec.split(':', 1)
+    args = [float(a) for a in args.split(',')]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(*args)
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(*args))
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(*args)
+    if kind == 'exponential':
+        return lambda rng: rng.expovariate(1.0 / args[0])
+    raise ValueError(f"Unknown latency distribution: {kind}")
+
+
+def _tokenize(content: str) -> List[str]:
+    # A rough stand-in for the tokenizer of the model, enough for per-token logprobs.
+    return re.findall(r'\w+|\s+|[^\w\s]', content)
+
+
+def _last_user_text(messages: List[dict]) -> str:
+    for message in reversed(messages):
+        if message.get('role') != 'user':
+            continue
+        content = message.get('content')
+        if isinstance(content, str):
+            return content
+        return '\n'.join(item.get('text', '') for item in content if item.get('type') == 'text')
+    return ''
+
+
+class MockVLMServer:
+    """A threaded HTTP server speaking the chat completions protocol.
+
+    The content of a response is found in order from:
+    the `cache` of recorded responses, the first of `rules` whose pattern is
+    found in the text of the request, `responder`, and `responses` taken in
+    turn. Stop sequences are honoured and logprobs are returned on request,
+    with a logprob of 0 for every token. Streams report their usage at the end
+    with `stream_options.include_usage`, and in every chunk with the vLLM
+    `continuous_usage_stats` option.
+
+    Args:
+        responses: Contents returned in turn.
+        rules: (pattern, content) pairs, the pattern is a regex searched in the
+            system and last user message.
+        responder: Called with the request body, returns the content or None.
+        cache: Replay the responses recorded in this `VLMCache`.
+        latency: Seconds until the first token, a number or a callable sampling
+            it from a `random.Random`, see `parse_latency`.
+        chunk_latency: Seconds between two streamed chunks.
+        error_rate: The fraction of requests answered with `error_status`.
+        error_status: The HTTP status of the injected errors.
+        seed: The seed of the latency and error sampling.
+    """
+
+    def __init__(
+            self,
+            responses: Optional[List[str]]=None,
+            rules: Optional[List[Tuple[str, str]]]=None,
+            responder: Optional[Callable[[dict], Optional[str]]]=None,
+            cache: Optional[VLMCache]=None,
+            latency: Latency=0.0,
+            chunk_latency: float=0.0,
+            error_rate: float=0.0,
+            error_status: int=500,
+            seed: Optional[int]=None,
+            host: str='127.0.0.1',
+            port: int=0,
+        ):
+        self.responses = responses or ['']
+        self.rules = [(re.compile(pattern), content) for pattern, content in (rules or [])]
+        self.responder = responder
+        self.cache = cache
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.num_requests = 0
+        self.num_errors = 0
+        self.total_latency = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_response = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> 'MockVLMServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MockVLMServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample(self) -> Tuple[float, bool]:
+        with self._lock:
+            latency = self.latency(self._rng) if callable(self.latency) else self.latency
+            error = self._rng.random() < self.error_rate
+            self.total_latency += latency
+        return latency, error
+
+    def content(self, body: dict) -> str:
+        """The scripted content of a request."""
+        messages = body.get('messages', [])
+        if self.cache is not None:
+            params = {k: v for k, v in body.items() if k not in ('model', 'messages', 'stream')}
+            response = self.cache.get(self.cache.key(body.get('model'), params, messages))
+            if response is not None:
+                return response.choices[0].message.content
+        if self.rules:
+            system = _last_user_text([dict(m, role='user') for m in messages if m.get('role') == 'system'])
+            text = system + '\n' + _last_user_text(messages)
+            for pattern, content in self.rules:
+                if pattern.search(text):
+                    return content
+        if self.responder is not None:
+            content = self.responder(body)
+            if content is not None:
+                return content
+        with self._lock:
+            content = self.responses[self._next_response % len(self.responses)]
+            self._next_response += 1
+        return content
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _send_json(self, status: int, payload: dict):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip('/').endswith('/models'):
+                    self._send_json(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'owned_by': 'mobile_use'}]})
+                else:
+                    self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'not_found'}})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'not_found'}})
+                    return
+                with server._lock:
+                    server.num_requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    self._complete(body)
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def _complete(self, body: dict):
+                latency, error = server._sample()
+                time.sleep(latency)
+                if error:
+                    with server._lock:
+                        server.num_errors += 1
+                    self._send_json(server.error_status, {'error': {'message': 'Injected error', 'type': 'server_error'}})
+                    return
+
+                content, finish_reason = server.content(body), 'stop'
+                stop = body.get('stop') or []
+                for s in [stop] if isinstance(stop, str) else stop:
+                    if s in content:
+                        content = content[:content.index(s)]
+                tokens = _tokenize(content)
+                max_tokens = body.get('max_tokens')
+                if max_tokens is not None and len(tokens) > max_tokens:
+                    tokens, finish_reason = tokens[:max_tokens], 'length'
+                    content = ''.join(tokens)
+                completion = {
+                    'id': f'chatcmpl-mock-{server.num_requests}',
+                    'created': int(time.time()),
+                    'model': body.get('model', 'mock'),
+                }
+                logprobs = bool(body.get('logprobs'))
+                prompt_tokens = sum(len(_tokenize(_last_user_text([dict(m, role='user')]))) for m in body.get('messages', []))
+                usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens), 'total_tokens': prompt_tokens + len(tokens)}
+
+                if not body.get('stream'):
+                    choice = {'index': 0, 'finish_reason': finish_reason, 'message': {'role': 'assistant', 'content': content}}
+                    if logprobs:
+                        choice['logprobs'] = {'content': [_logprob(t) for t in tokens]}
+                    self._send_json(200, dict(completion, object='chat.completion', choices=[choice], usage=usage))
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                stream_options = body.get('stream_options') or {}
+                try:
+                    for i, token in enumerate(tokens):
+                        if i > 0 and server.chunk_latency:
+                            time.sleep(server.chunk_latency)
+                        choice = {'index': 0, 'delta': {'content': token}, 'finish_reason': None}
+                        if i == 0:
+                            choice['delta']['role'] = 'assistant'
+                        if logprobs:
+                            choice['logprobs'] = {'content': [_logprob(token)]}
+                        chunk = dict(completion, object='chat.completion.chunk', choices=[choice])
+                        if stream_options.get('continuous_usage_stats'):
+                            chunk['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': i + 1, 'total_tokens': prompt_tokens + i + 1}
+                        self._send_event(chunk)
+                    self._send_event(dict(completion, object='chat.completion.chunk',
+                                          choices=[{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]))
+                    if stream_options.get('include_usage'):
+                        self._send_event(dict(completion, object='chat.completion.chunk', choices=[], usage=usage))
+                    self.wfile.write(b'data: [DONE]\n\n')
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client closed the stream early, e.g. `VLMWrapper.predict_until`.
+                    pass
+
+            def _send_event(self, payload: dict):
+                self.wfile.write(b'data: ' + json.dumps(payload).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+
+        return Handler
+
+
+def _logprob(token: str) -> dict:
+    return {'token': token, 'logprob': 0.0, 'bytes': list(token.encode('utf-8')), 'top_logprobs': []}
+
+
+def load_rules(path: str) -> List[Tuple[str, str]]:
+    """Load (pattern, content) rules from a JSONL file with `match` and `content` fields."""
+    rules = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                rule = json.loads(line)
+                rules.append((rule.get('match', ''), rule['content']))
+    return rules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve scripted chat completions for offline runs of the agents.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--response', action='append', default=[], help="A content returned in turn, can be repeated.")
+    parser.add_argument('--rules', help="A JSONL file of {\"match\": regex, \"content\": str} rules.")
+    parser.add_argument('--cache-dir', help="Replay the responses recorded in this VLMCache directory.")
+    parser.add_argument('--latency', default='0', help="Seconds to the first token, or a distribution, e.g. lognormal:0,0.3")
+    parser.add_argument('--chunk-latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    server = MockVLMServer(
+        responses=args.response,
+        rules=load_rules(args.rules) if args.rules else None,
+        cache=VLMCache(args.cache_dir, mode='read_only') if args.cache_dir else None,
+        latency=parse_latency(args.latency),
+        chunk_latency=args.chunk_latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Mock VLM server listening on {server.base_url}", file=sys.stderr)
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
 from PIL import Image
 from enum import Enum
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime
 
 from .action import ACTION_SPACE
+from .utils import ImageCodec, encode_image_url, grayscale, image_digest, dhash, hamming_distance
 
 ############ Environment ############
 @dataclass(frozen=True)
@@ -18,6 +19,101 @@ class EnvState:
 
     pixels: Image.Image
     package: str
+    # Encoded data URLs and resized copies of the screenshot, see `image_url` and `resized`.
+    _image_urls: Dict[Any, str] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _resized: Dict[Tuple[int, int], Image.Image] = field(default_factory=dict, init=False, repr=False, compare=False)
+    # Downscaled grayscale levels and the hashes of the screenshot, see `gray`, `digest` and `dhash`.
+    _gray: Dict[int, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _digest: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _dhash: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def digest(self) -> str:
+        """A hash of the screenshot, computed once."""
+        if self._digest is None:
+            object.__setattr__(self, '_digest', image_digest(self.pixels))
+        return self._digest
+
+    @property
+    def dhash(self) -> int:
+        """The perceptual difference hash of the screenshot, computed once."""
+        if self._dhash is None:
+            # From the cached 4x downscaled grayscale level, which the Reflector may share.
+            object.__setattr__(self, '_dhash', dhash(Image.fromarray(self.gray(2))))
+        return self._dhash
+
+    def near_duplicate(self, other: 'EnvState', threshold: Optional[int]=None) -> bool:
+        """Whether two screenshots show the same screen.
+
+        Args:
+            other: The state to compare with.
+            threshold: None for identical pixels, otherwise the largest Hamming distance
+                between the `dhash`es, e.g. a few bits to ignore a clock or a blinking cursor.
+        """
+        if self.digest == other.digest:
+            return True
+        if threshold is None:
+            return False
+        return hamming_distance(self.dhash, other.dhash) <= threshold
+
+    def gray(self, level: int=0):
+        """The grayscale screenshot downscaled by 2**level.
+
+        Only the downscaled levels are cached, a full-resolution level would keep
+        a screen-sized array alive on every state of the trajectory.
+        """
+        array = self._gray.get(level)
+        if array is None:
+            array = grayscale(self.pixels, level)
+            if level > 0:
+                self._gray[level] = array
+        return array
+
+    def resized(self, size: Tuple[int, int]) -> Image.Image:
+        """The screenshot resized to (width, height), resized once per size."""
+        size = tuple(size)
+        if size == self.pixels.size:
+            return self.pixels
+        image = self._resized.get(size)
+        if image is None:
+            image = self.pixels.resize(size, Image.Resampling.BICUBIC)
+            self._resized[size] = image
+        return image
+
+    def image_url(self, codec: Optional[ImageCodec]=None, size: Optional[Tuple[int, int]]=None) -> str:
+        """The screenshot as a data URL, encoded once per codec and size.
+
+        Every sub-agent sending the same frame shares the encoding. The pixels
+        must not be modified in place afterwards.
+
+        Args:
+            codec: The `ImageCodec`, PNG by default.
+            size: Resize to this (width, height) first, see `resized`.
+        """
+        key = (codec, tuple(size) if size else None)
+        url = self._image_urls.get(key)
+        if url is None:
+            image = self.resized(size) if size else self.pixels
+            url = encode_image_url(image, codec=codec)
+            self._image_urls[key] = url
+        return url
+
+    def __getstate__(self):
+        # The encoded URLs, resized copies and grayscale levels are large and can
+        # be recomputed, keep them out of pickled trajectories.
+        state = dict(self.__dict__)
+        state.pop('_image_urls', None)
+        state.pop('_resized', None)
+        state.pop('_gray', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        object.__setattr__(self, '_image_urls', {})
+        object.__setattr__(self, '_resized', {})
+        object.__setattr__(self, '_gray', {})
+        self.__dict__.setdefault('_digest', None)
+        self.__dict__.setdefault('_dhash', None)
 
 
 ############ Action ############
@@ -79,6 +175,52 @@ class VLMCallingData:
     messages: List[Dict[str,Any]]
     response: str
 
+@dataclass
+class VLMCallStats:
+    """Cost and latency of one VLM call.
+
+    Attributes:
+        role: The caller, e.g. the sub-agent name.
+        prompt_tokens, completion_tokens: The usage reported by the server, if any.
+        num_images: The number of images sent.
+        request_bytes: The size of the texts and image URLs sent.
+        ttft: Seconds to the first token, only known for streamed calls.
+        latency: Seconds until the response is complete.
+        cached: Whether the response came from the `VLMCache`.
+    """
+    role: Optional[str]
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    num_images: int = 0
+    request_bytes: int = 0
+    ttft: Optional[float] = None
+    latency: float = 0.0
+    cached: bool = False
+
+
+def summarize_vlm_calls(calls: List[VLMCallStats]) -> Dict[str, Dict[str, float]]:
+    """Aggregate VLM calls by role: number of calls, tokens, images, bytes and latencies."""
+    summary = {}
+    for call in calls:
+        s = summary.setdefault(call.role, {
+            'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'images': 0,
+            'request_bytes': 0, 'latency': 0.0, 'max_latency': 0.0, 'ttft': 0.0, 'streamed_calls': 0,
+        })
+        s['calls'] += 1
+        s['prompt_tokens'] += call.prompt_tokens or 0
+        s['completion_tokens'] += call.completion_tokens or 0
+        s['images'] += call.num_images
+        s['request_bytes'] += call.request_bytes
+        s['latency'] += call.latency
+        s['max_latency'] = max(s['max_latency'], call.latency)
+        if call.ttft is not None:
+            s['ttft'] += call.ttft
+            s['streamed_calls'] += 1
+    for s in summary.values():
+        s['mean_latency'] = s['latency'] / s['calls']
+        s['mean_ttft'] = s.pop('ttft') / s['streamed_calls'] if s['streamed_calls'] else None
+    return summary
+
 @dataclass
 class StepData:
     step_idx: int
@@ -106,6 +248,11 @@ class StepData:
     action_type_logprobs: Optional[List[float]] = None
     step_duration: Optional[float] = None
     exec_duration: Optional[float] = None
+    settle_duration: Optional[float] = None     # Seconds waited for the screen to settle after the action
+    prompt_prefix_length: Optional[int] = None  # Characters of the Operator prompt shared with the previous steps
+    prompt_prefix_hash: Optional[str] = None
+    speculative_hit: Optional[bool] = None      # Whether the speculative Operator response was used
+    vlm_call_stats: Optional[List[VLMCallStats]] = None
 
 @dataclass
 class EpisodeData:
@@ -120,3 +267,11 @@ class EpisodeData:
     output_tips: Optional[str] = None
     finish_count: Optional[int] = 0
     memory: Optional[str] = ""
+    vlm_call_stats: Optional[List[VLMCallStats]] = field(default_factory=list)   # Calls outside of the steps
+
+    def vlm_call_summary(self) -> Dict[str, Dict[str, float]]:
+        """The VLM calls of the episode aggregated by role, see `summarize_vlm_calls`."""
+        calls = list(self.vlm_call_stats or [])
+        for step in self.trajectory or []:
+            calls.extend(step.vlm_call_stats or [])
+        return summarize_vlm_calls(calls)
@@ -1,25 +1,91 @@
 import logging
 import math
 import base64
+import hashlib
 from io import BytesIO
 from PIL import Image
-from typing import Tuple, Union, List
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union, List
 import numpy as np
 from skimage.metrics import structural_similarity as ssim
 
 logger = logging.getLogger(__name__)
 
 
-def encode_image_url(image: Image.Image, resize: Union[Tuple, List]=None) -> str:
+@dataclass(frozen=True)
+class ImageCodec:
+    """How screenshots are encoded into the messages.
+
+    Attributes:
+        format: 'png', 'jpeg' or 'webp'.
+        quality: The JPEG and WebP quality, 1-100.
+        subsampling: The JPEG chroma subsampling, 0 for 4:4:4, 1 for 4:2:2 and
+            2 for 4:2:0. None keeps the Pillow default.
+        lossless: Lossless WebP.
+        compress_level: The PNG compression level, 0-9; lower is faster and larger.
+    """
+
+    format: str = 'png'
+    quality: int = 85
+    subsampling: Optional[int] = None
+    lossless: bool = False
+    compress_level: int = 6
+
+    FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+
+    def __post_init__(self):
+        if self.format.lower() not in self.FORMATS:
+            raise ValueError(f"Unknown image format: {self.format}, should be one of {list(self.FORMATS)}")
+
+    @classmethod
+    def from_params(cls, params: Union['ImageCodec', dict, str, None]) -> Optional['ImageCodec']:
+        """Build a codec from an `ImageCodec`, its keyword arguments or a format name."""
+        if params is None or isinstance(params, ImageCodec):
+            return params
+        if isinstance(params, str):
+            return cls(format=params)
+        return cls(**params)
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.FORMATS[self.format.lower()].lower()}"
+
+    def encode(self, image: Image.Image) -> bytes:
+        fmt = self.FORMATS[self.format.lower()]
+        if fmt == 'PNG':
+            kwargs = dict(compress_level=self.compress_level)
+        elif fmt == 'JPEG':
+            # JPEG has no alpha channel.
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            kwargs = dict(quality=self.quality)
+            if self.subsampling is not None:
+                kwargs['subsampling'] = self.subsampling
+        else:
+            kwargs = dict(quality=self.quality, lossless=self.lossless)
+        buffered = BytesIO()
+        image.save(buffered, format=fmt, **kwargs)
+        return buffered.getvalue()
+
+
+def encode_image_url(image: Image.Image, resize: Union[Tuple, List]=None, codec: ImageCodec=None) -> str:
     """Encode an image to base64 string.
+
+    Args:
+        resize: Shrink the image to fit in this (width, height) first.
+        codec: The `ImageCodec`, PNG by default.
     """
     if resize:
         image = image.copy()
         image.thumbnail(resize)
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    base64_url = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{base64_url}"
+    if codec is None:
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        data, mime_type = buffered.getvalue(), "image/png"
+    else:
+        data, mime_type = codec.encode(image), codec.mime_type
+    base64_url = base64.b64encode(data).decode('utf-8')
+    return f"data:{mime_type};base64,{base64_url}"
 
 
 def contains_chinese(text):
@@ -107,6 +173,89 @@ def is_same_image(img1: Image.Image, img2: Image.Image):
     img2 = np.array(img2)
     return np.array_equal(img1, img2)
 
+def image_digest(image: Image.Image) -> str:
+    """A hash of the mode, size and pixels of an image."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+def dhash(image: Image.Image, hash_size: int = 16) -> int:
+    """The difference hash of an image.
+
+    Each bit tells whether a cell of a (hash_size + 1) x hash_size grayscale
+    thumbnail is brighter than its right neighbour. Similar images have hashes
+    at a small Hamming distance, see `hamming_distance`.
+    """
+    small = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+def grayscale(image: Image.Image, level: int = 0) -> np.ndarray:
+    """The image as a grayscale array, downscaled by 2**level with box averaging."""
+    if level > 0:
+        image = image.reduce(2 ** level)
+    return np.asarray(image.convert('L'))
+
+def diff_boxes(
+    gray1: np.ndarray,
+    gray2: np.ndarray,
+    level: int = 0,
+    pixel_threshold: int = 5,
+    area_threshold: int = 1000,
+    max_boxes: int = 2,
+    merge_threshold: int = 20,
+) -> Optional[List[Tuple[int, int, int, int]]]:
+    """The (x, y, w, h) boxes of the regions that differ between two grayscale images.
+
+    The images are downscaled by 2**level, the thresholds and the boxes are in
+    full-resolution pixels. Returns None when there is nothing to highlight:
+    no change, too many changes, or a change of the whole screen.
+    """
+    import cv2
+    scale = 2 ** level
+    diff = cv2.absdiff(gray1, gray2)
+    _, thresh = cv2.threshold(diff, pixel_threshold, 255, cv2.THRESH_BINARY)
+    kernel_size = max(1, round(merge_threshold / scale))
+    dilated = cv2.dilate(thresh, np.ones((kernel_size, kernel_size), np.uint8), iterations=1)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    logger.info(f"DIFF IMAGE: Number of raw contours: {len(contours)}")
+    contours = [c for c in contours if cv2.contourArea(c) > area_threshold / scale ** 2]
+    logger.info(f"DIFF IMAGE: Number of filtered contours: {len(contours)}")
+    if len(contours) == 0:
+        logger.info("DIFF IMAGE: No contours found.")
+        return None
+    boxes = [cv2.boundingRect(c) for c in contours]
+    if len(boxes) == 1 and boxes[0] == (0, 0, gray2.shape[1], gray2.shape[0]):
+        logger.info("DIFF IMAGE: The two images are exactly different.")
+        return None
+    if len(boxes) > max_boxes:
+        logger.info(f"DIFF IMAGE: Too many contours found: {len(boxes)}")
+        return None
+    return [(x * scale, y * scale, w * scale, h * scale) for x, y, w, h in boxes]
+
+def draw_diff_boxes(img1: Image.Image, img2: Image.Image, boxes: List[Tuple[int, int, int, int]]):
+    """Copies of both images with the boxes drawn in red."""
+    import cv2
+    new_images = [img1.convert('RGB'), img2.convert('RGB')]
+    width, height = img1.size
+    for x, y, w, h in boxes:
+        x = max(0, x-3)
+        y = max(0, y-3)
+        w = min(w + 6, width - x)
+        h = min(h + 6, height - y)
+        # Only the pixels around the box change, draw on that region instead of the whole frame.
+        left, top = max(0, x - 2), max(0, y - 2)
+        region = (left, top, min(width, x + w + 3), min(height, y + h + 3))
+        for image in new_images:
+            patch = np.array(image.crop(region))
+            cv2.rectangle(patch, (x - left, y - top), (x + w - left, y + h - top), (255, 0, 0), 3)
+            image.paste(Image.fromarray(patch), region[:2])
+    return tuple(new_images)
+
 def diff_image(
     img1: Image.Image,
     img2: Image.Image,
@@ -141,17 +290,28 @@ def diff_image(
     if len(contours) > max_boxes:
         logger.info(f"DIFF IMAGE: Too many contours found: {len(contours)}")
         return None, None
+    return draw_diff_boxes(img1, img2, [cv2.boundingRect(c) for c in contours])
 
-    new_img1 = opencv_image1.copy()
-    new_img2 = opencv_image2.copy()
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        x = max(0, x-3)
-        y = max(0, y-3)
-        w = min(w + 6, img1.size[0] - x)
-        h = min(h + 6, img1.size[1] - y)
-        cv2.rectangle(new_img1, (x, y), (x + w, y + h), (0, 0, 255), 3)
-        cv2.rectangle(new_img2, (x, y), (x + w, y + h), (0, 0, 255), 3)
-    new_img1 = Image.fromarray(cv2.cvtColor(new_img1, cv2.COLOR_BGR2RGB))
-    new_img2 = Image.fromarray(cv2.cvtColor(new_img2, cv2.COLOR_BGR2RGB))
-    return new_img1, new_img2
+def diff_image_fast(
+    img1: Image.Image,
+    img2: Image.Image,
+    pixel_threshold: int = 5,
+    area_threshold: int = 1000,
+    max_boxes: int = 2,
+    merge_threshold: int = 20,
+    level: int = 2,
+    gray1: Optional[np.ndarray] = None,
+    gray2: Optional[np.ndarray] = None,
+):
+    """`diff_image` on grayscale images downscaled by 2**level.
+
+    Pass `gray1` and `gray2` to reuse precomputed levels, see `grayscale`.
+    """
+    if gray1 is None:
+        gray1 = grayscale(img1, level)
+    if gray2 is None:
+        gray2 = grayscale(img2, level)
+    boxes = diff_boxes(gray1, gray2, level, pixel_threshold, area_threshold, max_boxes, merge_threshold)
+    if boxes is None:
+        return None, None
+    return draw_diff_boxes(img1, img2, boxes)
@@ -1,8 +1,14 @@
 import time
 import asyncio
 import logging
-from typing import Any, Optional
-from openai import OpenAI, ChatCompletion
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+from .scheme import VLMCallStats
+from .vlm_cache import VLMCache
+from .vlm_client import get_client, get_async_client
 
 
 logger = logging.getLogger(__name__)
@@ -21,32 +27,65 @@ class VLMWrapper:
             retry_waiting_seconds: int = 2, 
             max_tokens: int = 1024, 
             temperature: float = 0.0,
+            cache: VLMCache = None,
+            share_client: bool = True,
+            http2: bool = False,
+            continuous_usage_stats: bool = False,
             **vlm_kwargs
         ):
+        """
+        Args:
+            cache: An optional `VLMCache`. Non-streaming requests are answered from
+                it when the same request was sent before.
+            share_client: Use the process-wide client of `base_url` and `api_key`,
+                so that wrappers of the same endpoint reuse warm connections.
+            http2: Use HTTP/2 for the shared client, needs the `h2` package.
+            continuous_usage_stats: Ask for the usage in every streamed chunk (a vLLM
+                extension), so that streams stopped early by `predict_until` still
+                report their usage. Otherwise it is only in the last chunk.
+        """
         self.model_name = model_name
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        # self.aclient = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        self.base_url = base_url
+        self.api_key = api_key
+        self.share_client = share_client
+        self.http2 = http2
+        self.continuous_usage_stats = continuous_usage_stats
+        if share_client:
+            self.client = get_client(base_url, api_key, http2=http2)
+        else:
+            self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self._aclient = None
     
         self.max_retry = max_retry
         self.retry_waiting_seconds = retry_waiting_seconds
         
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.cache = cache
 
         self.vlm_kwargs = vlm_kwargs
 
-    def predict(self, messages, stream: bool=False, **kwargs) -> ChatCompletion:
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        """The async client, the shared one of the running event loop if `share_client`."""
+        if self.share_client:
+            return get_async_client(self.base_url, self.api_key, http2=self.http2)
+        if self._aclient is None:
+            self._aclient = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        return self._aclient
+
+    def predict(self, messages, stream: bool=False, role: str=None, call_stats: List[VLMCallStats]=None, **kwargs) -> ChatCompletion:
         """Predict the next action given the history and the current screenshot.
 
         Args:
             messages: The messages to send to the model.
+            role: The caller, e.g. the sub-agent name, to tag the call stats with.
+            call_stats: A list to append the `VLMCallStats` of the call to.
+                Streamed calls are only recorded by `predict_until`.
         
         Returns:
             The ChatCompletion of the VLM
         """
-        counter = self.max_retry
-        wait_seconds = self.retry_waiting_seconds
-
         # import copy
         # messages_s = copy.deepcopy(messages)
         # for msg in messages_s:
@@ -58,6 +97,41 @@ class VLMWrapper:
         # print("messages: ", json.dumps(messages_s, ensure_ascii=False, indent=2))
 
         kwargs.update(self.vlm_kwargs)
+        start = time.time()
+        cache_key = self._cache_key(messages, stream, kwargs)
+        if cache_key is not None:
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self._record(call_stats, role, messages, response, start, cached=True)
+                return response
+        response = self._request(messages, stream, kwargs)
+        if cache_key is not None:
+            self.cache.put(cache_key, response)
+        if not stream:
+            self._record(call_stats, role, messages, response, start)
+        return response
+
+    def _record(self, call_stats: Optional[List[VLMCallStats]], role: Optional[str], messages, response,
+                start: float, ttft: float=None, cached: bool=False):
+        if call_stats is None:
+            return
+        usage = getattr(response, 'usage', None)
+        num_images, request_bytes = _measure(messages)
+        call_stats.append(VLMCallStats(
+            role=role,
+            prompt_tokens=getattr(usage, 'prompt_tokens', None),
+            completion_tokens=getattr(usage, 'completion_tokens', None),
+            num_images=num_images,
+            request_bytes=request_bytes,
+            ttft=ttft,
+            latency=time.time() - start,
+            cached=cached,
+        ))
+
+    def _request(self, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        """Send the request, retrying on errors."""
+        counter = self.max_retry
+        wait_seconds = self.retry_waiting_seconds
         while counter > 0:
             try:
                 response = self.client.chat.completions.create(
@@ -74,3 +148,136 @@ class VLMWrapper:
                 time.sleep(wait_seconds)
                 counter -= 1
                 if counter <= 0: raise  # re-raise after max retry.
+
+    def predict_until(self, messages, until: Callable[[str], bool], role: str=None,
+                      call_stats: List[VLMCallStats]=None, **kwargs) -> ChatCompletion:
+        """Stream the response and stop as soon as `until(delta)` returns True.
+
+        Closing the stream early aborts the rest of the generation. The content
+        (and logprobs, if requested) received so far is returned as a ChatCompletion.
+        """
+        start = time.time()
+        stream_options = {'include_usage': True}
+        if self.continuous_usage_stats:
+            stream_options['continuous_usage_stats'] = True
+        kwargs.setdefault('stream_options', stream_options)
+        stream = self.predict(messages, stream=True, **kwargs)
+        content, logprobs = [], []
+        completion_id, created, model, finish_reason = '', 0, self.model_name, None
+        ttft, usage = None, None
+        try:
+            for chunk in stream:
+                completion_id, created, model = chunk.id, chunk.created, chunk.model or model
+                usage = getattr(chunk, 'usage', None) or usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.logprobs is not None and choice.logprobs.content:
+                    logprobs.extend(lp.model_dump() for lp in choice.logprobs.content)
+                finish_reason = choice.finish_reason or finish_reason
+                delta = choice.delta.content if choice.delta is not None else None
+                if delta:
+                    if ttft is None:
+                        ttft = time.time() - start
+                    content.append(delta)
+                    if until(delta):
+                        break
+        finally:
+            stream.close()
+        response = ChatCompletion.model_validate({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'finish_reason': finish_reason or 'stop',
+                'message': {'role': 'assistant', 'content': ''.join(content)},
+                'logprobs': {'content': logprobs} if logprobs else None,
+            }],
+            'usage': usage.model_dump() if usage is not None else None,
+        })
+        self._record(call_stats, role, messages, response, start, ttft=ttft)
+        return response
+
+    def _cache_key(self, messages, stream: bool, kwargs: dict) -> Optional[str]:
+        if self.cache is None or stream:
+            return None
+        params = dict(kwargs, max_tokens=self.max_tokens, temperature=self.temperature)
+        return self.cache.key(self.model_name, params, messages)
+
+    async def apredict(self, messages, stream: bool=False, role: str=None, call_stats: List[VLMCallStats]=None, **kwargs) -> ChatCompletion:
+        """The async version of `predict`, on the shared `AsyncOpenAI` client."""
+        kwargs.update(self.vlm_kwargs)
+        start = time.time()
+        cache_key = self._cache_key(messages, stream, kwargs)
+        if cache_key is not None:
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self._record(call_stats, role, messages, response, start, cached=True)
+                return response
+        response = await self._arequest(messages, stream, kwargs)
+        if cache_key is not None:
+            self.cache.put(cache_key, response)
+        if not stream:
+            self._record(call_stats, role, messages, response, start)
+        return response
+
+    async def _arequest(self, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        counter = self.max_retry
+        wait_seconds = self.retry_waiting_seconds
+        while counter > 0:
+            try:
+                response = await self.aclient.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    stream=stream,
+                    **kwargs
+                )
+                return response
+            except Exception as err:
+                logger.warning(f'Error calling VLM API with message: {err}')
+                counter -= 1
+                if counter <= 0: raise  # re-raise after max retry.
+                await asyncio.sleep(wait_seconds)
+
+    async def apredict_many(self, messages_list: List[list], **kwargs) -> List[ChatCompletion]:
+        """Send several independent requests concurrently, results are in the same order."""
+        return await asyncio.gather(*[self.apredict(messages, **kwargs) for messages in messages_list])
+
+    def predict_many(self, messages_list: List[list], roles: List[str]=None, **kwargs) -> List[ChatCompletion]:
+        """Send several independent requests concurrently from synchronous code.
+
+        The requests run on a thread pool over the synchronous client, which is
+        safe to share between threads. Results are in the same order. `roles`
+        tags the call stats of each request, see `predict`.
+        """
+        roles = roles or [None] * len(messages_list)
+        if len(messages_list) <= 1:
+            return [self.predict(messages, role=role, **kwargs) for messages, role in zip(messages_list, roles)]
+        with ThreadPoolExecutor(max_workers=len(messages_list)) as executor:
+            futures = [executor.submit(self.predict, messages, role=role, **kwargs) for messages, role in zip(messages_list, roles)]
+            return [future.result() for future in futures]
+
+
+def _measure(messages) -> tuple[int, int]:
+    """Count the images and the bytes of the texts and image URLs in `messages`.
+
+    The payload is not serialized again, the data URLs are ASCII so their
+    length is their size.
+    """
+    num_images, size = 0, 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            size += len(content.encode('utf-8'))
+            continue
+        for item in content or ():
+            if item.get('type') == 'image_url':
+                num_images += 1
+                size += len(item['image_url']['url'])
+            elif item.get('type') == 'text':
+                size += len(item['text'].encode('utf-8'))
+    return num_images, size
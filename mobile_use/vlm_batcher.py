@@ -0,0 +1,217 @@
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import dataclasses
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from openai.types.chat import ChatCompletion
+
+from .vlm import VLMWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class VLMBatcher:
+    """Coalesce the requests of concurrent agents into micro-batches.
+
+    Requests arriving within `window_seconds` of the first pending request are
+    dispatched together with `apredict`, on one event loop over the shared async
+    client of `vlm`, so that they reach the server at once and are scheduled in
+    the same batch. Identical requests in a batch are sent once and all their
+    callers get the response, unless the VLM samples with a non-zero temperature
+    and each caller expects its own sample. Each caller waits on the future of
+    its own request.
+    Streaming requests bypass the batcher.
+
+    The batcher exposes the `VLMWrapper` interface and can be shared by the
+    agents of several episodes.
+
+    Args:
+        vlm: The wrapper that sends the requests.
+        window_seconds: How long to wait for more requests after the first one.
+        max_batch_size: Dispatch as soon as this many requests are pending.
+        max_concurrency: The maximum number of requests in flight, defaults to
+            `max_batch_size`.
+    """
+
+    def __init__(
+            self,
+            vlm: VLMWrapper,
+            window_seconds: float=0.02,
+            max_batch_size: int=16,
+            max_concurrency: Optional[int]=None,
+        ):
+        self.vlm = vlm
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency or max_batch_size
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_sent = 0
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._pending = []
+        self._futures = set()
+        self._timer = None
+        self._tasks = set()
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._thread = threading.Thread(target=self._run_loop, name="VLMBatcher-dispatch", daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # Everything else, e.g. `model_name` or `client`, is the wrapped VLM's.
+        if name == 'vlm':
+            raise AttributeError(name)
+        return getattr(self.vlm, name)
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.num_requests / self.num_batches if self.num_batches else 0.0
+
+    def submit(self, messages, **kwargs) -> Future:
+        """Queue a non-streaming request, the future resolves to its ChatCompletion."""
+        future = Future()
+        # Hashed on the caller's thread, the dispatch loop only groups the keys.
+        key = _request_key(messages, kwargs) if self._dedupe(kwargs) else None
+        with self._lock:
+            # Checked and queued under the lock, so nothing is queued after `close`.
+            if self._closed:
+                raise RuntimeError("The VLMBatcher is closed.")
+            self._futures.add(future)
+            self._loop.call_soon_threadsafe(self._enqueue, (messages, kwargs, future, key))
+        future.add_done_callback(self._discard)
+        return future
+
+    def _dedupe(self, kwargs: dict) -> bool:
+        # Sampled requests are not merged, each caller gets an independent sample.
+        temperature = kwargs.get('temperature', getattr(self.vlm, 'temperature', None))
+        return not temperature
+
+    def _discard(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def predict(self, messages, stream: bool=False, **kwargs) -> ChatCompletion:
+        if stream:
+            return self.vlm.predict(messages, stream=True, **kwargs)
+        return self.submit(messages, **kwargs).result()
+
+    def predict_many(self, messages_list: List[list], roles: List[str]=None, **kwargs) -> List[ChatCompletion]:
+        roles = roles or [None] * len(messages_list)
+        futures = [self.submit(messages, role=role, **kwargs) for messages, role in zip(messages_list, roles)]
+        return [future.result() for future in futures]
+
+    def predict_until(self, messages, until, **kwargs) -> ChatCompletion:
+        return self.vlm.predict_until(messages, until, **kwargs)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.run_forever()
+
+    def _enqueue(self, item):
+        self._pending.append(item)
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.window_seconds, self._flush)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        groups: Dict[object, list] = {}
+        for messages, kwargs, future, key in batch:
+            # Requests without a key are never merged.
+            groups.setdefault(future if key is None else key, []).append((messages, kwargs, future))
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        self.num_sent += len(groups)
+        logger.debug(f"Dispatching a batch of {len(batch)} VLM requests as {len(groups)} requests.")
+        for group in groups.values():
+            task = self._loop.create_task(self._send(group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, group: list):
+        messages, kwargs, _ = group[0]
+        kwargs = dict(kwargs)
+        kwargs.pop('call_stats', None)
+        stats = []
+        try:
+            async with self._semaphore:
+                response = await self.vlm.apredict(messages, call_stats=stats, **kwargs)
+        except BaseException as e:
+            for _, _, future in group:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        # The first caller sent the request, the others share its response.
+        for i, (_, other_kwargs, future) in enumerate(group):
+            other_stats = other_kwargs.get('call_stats')
+            if other_stats is not None:
+                other_stats.extend(s if i == 0 else dataclasses.replace(s, role=other_kwargs.get('role'), cached=True) for s in stats)
+            future.set_result(response)
+
+    async def _shutdown(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def close(self):
+        """Dispatch the pending requests, wait for them and stop the batcher."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+        # Anything left unresolved, e.g. after an error during the shutdown, fails.
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError("The VLMBatcher is closed."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _request_key(messages, kwargs: dict) -> str:
+    """Hash the texts and image URLs of a request, without serializing the messages."""
+    # The role and the call stats only tag the call, they do not change the request.
+    params = {k: v for k, v in kwargs.items() if k not in ('role', 'call_stats')}
+    h = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    if not isinstance(messages, list):
+        h.update(repr(messages).encode('utf-8'))
+        return h.hexdigest()
+    for message in messages:
+        h.update(f"\0{message.get('role')}".encode('utf-8'))
+        content = message.get('content')
+        items = [{'type': 'text', 'text': content}] if isinstance(content, str) else content or []
+        for item in items:
+            if item.get('type') == 'image_url':
+                part = item['image_url']['url']
+            elif item.get('type') == 'text':
+                part = item['text']
+            else:
+                part = json.dumps(item, sort_keys=True, default=str)
+            h.update(f"\0{item.get('type')}\0{part}".encode('utf-8'))
+    return h.hexdigest()
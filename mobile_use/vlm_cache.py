@@ -0,0 +1,167 @@
+import io
+import os
+import json
+import base64
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from PIL import Image
+from openai.types.chat import ChatCompletion
+
+logger = logging.getLogger(__name__)
+
+
+def _image_digest(url: str) -> str:
+    """Hash an image by its decoded pixels, so re-encodings of the same frame share a key."""
+    if not url.startswith('data:'):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+    data = base64.b64decode(url.split(',', 1)[1])
+    try:
+        image = Image.open(io.BytesIO(data))
+        h = hashlib.sha256(f"{image.mode}:{image.size}".encode('utf-8'))
+        h.update(image.tobytes())
+    except Exception:
+        h = hashlib.sha256(data)
+    return h.hexdigest()
+
+
+def _normalize_messages(messages: List[dict]) -> List[dict]:
+    normalized = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if item.get('type') == 'image_url':
+                    item = dict(item)
+                    item['image_url'] = {'sha256': _image_digest(item['image_url']['url'])}
+                items.append(item)
+            message = dict(message, content=items)
+        normalized.append(message)
+    return normalized
+
+
+class VLMCache:
+    """A content-addressed, on-disk cache of VLM responses.
+
+    Responses are keyed by the model name, the sampling parameters and the
+    messages, with images hashed by their pixels. Each response is stored as a
+    JSON file; the least recently used files are evicted once the cache grows
+    beyond `max_size_bytes`.
+
+    Args:
+        cache_dir: The directory of the cache, shared between runs.
+        max_size_bytes: The size bound of the cache directory.
+        mode: 'read_write' reads and stores responses, 'read_only' only reads
+            them, 'bypass' disables the cache.
+        only_deterministic: Only cache requests with temperature 0, sampled
+            responses are not replayed.
+    """
+
+    MODES = ('read_write', 'read_only', 'bypass')
+
+    def __init__(
+            self,
+            cache_dir: str,
+            max_size_bytes: int=1 << 30,
+            mode: str='read_write',
+            only_deterministic: bool=True,
+        ):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode: {mode}, should be one of {self.MODES}")
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.mode = mode
+        self.only_deterministic = only_deterministic
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._files())
+
+    def _files(self) -> List[str]:
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            files.extend(os.path.join(root, name) for name in names if name.endswith('.json'))
+        return files
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def key(self, model: str, params: Dict[str, Any], messages: List[dict]) -> Optional[str]:
+        """Return the cache key of a request, or None if the request should not be cached."""
+        if self.mode == 'bypass':
+            return None
+        if self.only_deterministic and params.get('temperature', 1.0) != 0:
+            return None
+        payload = json.dumps(
+            {'model': model, 'params': params, 'messages': _normalize_messages(messages)},
+            sort_keys=True, ensure_ascii=False, default=str,
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[ChatCompletion]:
+        if key is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = ChatCompletion.model_validate_json(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Failed to read the cached response {path}: {e}.")
+            self.misses += 1
+            return None
+        if self.mode == 'read_write':
+            # Mark as recently used.
+            os.utime(path)
+        self.hits += 1
+        return response
+
+    def put(self, key: Optional[str], response: ChatCompletion):
+        if key is None or self.mode != 'read_write':
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(response.model_dump_json())
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            new_size = os.path.getsize(path)
+        except OSError as e:
+            logger.warning(f"Failed to store the response in the VLM cache: {e}.")
+            return
+        with self._lock:
+            self._size += new_size - old_size
+            if self._size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used responses until the cache is 10% below its bound."""
+        files = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        size = sum(f[1] for f in files)
+        target = self.max_size_bytes * 0.9
+        for _, file_size, path in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except FileNotFoundError:
+                pass
+        logger.info(f"Evicted VLM cache entries, size {self._size} -> {size} bytes.")
+        self._size = size
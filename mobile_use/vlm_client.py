@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import threading
+import importlib.util
+import weakref
+from typing import Any, Dict, List, Tuple
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+# Connection pool settings of the shared clients.
+POOL_LIMITS = httpx.Limits(
+    max_connections=64,
+    max_keepalive_connections=32,
+    keepalive_expiry=120.0,
+)
+# VLM calls with several screenshots can take a while, but connecting should not.
+POOL_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[str, str, bool], OpenAI] = {}
+# The pool of an async client is bound to its event loop, so async clients are shared per loop.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str, bool], AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+_request_counts: Dict[Tuple[str, str, bool], int] = {}
+
+
+def _http2_available(http2: bool) -> bool:
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning("HTTP/2 needs the `h2` package (pip install httpx[http2]), falling back to HTTP/1.1.")
+        return False
+    return http2
+
+
+def _count_request(key):
+    def hook(request):
+        with _lock:
+            _request_counts[key] = _request_counts.get(key, 0) + 1
+    return hook
+
+
+def get_client(base_url: str, api_key: str, http2: bool=False) -> OpenAI:
+    """Return the process-wide `OpenAI` client of an endpoint, creating it on first use.
+
+    All `VLMWrapper`s of the same endpoint share the client and therefore its
+    keep-alive connections.
+    """
+    http2 = _http2_available(http2)
+    key = (base_url, api_key, http2)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=POOL_LIMITS,
+                timeout=POOL_TIMEOUT,
+                http2=http2,
+                event_hooks={'request': [_count_request(key)]},
+            )
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            _clients[key] = client
+        return client
+
+
+def get_async_client(base_url: str, api_key: str, http2: bool=False) -> AsyncOpenAI:
+    """Return the `AsyncOpenAI` client of an endpoint shared within the running event loop."""
+    http2 = _http2_available(http2)
+    key = (base_url, api_key, http2)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            async def hook(request):
+                _count_request(key)(request)
+            http_client = httpx.AsyncClient(
+                limits=POOL_LIMITS,
+                timeout=POOL_TIMEOUT,
+                http2=http2,
+                event_hooks={'request': [hook]},
+            )
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            clients[key] = client
+        return client
+
+
+def _pool_connections(http_client) -> List[Any]:
+    # httpx does not expose its pool, read it from httpcore when possible.
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    return list(getattr(pool, 'connections', []))
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    """Connection statistics of the shared synchronous clients, one entry per endpoint."""
+    stats = []
+    with _lock:
+        items = list(_clients.items())
+        counts = dict(_request_counts)
+    for (base_url, api_key, http2), client in items:
+        connections = _pool_connections(client._client)
+        stats.append({
+            'base_url': base_url,
+            'http2': http2,
+            'requests': counts.get((base_url, api_key, http2), 0),
+            'connections': len(connections),
+            'idle_connections': sum(1 for c in connections if c.is_idle()),
+        })
+    return stats
+
+
+def close_clients():
+    """Close the shared synchronous clients, e.g. before the process exits."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
@@ -0,0 +1,310 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from openai.types.chat import ChatCompletion
+
+from .vlm import VLMWrapper
+from .vlm_cache import VLMCache
+from .vlm_client import get_client, get_async_client
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """One replica served behind `VLMRouter`, with its load and circuit breaker state."""
+
+    def __init__(self, base_url: str, api_key: str='EMPTY', http2: bool=False):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.http2 = http2
+        # The router retries on another endpoint itself, the SDK should not retry on this one.
+        self.client = get_client(base_url, api_key, http2=http2).with_options(max_retries=0)
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.base_url}, outstanding={self.outstanding}, failures={self.failures})"
+
+
+class _TrackedStream:
+    """A response stream that releases its endpoint once it is exhausted, closed or fails."""
+
+    def __init__(self, stream, release: Callable[[Optional[float], Optional[Exception]], None]):
+        self._stream = stream
+        self._release = release
+        self._start = time.time()
+        self._released = False
+
+    def _done(self, latency: Optional[float], error: Optional[Exception] = None):
+        if not self._released:
+            self._released = True
+            self._release(latency, error)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except Exception as err:
+            self._done(None, err)
+            raise
+        self._done(time.time() - self._start)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            # Closed before the end, the latency is not that of a whole response.
+            self._done(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _AsyncTrackedStream(_TrackedStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception as err:
+            self._done(None, err)
+            raise
+        self._done(time.time() - self._start)
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._done(None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class VLMRouter(VLMWrapper):
+    """A `VLMWrapper` over several replicas of the same model.
+
+    Each request goes to the available endpoint with the fewest outstanding
+    requests. An endpoint is taken out of rotation for `recovery_seconds` after
+    `failure_threshold` consecutive failures. Failed requests are retried on
+    another endpoint after an exponential backoff with full jitter.
+
+    With `hedge=True`, a non-streaming request still unanswered after the
+    `hedge_quantile` latency of recent requests is duplicated on another
+    endpoint, and the first answer wins.
+
+    Args:
+        endpoints: The replicas, as dicts with `base_url` and optionally `api_key`.
+        backoff_base_seconds: The backoff before the first retry, doubled on each retry.
+        backoff_max_seconds: The upper bound of the backoff.
+        failure_threshold: Consecutive failures that open the circuit of an endpoint.
+        recovery_seconds: How long an open circuit keeps the endpoint out of rotation.
+        hedge: Enable hedged requests.
+        hedge_quantile: The latency quantile after which a request is hedged.
+        hedge_min_samples: Hedging starts once this many latencies are recorded.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            endpoints: List[Dict[str, str]],
+            max_retry: int = 3,
+            backoff_base_seconds: float = 0.5,
+            backoff_max_seconds: float = 10.0,
+            failure_threshold: int = 3,
+            recovery_seconds: float = 30.0,
+            hedge: bool = False,
+            hedge_quantile: float = 0.95,
+            hedge_min_samples: int = 20,
+            max_tokens: int = 1024,
+            temperature: float = 0.0,
+            cache: VLMCache = None,
+            http2: bool = False,
+            **vlm_kwargs
+        ):
+        if not endpoints:
+            raise ValueError("VLMRouter needs at least one endpoint.")
+        self.endpoints = [Endpoint(http2=http2, **endpoint) for endpoint in endpoints]
+        super().__init__(
+            model_name=model_name,
+            api_key=self.endpoints[0].api_key,
+            base_url=self.endpoints[0].base_url,
+            max_retry=max_retry,
+            retry_waiting_seconds=backoff_base_seconds,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            cache=cache,
+            http2=http2,
+            **vlm_kwargs
+        )
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.num_hedged = 0
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self._executor = ThreadPoolExecutor(thread_name_prefix="VLMRouter") if hedge else None
+
+    def _acquire(self, exclude: Optional[Endpoint] = None) -> Endpoint:
+        """Pick the available endpoint with the fewest outstanding requests."""
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e is not exclude] or self.endpoints
+            available = [e for e in candidates if e.open_until <= now]
+            if available:
+                endpoint = min(available, key=lambda e: e.outstanding)
+            else:
+                # Every circuit is open, try the one that recovers first.
+                endpoint = min(candidates, key=lambda e: e.open_until)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint: Endpoint, latency: Optional[float], error: Optional[Exception] = None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.failures = 0
+                endpoint.open_until = 0.0
+                if latency is not None:
+                    self._latencies.append(latency)
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.open_until = time.time() + self.recovery_seconds
+                logger.warning(f"Endpoint {endpoint.base_url} failed {endpoint.failures} times, "
+                               f"out of rotation for {self.recovery_seconds}s.")
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a request is hedged, None until enough latencies are recorded."""
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_quantile))]
+
+    def _create_kwargs(self, messages, stream: bool, kwargs: dict) -> dict:
+        return dict(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=stream,
+            **kwargs
+        )
+
+    def _call(self, endpoint: Endpoint, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        start = time.time()
+        try:
+            response = endpoint.client.chat.completions.create(**self._create_kwargs(messages, stream, kwargs))
+        except Exception as err:
+            self._release(endpoint, None, err)
+            raise
+        if stream:
+            # The endpoint stays busy until the stream is consumed.
+            return _TrackedStream(response, lambda latency, error: self._release(endpoint, latency, error))
+        self._release(endpoint, time.time() - start)
+        return response
+
+    def _hedged_call(self, messages, kwargs: dict) -> ChatCompletion:
+        primary = self._acquire()
+        first = self._executor.submit(self._call, primary, messages, False, kwargs)
+        delay = self.hedge_delay()
+        if delay is None or wait([first], timeout=delay).done:
+            return first.result()
+        self.num_hedged += 1
+        logger.info(f"Hedging a request after {delay:.2f}s on another endpoint.")
+        second = self._executor.submit(self._call, self._acquire(exclude=primary), messages, False, kwargs)
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The other request keeps running and is released when it ends.
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _request(self, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        for attempt in range(self.max_retry):
+            try:
+                if self.hedge and not stream:
+                    return self._hedged_call(messages, kwargs)
+                return self._call(self._acquire(), messages, stream, kwargs)
+            except Exception as err:
+                logger.warning(f'Error calling VLM API with message: {err}')
+                if attempt >= self.max_retry - 1:
+                    raise  # re-raise after max retry.
+                time.sleep(self._backoff(attempt))
+
+    async def _acall(self, endpoint: Endpoint, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        start = time.time()
+        client = get_async_client(endpoint.base_url, endpoint.api_key, http2=endpoint.http2).with_options(max_retries=0)
+        try:
+            response = await client.chat.completions.create(**self._create_kwargs(messages, stream, kwargs))
+        except BaseException as err:
+            self._release(endpoint, None, err if isinstance(err, Exception) else None)
+            raise
+        if stream:
+            return _AsyncTrackedStream(response, lambda latency, error: self._release(endpoint, latency, error))
+        self._release(endpoint, time.time() - start)
+        return response
+
+    async def _ahedged_call(self, messages, kwargs: dict) -> ChatCompletion:
+        primary = self._acquire()
+        first = asyncio.ensure_future(self._acall(primary, messages, False, kwargs))
+        delay = self.hedge_delay()
+        if delay is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        self.num_hedged += 1
+        logger.info(f"Hedging a request after {delay:.2f}s on another endpoint.")
+        second = asyncio.ensure_future(self._acall(self._acquire(exclude=primary), messages, False, kwargs))
+        pending, error = {first, second}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _arequest(self, messages, stream: bool, kwargs: dict) -> ChatCompletion:
+        for attempt in range(self.max_retry):
+            try:
+                if self.hedge and not stream:
+                    return await self._ahedged_call(messages, kwargs)
+                return await self._acall(self._acquire(), messages, stream, kwargs)
+            except Exception as err:
+                logger.warning(f'Error calling VLM API with message: {err}')
+                if attempt >= self.max_retry - 1:
+                    raise  # re-raise after max retry.
+                await asyncio.sleep(self._backoff(attempt))
@@ -0,0 +1,318 @@
+import time
+import threading
+import unittest
+from types import SimpleNamespace
+from PIL import Image
+from mobile_use.scheme import EnvState
+from mobile_use.vlm import VLMWrapper
+from openai.types.chat import ChatCompletionChunk
+from mobile_use.agents.multi_agent import MultiAgent
+from mobile_use.agents.sub_agent import ToolCallScanner
+
+
+CONTENT = """Thought: Open the app.
+Action: Click the icon.
+{"name": "mobile_use", "arguments": {"action": "click", "coordinate": [10, 20]}}
+### Outcome ###
+A
+### Error Description ###
+None
+### Important Notes ###
+Nothing.
+### Completed contents ###
+Opened the app."""
+
+
+class FakeEnvironment:
+    last_settle_duration = 0.0
+
+    def __init__(self):
+        self.actions = []
+
+    def get_state(self):
+        return EnvState(pixels=Image.new('RGB', (108, 240), (255, 255, 255)), package='com.example')
+
+    def execute_action(self, action):
+        self.actions.append(action)
+
+
+class FakeVLM:
+    predict_many = VLMWrapper.predict_many
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def predict(self, messages, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=CONTENT))])
+
+
+class TestMultiAgent(unittest.TestCase):
+    def run_step(self, concurrent_sub_agents: bool):
+        vlm = FakeVLM(latency=0.05)
+        agent = MultiAgent(
+            env=FakeEnvironment(),
+            vlm=vlm,
+            use_reflector=True,
+            use_note_taker=True,
+            use_processor=True,
+            include_time=False,
+            concurrent_sub_agents=concurrent_sub_agents,
+        )
+        agent.reset(goal='Open the app')
+        agent.step()
+        return agent, vlm
+
+    def test_sequential_sub_agents(self):
+        agent, vlm = self.run_step(concurrent_sub_agents=False)
+        self.assertEqual(vlm.max_in_flight, 1)
+        step_data = agent.trajectory[-1]
+        self.assertEqual(step_data.reflection_outcome, 'A')
+        self.assertEqual(step_data.progress, 'Opened the app.')
+
+    def test_concurrent_sub_agents(self):
+        agent, vlm = self.run_step(concurrent_sub_agents=True)
+        self.assertEqual(vlm.max_in_flight, 3)
+        step_data = agent.trajectory[-1]
+        self.assertEqual(step_data.action.name, 'click')
+        self.assertEqual(step_data.reflection_outcome, 'A')
+        self.assertIsNotNone(step_data.memory)
+        self.assertEqual(step_data.progress, 'Opened the app.')
+
+
+class FakeStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for delta in self.deltas:
+            self.consumed += 1
+            yield ChatCompletionChunk.model_validate({
+                'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'model',
+                'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}],
+            })
+
+    def close(self):
+        self.closed = True
+
+
+class TestStreamOperator(unittest.TestCase):
+    def test_scanner(self):
+        scanner = ToolCallScanner()
+        chunks = ['Thought: x\nAction: type\n{"name": "mobile', '_use", "arguments": {"action": "type", ',
+                  '"text": "a } \\" {"}}', '\nSummary: typed']
+        results = [scanner.feed(chunk) for chunk in chunks]
+        self.assertEqual(results, [False, False, True, True])
+        self.assertTrue(scanner.text.endswith('{"}}'))
+
+    def test_early_dispatch(self):
+        deltas = ['Thought: Open the app.\n', 'Action: Click the icon.\n', '{"name": "mobile_use", ',
+                  '"arguments": {"action": "click", ', '"coordinate": [10, 20]}}', '\nSummary', ': clicked']
+        stream = FakeStream(deltas)
+        vlm = VLMWrapper(model_name='model', api_key='EMPTY', base_url='http://127.0.0.1:1/v1', share_client=False)
+        vlm.client.chat.completions.create = lambda **kwargs: stream
+        env = FakeEnvironment()
+        agent = MultiAgent(env=env, vlm=vlm, include_time=False, stream_operator=True)
+        agent.reset(goal='Open the app')
+        agent.step()
+        self.assertTrue(stream.closed)
+        self.assertEqual(stream.consumed, 5)
+        self.assertEqual(env.actions[0].name, 'click')
+        self.assertEqual(agent.trajectory[-1].action_desc, 'Click the icon.')
+
+
+class TestPromptLayout(unittest.TestCase):
+    def run_steps(self, prompt_layout: str):
+        agent = MultiAgent(env=FakeEnvironment(), vlm=FakeVLM(latency=0), include_time=False, prompt_layout=prompt_layout)
+        agent.reset(goal='Open the app')
+        prompts = []
+        for _ in range(2):
+            agent.step()
+            prompts.append(agent.operator.get_message(agent.episode_data)[-1]['content'][0]['text'])
+        return agent, prompts
+
+    def test_prefix_cache(self):
+        agent, prompts = self.run_steps('prefix_cache')
+        first, second = agent.trajectory
+        self.assertEqual(first.prompt_prefix_hash, second.prompt_prefix_hash)
+        self.assertEqual(first.prompt_prefix_length, second.prompt_prefix_length)
+        stable = prompts[0].index('### Latest History Operations ###')
+        self.assertGreater(stable, prompts[0].index('### Response Requirements ###'))
+        self.assertEqual(prompts[0][:stable], prompts[1][:stable])
+
+    def test_same_sections(self):
+        _, default = self.run_steps('default')
+        _, prefix_cache = self.run_steps('prefix_cache')
+        self.assertLess(default[1].index('### Latest History Operations ###'), default[1].index('### Response Requirements ###'))
+        # Only the order of the sections differs.
+        self.assertEqual(sorted(filter(None, default[1].split('\n'))), sorted(filter(None, prefix_cache[1].split('\n'))))
+
+    def test_unknown_layout(self):
+        with self.assertRaises(ValueError):
+            MultiAgent(env=FakeEnvironment(), vlm=FakeVLM(latency=0), include_time=False, prompt_layout='unknown')
+
+
+class CountingVLM(FakeVLM):
+    def __init__(self, content: str = CONTENT):
+        super().__init__(latency=0.05)
+        self.content = content
+        self.calls = 0
+
+    def predict(self, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+        response = super().predict(messages, **kwargs)
+        response.choices[0].message.content = self.content
+        return response
+
+
+class TestSpeculativeOperator(unittest.TestCase):
+    def run_steps(self, vlm, num_steps=2, **kwargs):
+        agent = MultiAgent(env=FakeEnvironment(), vlm=vlm, use_reflector=True, include_time=False, speculative_operator=True, **kwargs)
+        agent.reset(goal='Open the app')
+        for _ in range(num_steps):
+            agent.step()
+        return agent
+
+    def test_hit(self):
+        vlm = CountingVLM()
+        agent = self.run_steps(vlm)
+        self.assertIsNone(agent.trajectory[0].speculative_hit)
+        self.assertTrue(agent.trajectory[1].speculative_hit)
+        # The Reflector and the speculative Operator of the first step overlap.
+        self.assertEqual(vlm.max_in_flight, 2)
+        # Operator, Reflector and speculation, then a Reflector and a speculation.
+        self.assertEqual(vlm.calls, 5)
+        self.assertEqual(agent.trajectory[1].action.name, 'click')
+
+    def test_miss(self):
+        vlm = CountingVLM(CONTENT.replace('### Outcome ###\nA', '### Outcome ###\nB'))
+        agent = self.run_steps(vlm)
+        self.assertEqual(agent.trajectory[0].reflection_outcome, 'B')
+        self.assertFalse(agent.trajectory[1].speculative_hit)
+        self.assertEqual(vlm.calls, 6)
+
+    def test_step_budget(self):
+        vlm = CountingVLM()
+        agent = self.run_steps(vlm, max_steps=2)
+        # No speculation for a third step.
+        self.assertIsNone(agent._speculation)
+        self.assertEqual(vlm.calls, 4)
+
+    def test_reset(self):
+        agent = self.run_steps(CountingVLM(), num_steps=1)
+        _, future = agent._speculation
+        agent.reset(goal='Open the app')
+        self.assertIsNone(agent._speculation)
+        self.assertIsNone(agent._speculation_executor)
+        self.assertTrue(future.cancelled() or future.done())
+
+
+class MarkerEnvironment(FakeEnvironment):
+    """A phone-sized screen with a red marker to click."""
+    marker = (731, 1650)
+
+    def get_state(self):
+        image = Image.new('RGB', (1080, 2400), (255, 255, 255))
+        x, y = self.marker
+        image.paste((255, 0, 0), (x - 20, y - 20, x + 21, y + 21))
+        return EnvState(pixels=image, package='com.example')
+
+
+class MarkerVLM(FakeVLM):
+    """Clicks the centre of the red marker, like a grounded model behind a server that resizes the images."""
+
+    def __init__(self):
+        super().__init__(latency=0)
+        self.image_sizes = []
+
+    def predict(self, messages, **kwargs):
+        item = next(c for c in messages[-1]['content'] if c['type'] == 'image_url')
+        image = decode(item['image_url']['url']).convert('RGB')
+        size = (item['resized_width'], item['resized_height'])
+        self.image_sizes.append(image.size)
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.BICUBIC)
+        data = image.tobytes()
+        red = [(i % image.width, i // image.width) for i in range(image.width * image.height)
+               if data[3 * i] > 200 and data[3 * i + 1] < 80 and data[3 * i + 2] < 80]
+        x = round(sum(p[0] for p in red) / len(red))
+        y = round(sum(p[1] for p in red) / len(red))
+        response = super().predict(messages, **kwargs)
+        response.choices[0].message.content = CONTENT.replace('[10, 20]', f'[{x}, {y}]')
+        return response
+
+
+def decode(url: str) -> Image.Image:
+    import io
+    import base64
+    return Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1])))
+
+
+class TestSendResizedImages(unittest.TestCase):
+    max_pixels = 1000 * 28 * 28
+
+    def run_step(self, send_resized_images, max_pixels=max_pixels):
+        env, vlm = MarkerEnvironment(), MarkerVLM()
+        agent = MultiAgent(env=env, vlm=vlm, include_time=False,
+                           send_resized_images=send_resized_images, max_pixels=max_pixels)
+        agent.reset(goal='Click the marker')
+        agent.step()
+        return env, vlm
+
+    def test_default_budget_shrinks(self):
+        env, vlm = self.run_step(send_resized_images=True, max_pixels=None)
+        width, height = vlm.image_sizes[0]
+        self.assertLess(width, 1080)
+        self.assertLess(height, 2400)
+        x, y = env.actions[0].parameters['coordinate']
+        self.assertLessEqual(abs(x - env.marker[0]), 1080 / width / 2 + 1)
+        self.assertLessEqual(abs(y - env.marker[1]), 2400 / height / 2 + 1)
+
+    def test_never_upscaled(self):
+        from mobile_use.agents.sub_agent import Operator
+        state = MarkerEnvironment().get_state()
+        operator = Operator()
+        operator.send_resized_images = True
+        # The smart_resize default targets 1092x2408 for a 1080x2400 screen.
+        self.assertEqual(operator.resized_size(state.pixels), (2408, 1092))
+        self.assertIsNone(operator.send_size(state.pixels))
+        self.assertEqual(decode(operator.frame_url(state)).size, (1080, 2400))
+
+    def test_resized_image_sent(self):
+        _, vlm = self.run_step(send_resized_images=True)
+        width, height = vlm.image_sizes[0]
+        self.assertLess(width * height, 1080 * 2400 / 2)
+        _, vlm = self.run_step(send_resized_images=False)
+        self.assertEqual(vlm.image_sizes[0], (1080, 2400))
+
+    def test_coordinates_rescale_exactly(self):
+        env, vlm = self.run_step(send_resized_images=True)
+        width, height = vlm.image_sizes[0]
+        x, y = env.actions[0].parameters['coordinate']
+        # Off by at most half a pixel of the sent image, plus rounding.
+        self.assertLessEqual(abs(x - env.marker[0]), 1080 / width / 2 + 1)
+        self.assertLessEqual(abs(y - env.marker[1]), 2400 / height / 2 + 1)
+
+        # The same action as when the server resizes the full-resolution image.
+        env_full, _ = self.run_step(send_resized_images=False)
+        self.assertEqual(env_full.actions[0].parameters['coordinate'], (x, y))
+
+        # The corners of the sent image map onto the corners of the screen.
+        operator = MultiAgent(env=env, vlm=vlm, include_time=False, max_pixels=self.max_pixels).operator
+        content = CONTENT.replace('[10, 20]', f'[{width}, {height}]')
+        self.assertEqual(operator.parse_response(content, (width, height), (1080, 2400))[1].parameters['coordinate'], (1080, 2400))
+
+    def test_unknown_role(self):
+        with self.assertRaises(ValueError):
+            MultiAgent(env=FakeEnvironment(), vlm=FakeVLM(latency=0), include_time=False, send_resized_images=['Operater'])
@@ -0,0 +1,9 @@
+import struct
+
+
+def make_raw_frame(width, height, rgba, dataspace=True):
+    """A `screencap` raw frame of one color, with or without the dataspace field."""
+    header = struct.pack('<III', width, height, 1)
+    if dataspace:
+        header += struct.pack('<I', 0)
+    return header + bytes(rgba) * (width * height)
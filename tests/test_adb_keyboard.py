@@ -0,0 +1,41 @@
+import unittest
+from mobile_use.environ import AdbKeyboardSession, ADB_KEYBOARD_IME
+
+
+class FakeShellDevice:
+    def __init__(self, default_ime: str):
+        self.default_ime = default_ime
+        self.commands = []
+
+    def shell(self, cmd):
+        self.commands.append(cmd)
+        if isinstance(cmd, list) and cmd[:3] == ["settings", "get", "secure"]:
+            return self.default_ime + "\n"
+        return ""
+
+
+class TestAdbKeyboardSession(unittest.TestCase):
+    def test_switch_once(self):
+        device = FakeShellDevice('com.google.android.inputmethod.latin/.LatinIME')
+        session = AdbKeyboardSession(device)
+        self.assertTrue(session.activate())
+        self.assertFalse(session.activate())
+        self.assertEqual(len(device.commands), 2)
+        session.restore()
+        session.restore()
+        self.assertEqual(len(device.commands), 3)
+        self.assertEqual(
+            device.commands[-1],
+            f"ime set com.google.android.inputmethod.latin/.LatinIME; ime disable {ADB_KEYBOARD_IME}",
+        )
+
+    def test_already_selected(self):
+        device = FakeShellDevice(ADB_KEYBOARD_IME)
+        session = AdbKeyboardSession(device)
+        self.assertFalse(session.activate())
+        session.restore()
+        self.assertEqual(len(device.commands), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
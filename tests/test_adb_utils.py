@@ -0,0 +1,73 @@
+import re
+import unittest
+from mobile_use.adb_utils import (
+    _PATTERN_TO_ACTIVITY, build_installed_app_index, get_adb_activity, get_installed_app_index,
+    get_launch_command,
+)
+
+
+QUERY_OUTPUT = """priority=0 preferredOrder=0 match=0x108000 specificIndex=-1 isDefault=false
+  net.gsantner.markor/.activity.MainActivity
+priority=0 preferredOrder=0 match=0x108000 specificIndex=-1 isDefault=false
+  com.simplemobiletools.smsmessenger/.activities.SplashActivity
+priority=0 preferredOrder=0 match=0x108000 specificIndex=-1 isDefault=false
+  com.example.music/.MainActivity
+priority=0 preferredOrder=0 match=0x108000 specificIndex=-1 isDefault=false
+  org.other.music/.Player
+"""
+
+
+class TestAppResolver(unittest.TestCase):
+    def test_same_as_linear_scan(self):
+        def linear(app_name):
+            for pattern, activity in _PATTERN_TO_ACTIVITY.items():
+                if re.match(pattern.lower(), app_name.lower()):
+                    return activity
+
+        names = [alias for pattern in _PATTERN_TO_ACTIVITY for alias in pattern.split('|')]
+        names += ['Chrome browser', 'Google', 'Docs', 'unknown app']
+        for name in names:
+            self.assertEqual(get_adb_activity(name), linear(name), name)
+
+    def test_installed_app_index(self):
+        index = build_installed_app_index(QUERY_OUTPUT)
+        self.assertEqual(index['markor'], 'net.gsantner.markor/.activity.MainActivity')
+        self.assertEqual(index['netgsantnermarkor'], 'net.gsantner.markor/.activity.MainActivity')
+        # Shared by two packages, not indexed.
+        self.assertNotIn('music', index)
+
+    def test_launch_command(self):
+        index = build_installed_app_index(QUERY_OUTPUT)
+        self.assertEqual(
+            get_launch_command('SMS Messenger', index),
+            ['am', 'start', '-n', 'com.simplemobiletools.smsmessenger/.activities.SplashActivity'],
+        )
+        self.assertEqual(
+            get_launch_command('settings', index),
+            ['am', 'start', '-n', 'com.android.settings/.Settings'],
+        )
+        self.assertEqual(get_launch_command('com.foo.bar'), ['monkey', '-p', 'com.foo.bar', '1'])
+
+    def test_index_per_adb_server(self):
+        import adbutils
+
+        class Device(adbutils.AdbDevice):
+            def __init__(self, port, output):
+                super().__init__(adbutils.AdbClient(host='127.0.0.1', port=port), serial='emulator-5554')
+                self.output = output
+                self.queries = 0
+
+            def shell(self, cmd):
+                self.queries += 1
+                return self.output
+
+        a = Device(5037, QUERY_OUTPUT)
+        b = Device(5038, "package:com.foo.bar\n")
+        self.assertIn('markor', get_installed_app_index(a, refresh=True))
+        self.assertNotIn('markor', get_installed_app_index(b, refresh=True))
+        self.assertIn('markor', get_installed_app_index(a))
+        self.assertEqual(a.queries, 1)
+
+    def test_package_list_fallback(self):
+        index = build_installed_app_index("package:com.foo.bar\npackage:org.baz\n")
+        self.assertEqual(get_launch_command('bar', index), ['monkey', '-p', 'com.foo.bar', '1'])
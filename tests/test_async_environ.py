@@ -0,0 +1,71 @@
+import asyncio
+import unittest
+from adbutils import AdbError
+from mobile_use.scheme import Action
+from mobile_use.async_environ import AsyncAdbDevice, AsyncEnvironment
+from tests.fakes import make_raw_frame
+
+
+class FakeAdbServer:
+    """Speaks the host side of the adb server protocol and answers from a table."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.services = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        while True:
+            length = int(await reader.readexactly(4), 16)
+            service = (await reader.readexactly(length)).decode()
+            self.services.append(service)
+            if service.startswith('host:transport'):
+                writer.write(b'OKAY')
+                continue
+            for prefix, output in self.responses.items():
+                if service.startswith(prefix):
+                    writer.write(b'OKAY' + output)
+                    break
+            else:
+                message = b'unknown service'
+                writer.write(b'FAIL' + b'%04x' % len(message) + message)
+            await writer.drain()
+            writer.close()
+            return
+
+
+class TestAsyncEnvironment(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        probe = b"  mCurrentFocus=Window{5d7e2e1 u0 com.android.settings/com.android.settings.Settings}\n"
+        self.server = FakeAdbServer({
+            'shell:wm size': b'Physical size: 1080x2400\n',
+            'exec:': probe + b'--mobile-use-frame--\n' + make_raw_frame(4, 2, [7, 8, 9, 255]),
+            'shell:': b'',
+        })
+        self.port = await self.server.start()
+
+    async def asyncTearDown(self):
+        self.server.server.close()
+        await self.server.server.wait_closed()
+
+    async def test_shell_fail(self):
+        device = AsyncAdbDevice('fake', port=self.port)
+        self.server.responses = {}
+        with self.assertRaisesRegex(AdbError, 'unknown service'):
+            await device.shell('echo')
+
+    async def test_get_state(self):
+        env = await AsyncEnvironment.create('fake', port=self.port)
+        self.assertEqual(env.window_size, (1080, 2400))
+        states = await asyncio.gather(env.get_state(), env.get_state())
+        for state in states:
+            self.assertEqual(state.package, 'com.android.settings')
+            self.assertEqual(state.pixels.getpixel((0, 0)), (7, 8, 9))
+
+    async def test_execute_action(self):
+        env = await AsyncEnvironment.create('fake', port=self.port, go_home=False, wait_after_action_seconds=0)
+        await env.execute_action(Action(name='click', parameters={'coordinate': [12, 34]}))
+        self.assertIn("shell:input tap 12 34", self.server.services)
@@ -0,0 +1,118 @@
+import io
+import struct
+import unittest
+from mobile_use.capture import (
+    ScreenCapture, StreamCapture, RawScreencapCapture,
+    decode_raw_screencap, parse_raw_header, parse_focused_package,
+)
+from tests.fakes import make_raw_frame
+
+
+class FakeConnection:
+    def __init__(self, data: bytes):
+        self._buf = io.BytesIO(data)
+        self.conn = self
+
+    def settimeout(self, timeout):
+        pass
+
+    def send_command(self, cmd):
+        pass
+
+    def check_okay(self):
+        pass
+
+    def read_until_close(self, encoding=None):
+        return self._buf.read()
+
+    def read_exact(self, n):
+        data = self._buf.read(n)
+        if len(data) < n:
+            raise EOFError(f"Expected {n} bytes, got {len(data)}")
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeDevice:
+    serial = 'fake'
+
+    def __init__(self, probe: bytes, stream: bytes):
+        self._conns = [FakeConnection(probe), FakeConnection(stream)]
+
+    def open_transport(self):
+        return self._conns.pop(0)
+
+
+class TestRawScreencap(unittest.TestCase):
+    def test_header_with_dataspace(self):
+        data = make_raw_frame(3, 5, [1, 2, 3, 4])
+        self.assertEqual(parse_raw_header(data), (3, 5, 1, 16))
+
+    def test_header_without_dataspace(self):
+        data = make_raw_frame(3, 5, [1, 2, 3, 4], dataspace=False)
+        self.assertEqual(parse_raw_header(data), (3, 5, 1, 12))
+
+    def test_decode_rgba(self):
+        image = decode_raw_screencap(make_raw_frame(3, 5, [1, 2, 3, 4]))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(image.size, (3, 5))
+        self.assertEqual(image.getpixel((2, 4)), (1, 2, 3))
+
+    def test_decode_rgb565(self):
+        data = struct.pack('<IIII', 2, 1, 4, 0) + bytes([0x00, 0xF8]) * 2
+        image = decode_raw_screencap(data)
+        self.assertEqual(image.getpixel((1, 0)), (255, 0, 0))
+
+    def test_raw_backend(self):
+        device = FakeDevice(make_raw_frame(4, 2, [7, 8, 9, 255]), b'')
+        capture = RawScreencapCapture(device, display_id=None)
+        self.assertEqual(capture.capture().getpixel((0, 0)), (7, 8, 9))
+
+
+class TestStateQuery(unittest.TestCase):
+    def test_focused_window(self):
+        output = "  mCurrentFocus=Window{5d7e2e1 u0 com.android.settings/com.android.settings.Settings}\n"
+        self.assertEqual(parse_focused_package(output), 'com.android.settings')
+
+    def test_focused_app_fallback(self):
+        output = (
+            "  mCurrentFocus=Window{8a1b2c3 u0 NotificationShade}\n"
+            "  mFocusedApp=ActivityRecord{4e3f1a2 u0 com.google.android.apps.maps/.MapsActivity t12}\n"
+        )
+        self.assertEqual(parse_focused_package(output), 'com.google.android.apps.maps')
+
+    def test_no_focus(self):
+        self.assertIsNone(parse_focused_package("  mCurrentFocus=null\n"))
+
+    def test_raw_backend_state(self):
+        probe = b"  mCurrentFocus=Window{5d7e2e1 u0 com.android.chrome/org.chromium.chrome.browser.ChromeTabbedActivity}\n"
+        data = probe + b"--mobile-use-frame--\n" + make_raw_frame(4, 2, [7, 8, 9, 255])
+        capture = RawScreencapCapture(FakeDevice(data, b''), display_id=None)
+        image, package = capture.capture_state()
+        self.assertEqual(package, 'com.android.chrome')
+        self.assertEqual(image.size, (4, 2))
+        self.assertEqual(image.getpixel((3, 1)), (7, 8, 9))
+
+
+class TestStreamCapture(unittest.TestCase):
+    def test_registered(self):
+        self.assertIs(ScreenCapture.by_name('stream'), StreamCapture)
+
+    def test_latest_frame(self):
+        probe = make_raw_frame(4, 2, [0, 0, 0, 255])
+        stream = make_raw_frame(4, 2, [10, 20, 30, 255]) + make_raw_frame(4, 2, [40, 50, 60, 255])
+        capture = StreamCapture(FakeDevice(probe, stream), display_id=None, timeout=1.0)
+        capture._thread.join(timeout=1.0)
+        frame = capture.capture()
+        self.assertEqual(frame.mode, 'RGB')
+        self.assertEqual(frame.size, (4, 2))
+        self.assertEqual(frame.getpixel((3, 1)), (40, 50, 60))
+        capture.close()
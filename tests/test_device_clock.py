@@ -0,0 +1,37 @@
+import time
+import unittest
+from mobile_use.device_clock import DeviceClock
+
+
+class TestDeviceClock(unittest.TestCase):
+    def test_format(self):
+        clock = DeviceClock()
+        now = time.time()
+        # Device is one hour ahead of the host.
+        clock.update(f"{int(now) + 3600}\n+0800\nCST\n", now, now)
+        d = clock.now()
+        self.assertAlmostEqual(d.timestamp(), now + 3600, delta=1.5)
+        self.assertEqual(d.utcoffset().total_seconds(), 8 * 3600)
+        parts = clock.format().split()
+        self.assertEqual(len(parts), 6)
+        self.assertEqual(parts[4], 'CST')
+        self.assertEqual(parts[5], str(d.year))
+
+    def test_padded_day(self):
+        clock = DeviceClock()
+        # 2026-03-05 04:06:07 UTC
+        clock.update("1772683567\n+0000\nGMT\n", time.time(), time.time())
+        clock._offset = 1772683567.5 - time.time()
+        self.assertEqual(clock.format(), "Thu Mar  5 04:06:07 GMT 2026")
+
+    def test_refresh(self):
+        clock = DeviceClock(refresh_seconds=None)
+        self.assertTrue(clock.needs_refresh())
+        clock.update("1772683567\n-0530\n\n", time.time(), time.time())
+        self.assertFalse(clock.needs_refresh())
+        clock.invalidate()
+        self.assertTrue(clock.needs_refresh())
+
+    def test_bad_output(self):
+        with self.assertRaises(ValueError):
+            DeviceClock().update("date: bad format", 0, 0)
@@ -0,0 +1,78 @@
+import threading
+import unittest
+from mobile_use.device_pool import DevicePool
+
+
+class FakeEnvironment:
+    def __init__(self, serial_no, host, port, fail_reset=False):
+        self.serial_no = serial_no
+        self.fail_reset = fail_reset
+        self.resets = 0
+        self.closed = False
+
+    def reset(self, go_home=True):
+        if self.fail_reset:
+            raise RuntimeError("device offline")
+        self.resets += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(DevicePool):
+    def __init__(self, serials, unhealthy=(), **kwargs):
+        self._fake_serials = serials
+        self._unhealthy = set(unhealthy)
+        super().__init__(environment_cls=FakeEnvironment, **kwargs)
+
+    def discover(self):
+        return [("127.0.0.1", 5037, s) for s in self._fake_serials]
+
+    def check_health(self, key):
+        return key[2] not in self._unhealthy
+
+
+class TestDevicePool(unittest.TestCase):
+    def test_health_check(self):
+        pool = FakePool(['emulator-5554', 'emulator-5556'], unhealthy=['emulator-5556'])
+        self.assertEqual(len(pool), 1)
+
+    def test_lease_and_return(self):
+        pool = FakePool(['emulator-5554'])
+        with pool.lease() as env:
+            self.assertEqual(env.serial_no, 'emulator-5554')
+            self.assertEqual(pool.available, 0)
+            with self.assertRaises(TimeoutError):
+                with pool.lease(timeout=0.05):
+                    pass
+        self.assertEqual(env.resets, 1)
+        self.assertEqual(pool.available, 1)
+        with pool.lease() as env2:
+            self.assertIs(env2, env)
+
+    def test_concurrent_leases(self):
+        pool = FakePool(['emulator-5554', 'emulator-5556'])
+        leased, lock = [], threading.Lock()
+
+        def worker():
+            with pool.lease(timeout=5) as env:
+                with lock:
+                    leased.append(env.serial_no)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(leased), 8)
+        self.assertEqual(pool.available, 2)
+
+    def test_drop_on_failed_reset(self):
+        pool = FakePool(['emulator-5554'], env_kwargs=dict(fail_reset=True))
+        with pool.lease() as env:
+            pass
+        self.assertTrue(env.closed)
+        self.assertEqual(len(pool), 0)
+        with self.assertRaises(RuntimeError):
+            with pool.lease():
+                pass
@@ -0,0 +1,153 @@
+import tempfile
+import unittest
+from PIL import Image
+from mobile_use.scheme import EnvState
+from mobile_use.vlm import VLMWrapper
+from mobile_use.vlm_cache import VLMCache
+from mobile_use.mock_vlm import MockVLMServer, parse_latency
+from mobile_use.agents.multi_agent import MultiAgent
+
+
+MESSAGES = [{'role': 'user', 'content': [{'type': 'text', 'text': 'who are you?'}]}]
+
+
+class StaticEnvironment:
+    last_settle_duration = 0.0
+
+    def __init__(self):
+        self.actions = []
+
+    def get_state(self):
+        return EnvState(pixels=Image.new('RGB', (108, 240), (255, 255, 255)), package='com.example')
+
+    def execute_action(self, action):
+        self.actions.append(action)
+
+
+class TestMockVLMServer(unittest.TestCase):
+    def make_vlm(self, server, **kwargs):
+        return VLMWrapper(model_name='mock', api_key='EMPTY', base_url=server.base_url, share_client=False, **kwargs)
+
+    def test_scripted(self):
+        with MockVLMServer(responses=['first', 'second Summary: x']) as server:
+            vlm = self.make_vlm(server)
+            self.assertEqual(vlm.predict(MESSAGES).choices[0].message.content, 'first')
+            response = vlm.predict(MESSAGES, stop=['Summary'], logprobs=True)
+            self.assertEqual(response.choices[0].message.content, 'second ')
+            self.assertEqual([lp.token for lp in response.choices[0].logprobs.content], ['second', ' '])
+            self.assertEqual(server.num_requests, 2)
+
+    def test_rules_and_stream(self):
+        rules = [('Reflector', 'reflection'), ('who are you', 'a mock')]
+        with MockVLMServer(rules=rules) as server:
+            vlm = self.make_vlm(server)
+            stream = vlm.predict(MESSAGES, stream=True)
+            self.assertEqual(''.join(chunk.choices[0].delta.content or '' for chunk in stream), 'a mock')
+            response = vlm.predict_until(MESSAGES, lambda delta: delta == 'a')
+            self.assertEqual(response.choices[0].message.content, 'a')
+
+    def test_error_injection(self):
+        with MockVLMServer(responses=['ok'], error_rate=1.0, error_status=503) as server:
+            vlm = self.make_vlm(server, max_retry=2, retry_waiting_seconds=0)
+            vlm.client = vlm.client.with_options(max_retries=0)
+            with self.assertRaises(Exception):
+                vlm.predict(MESSAGES)
+            self.assertEqual(server.num_errors, 2)
+
+    def test_replay_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with MockVLMServer(responses=['recorded']) as server:
+                self.make_vlm(server, cache=VLMCache(cache_dir)).predict(MESSAGES)
+            with MockVLMServer(responses=['live'], cache=VLMCache(cache_dir, mode='read_only')) as server:
+                vlm = self.make_vlm(server)
+                self.assertEqual(vlm.predict(MESSAGES).choices[0].message.content, 'recorded')
+                other = [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}]
+                self.assertEqual(vlm.predict(other).choices[0].message.content, 'live')
+
+    def test_latency(self):
+        import random
+        rng = random.Random(0)
+        self.assertEqual(parse_latency('0.5'), 0.5)
+        self.assertTrue(all(1 <= parse_latency('uniform:1,2')(rng) <= 2 for _ in range(10)))
+        with self.assertRaises(ValueError):
+            parse_latency('gamma:1')
+
+    def test_multi_agent_offline(self):
+        operator = '''Thought: Done.
+Action: Finish the task.
+{"name": "mobile_use", "arguments": {"action": "terminate", "status": "success"}}'''
+        answer = '{"name": "mobile_use", "arguments": {"action": "answer", "text": "42"}}'
+        rules = [('provide an answer to the user query', answer), ('operating mobile phones', operator)]
+        with MockVLMServer(rules=rules) as server:
+            agent = MultiAgent(env=StaticEnvironment(), vlm=self.make_vlm(server), include_time=False, reflect_on_demand=True)
+            episode = agent.run('What is the answer?')
+        self.assertEqual(len(episode.trajectory), 1)
+        self.assertEqual(episode.trajectory[0].action.name, 'terminate')
+        self.assertEqual(episode.trajectory[0].answer, '42')
+
+
+class TestVLMCallStats(unittest.TestCase):
+    def test_multi_agent_roles(self):
+        content = '''Thought: Open the app.
+Action: Click the icon.
+{"name": "mobile_use", "arguments": {"action": "click", "coordinate": [10, 20]}}
+### Outcome ###
+A
+### Error Description ###
+None
+### Completed contents ###
+Opened the app.'''
+        with MockVLMServer(responses=[content], latency=0.01) as server:
+            vlm = VLMWrapper(model_name='mock', api_key='EMPTY', base_url=server.base_url, share_client=False,
+                             continuous_usage_stats=True)
+            agent = MultiAgent(env=StaticEnvironment(), vlm=vlm, include_time=False, use_reflector=True,
+                               use_processor=True, stream_operator=True)
+            agent.reset(goal='Open the app')
+            agent.step()
+        calls = agent.trajectory[0].vlm_call_stats
+        self.assertEqual([c.role for c in calls], ['Operator', 'Reflector', 'Processor'])
+        operator, reflector, _ = calls
+        # Only streamed calls know their time to first token.
+        self.assertIsNotNone(operator.ttft)
+        self.assertIsNone(reflector.ttft)
+        self.assertEqual(operator.num_images, 1)
+        self.assertEqual(reflector.num_images, 2)
+        # The Operator stream is stopped early, its usage comes from the last chunk read.
+        self.assertGreater(operator.prompt_tokens, 0)
+        self.assertGreater(operator.completion_tokens, 0)
+        self.assertGreater(reflector.prompt_tokens, 0)
+        self.assertGreater(reflector.completion_tokens, 0)
+        self.assertGreater(reflector.request_bytes, 1000)
+        self.assertGreaterEqual(reflector.latency, 0.01)
+
+        summary = agent.episode_data.vlm_call_summary()
+        self.assertEqual(set(summary), {'Operator', 'Reflector', 'Processor'})
+        self.assertEqual(summary['Reflector']['calls'], 1)
+        self.assertIsNone(summary['Reflector']['mean_ttft'])
+        self.assertEqual(summary['Operator']['mean_ttft'], operator.ttft)
+
+    def test_stream_usage(self):
+        with MockVLMServer(responses=['one two three'], latency=0.0) as server:
+            vlm = VLMWrapper(model_name='mock', api_key='EMPTY', base_url=server.base_url, share_client=False)
+            stats = []
+            vlm.predict_until(MESSAGES, lambda delta: False, role='Operator', call_stats=stats)
+        # Read to the end, the usage is in the last chunk.
+        self.assertGreater(stats[0].prompt_tokens, 0)
+        self.assertEqual(stats[0].completion_tokens, 5)
+
+    def test_request_bytes(self):
+        url = 'data:image/png;base64,' + 'A' * 1000
+        messages = [
+            {'role': 'system', 'content': 'ab'},
+            {'role': 'user', 'content': [{'type': 'text', 'text': '点击'}, {'type': 'image_url', 'image_url': {'url': url}}]},
+        ]
+        with MockVLMServer(responses=['ok'], latency=0.0) as server:
+            vlm = VLMWrapper(model_name='mock', api_key='EMPTY', base_url=server.base_url, share_client=False)
+            stats = []
+            vlm.predict(messages, call_stats=stats)
+        self.assertEqual(stats[0].num_images, 1)
+        self.assertEqual(stats[0].request_bytes, 2 + 6 + len(url))
+
+
+if __name__ == '__main__':
+    unittest.main()
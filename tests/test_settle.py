@@ -0,0 +1,95 @@
+import time
+import unittest
+from unittest import mock
+from mobile_use.scheme import Action
+from mobile_use.environ import Environment
+
+
+class FakeDevice:
+    def __init__(self):
+        self.clicks = []
+
+    def window_size(self, landscape=False):
+        return (1080, 2400)
+
+    def click(self, x, y):
+        self.clicks.append((x, y))
+
+    def shell(self, cmd):
+        return ""
+
+
+class FakeCapture:
+    """Returns the scripted screen signatures in turn, the last one repeats."""
+
+    def __init__(self, signatures):
+        self.signatures = list(signatures)
+        self.samples = 0
+
+    def signature(self):
+        signature = self.signatures[min(self.samples, len(self.signatures) - 1)]
+        self.samples += 1
+        if isinstance(signature, Exception):
+            raise signature
+        return signature
+
+    def invalidate(self):
+        pass
+
+
+def make_env(signatures, **kwargs) -> Environment:
+    capture = FakeCapture(signatures)
+    with mock.patch.object(Environment, '_setup_device', return_value=FakeDevice()), \
+            mock.patch('mobile_use.environ.ScreenCapture.by_name', return_value=lambda device: capture):
+        kwargs.setdefault('settle_mode', 'adaptive')
+        return Environment(go_home=False, **kwargs)
+
+
+class TestAdaptiveSettle(unittest.TestCase):
+    def test_early_exit(self):
+        env = make_env(['a', 'b', 'b'], wait_after_action_seconds=5.0, settle_min_seconds=0.0,
+                       settle_interval_seconds=0.01)
+        env.execute_action(Action(name='click', parameters={'coordinate': (10, 20)}))
+        self.assertEqual(env._d.clicks, [(10, 20)])
+        self.assertEqual(env._capture.samples, 3)
+        self.assertLess(env.last_settle_duration, 1.0)
+
+    def test_max_seconds(self):
+        # The screen keeps changing, e.g. an animation.
+        env = make_env([str(i) for i in range(1000)], settle_min_seconds=0.0, settle_max_seconds=0.2,
+                       settle_interval_seconds=0.02)
+        duration = env._wait_for_settle()
+        self.assertGreaterEqual(duration, 0.2)
+        self.assertLess(duration, 0.5)
+        self.assertGreater(env._capture.samples, 2)
+
+    def test_signature_failure(self):
+        # Without a signature, the whole fixed wait is spent.
+        env = make_env([RuntimeError('no screen')], wait_after_action_seconds=0.3, settle_min_seconds=0.0,
+                       settle_interval_seconds=0.01)
+        start = time.time()
+        duration = env._wait_for_settle()
+        self.assertGreaterEqual(duration, 0.3)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(env._capture.samples, 1)
+
+    def test_take_note(self):
+        # A note does not touch the screen, the previous action's settle time is not carried over.
+        env = make_env(['a', 'a'], settle_min_seconds=0.0, settle_interval_seconds=0.01)
+        env.execute_action(Action(name='click', parameters={'coordinate': (10, 20)}))
+        self.assertGreater(env.last_settle_duration, 0.0)
+        self.assertEqual(env.execute_action(Action(name='take_note', parameters={'text': 'note'})), 'note')
+        self.assertEqual(env.last_settle_duration, 0.0)
+
+    def test_unknown_mode(self):
+        # Rejected before the device is connected and pressed HOME.
+        with mock.patch.object(Environment, '_setup_device') as setup_device:
+            with self.assertRaises(ValueError):
+                Environment(settle_mode='sometimes')
+            with self.assertRaises(ValueError):
+                Environment(settle_mode='adaptive', settle_stable_samples=0)
+        setup_device.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
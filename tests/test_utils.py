@@ -0,0 +1,154 @@
+import io
+import base64
+import unittest
+import numpy as np
+from PIL import Image
+from mobile_use.utils import ImageCodec, encode_image_url, diff_image, diff_image_fast, dhash
+from mobile_use.agents.sub_agent import Operator, Reflector, apply_image_codecs
+
+
+def decode(url: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1])))
+
+
+class TestImageCodec(unittest.TestCase):
+    def setUp(self):
+        self.image = Image.new('RGBA', (108, 240), (10, 200, 30, 255))
+
+    def test_default_png(self):
+        url = encode_image_url(self.image)
+        self.assertTrue(url.startswith('data:image/png;base64,'))
+        self.assertEqual(decode(url).tobytes(), self.image.tobytes())
+        self.assertEqual(url, encode_image_url(self.image, codec=ImageCodec()))
+
+    def test_formats(self):
+        for fmt, mime in [('jpeg', 'image/jpeg'), ('jpg', 'image/jpeg'), ('webp', 'image/webp')]:
+            url = encode_image_url(self.image, codec=ImageCodec(fmt, quality=80, subsampling=2 if fmt != 'webp' else None))
+            self.assertTrue(url.startswith(f'data:{mime};base64,'))
+            self.assertEqual(decode(url).size, self.image.size)
+        with self.assertRaises(ValueError):
+            ImageCodec('gif')
+
+    def test_apply_image_codecs(self):
+        operator, reflector = Operator(), Reflector()
+        apply_image_codecs({'Operator': operator, 'Reflector': reflector},
+                           {'Operator': {'format': 'jpeg', 'quality': 90}, 'default': 'webp'})
+        self.assertEqual(operator.image_codec, ImageCodec('jpeg', quality=90))
+        self.assertEqual(reflector.image_codec, ImageCodec('webp'))
+        with self.assertRaises(ValueError):
+            apply_image_codecs({'Operator': operator}, {'Operater': 'jpeg'})
+
+
+class TestEnvStateImageUrl(unittest.TestCase):
+    def test_memo(self):
+        import pickle
+        from unittest import mock
+        from mobile_use.scheme import EnvState
+        state = EnvState(pixels=Image.new('RGB', (108, 240), (255, 255, 255)), package='com.example')
+        with mock.patch('mobile_use.scheme.encode_image_url', wraps=encode_image_url) as encode:
+            png = state.image_url()
+            self.assertIs(state.image_url(), png)
+            self.assertIs(state.image_url(ImageCodec()), state.image_url(ImageCodec()))
+            jpeg = state.image_url(ImageCodec('jpeg'))
+            self.assertTrue(jpeg.startswith('data:image/jpeg'))
+            self.assertEqual(encode.call_count, 3)
+        self.assertEqual(png, encode_image_url(state.pixels))
+        self.assertEqual(state, EnvState(pixels=state.pixels, package='com.example'))
+
+        small = state.resized((54, 120))
+        self.assertIs(state.resized((54, 120)), small)
+        self.assertIs(state.resized(state.pixels.size), state.pixels)
+        self.assertEqual(decode(state.image_url(size=(54, 120))).size, (54, 120))
+
+        restored = pickle.loads(pickle.dumps(state))
+        self.assertEqual(restored._image_urls, {})
+        self.assertEqual(restored._resized, {})
+        self.assertEqual(restored.image_url(), png)
+
+
+class TestDiffImage(unittest.TestCase):
+    def setUp(self):
+        from PIL import ImageDraw
+        self.before = Image.new('RGB', (1080, 2400), (240, 240, 240))
+        self.after = self.before.copy()
+        ImageDraw.Draw(self.after).rectangle((300, 800, 599, 879), fill=(30, 120, 220))
+
+    def highlighted(self, images):
+        ys, xs = np.nonzero(np.any(np.asarray(images[1]) != np.asarray(self.after), axis=2))
+        return xs.min(), ys.min(), xs.max(), ys.max()
+
+    def test_fast_path_matches(self):
+        expected = self.highlighted(diff_image(self.before, self.after))
+        actual = self.highlighted(diff_image_fast(self.before, self.after, level=2))
+        for e, a in zip(expected, actual):
+            self.assertLessEqual(abs(int(e) - int(a)), 4)
+        self.assertEqual(diff_image_fast(self.before, self.before.copy()), (None, None))
+        self.assertEqual(diff_image_fast(self.before, Image.new('RGB', (1080, 2400))), (None, None))
+
+    def test_reflector_reuses_env_states(self):
+        from unittest import mock
+        from mobile_use.scheme import EnvState
+        reflector = Reflector(fast_diff=True)
+        before = EnvState(pixels=self.before, package='com.example')
+        after = EnvState(pixels=self.after, package='com.example')
+        self.assertIsNotNone(reflector.diff(before, after)[0])
+        self.assertIn(2, before._gray)
+        with mock.patch('mobile_use.scheme.grayscale') as gray, mock.patch('mobile_use.agents.sub_agent.diff_image_fast') as diff:
+            reflector.diff(before, after)
+            self.assertEqual(gray.call_count, 0)
+            self.assertIs(diff.call_args.kwargs['gray1'], before._gray[2])
+            same = EnvState(pixels=self.before.copy(), package='com.example')
+            self.assertEqual(reflector.diff(before, same), (None, None))
+            self.assertEqual(diff.call_count, 1)
+
+
+class TestNearDuplicate(unittest.TestCase):
+    def setUp(self):
+        from PIL import ImageDraw
+        from mobile_use.scheme import EnvState
+        image = Image.new('RGB', (1080, 2400), (250, 250, 250))
+        draw = ImageDraw.Draw(image)
+        for i in range(8):
+            draw.rectangle((60, 200 + 260 * i, 1020, 400 + 260 * i), fill=(40 + 25 * i, 90, 200 - 20 * i))
+        clock = image.copy()
+        ImageDraw.Draw(clock).text((50, 20), "12:35", fill=(0, 0, 0), font_size=40)
+        self.state = EnvState(pixels=image, package='com.example')
+        self.same = EnvState(pixels=image.copy(), package='com.example')
+        self.clock = EnvState(pixels=clock, package='com.example')
+        other = Image.new('RGB', (1080, 2400), (250, 250, 250))
+        for i in range(4):
+            ImageDraw.Draw(other).rectangle((40 + 260 * i, 200, 240 + 260 * i, 2200), fill=(40 + 50 * i, 90, 200))
+        self.other = EnvState(pixels=other, package='com.example')
+
+    def test_near_duplicate(self):
+        self.assertTrue(self.state.near_duplicate(self.same))
+        self.assertFalse(self.state.near_duplicate(self.clock))
+        self.assertTrue(self.state.near_duplicate(self.clock, threshold=4))
+        self.assertFalse(self.state.near_duplicate(self.other, threshold=4))
+
+    def test_gray_cache(self):
+        self.assertEqual(self.state.gray(0).shape, (2400, 1080))
+        self.assertIs(self.state.gray(2), self.state.gray(2))
+        # The full-resolution level is not kept on the state.
+        self.assertEqual(list(self.state._gray), [2])
+
+    def test_long_reflector_detect(self):
+        import pickle
+        from unittest import mock
+        from mobile_use.scheme import EpisodeData, StepData
+        from mobile_use.agents.sub_agent import LongReflector
+        states = [self.state, self.clock, self.same]
+        trajectory = [StepData(step_idx=i, curr_env_state=s, exec_env_state=s) for i, s in enumerate(states)]
+        episode = EpisodeData(goal='', num_steps=3, trajectory=trajectory)
+        self.assertNotIn('screen', LongReflector().detect(episode))
+        with mock.patch('mobile_use.scheme.dhash', wraps=dhash) as hash_fn:
+            reflector = LongReflector(screen_hash_threshold=4)
+            self.assertIn('screen has kept unchanged', reflector.detect(episode))
+            reflector.detect(episode)
+            # One fingerprint per state, not per comparison.
+            self.assertEqual(hash_fn.call_count, 2)
+        self.assertEqual(pickle.loads(pickle.dumps(self.clock)).dhash, self.clock.dhash)
+
+
+if __name__ == '__main__':
+    unittest.main()
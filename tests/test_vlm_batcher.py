@@ -0,0 +1,142 @@
+import time
+import asyncio
+import threading
+import unittest
+from mobile_use.scheme import VLMCallStats
+from mobile_use.vlm_batcher import VLMBatcher, _request_key
+
+
+class FakeVLM:
+    model_name = 'model'
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    def predict(self, messages, stream=False, **kwargs):
+        return ('stream' if stream else 'response', messages)
+
+    async def apredict(self, messages, role=None, call_stats=None, **kwargs):
+        if messages == 'error':
+            raise ValueError('bad request')
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        if call_stats is not None:
+            call_stats.append(VLMCallStats(role=role, latency=self.delay))
+        return ('response', messages)
+
+
+class TestVLMBatcher(unittest.TestCase):
+    def test_coalesce(self):
+        vlm = FakeVLM()
+        with VLMBatcher(vlm, window_seconds=0.1, max_batch_size=8) as batcher:
+            futures = [batcher.submit(i) for i in range(5)]
+            self.assertEqual([f.result() for f in futures], [('response', i) for i in range(5)])
+            self.assertEqual(batcher.num_batches, 1)
+            self.assertEqual(batcher.mean_batch_size, 5)
+        self.assertEqual(vlm.max_in_flight, 5)
+
+    def test_max_batch_size(self):
+        with VLMBatcher(FakeVLM(), window_seconds=1.0, max_batch_size=2) as batcher:
+            start = time.time()
+            self.assertEqual(len(batcher.predict_many(list(range(4)))), 4)
+            # Full batches are dispatched without waiting for the window.
+            self.assertLess(time.time() - start, 1.0)
+            self.assertEqual(batcher.num_batches, 2)
+
+    def test_concurrent_callers(self):
+        results = {}
+        with VLMBatcher(FakeVLM(), window_seconds=0.05) as batcher:
+            def run(i):
+                results[i] = batcher.predict(i)
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(results, {i: ('response', i) for i in range(4)})
+
+    def test_error_and_stream(self):
+        with VLMBatcher(FakeVLM(), window_seconds=0.0) as batcher:
+            with self.assertRaises(ValueError):
+                batcher.predict('error')
+            self.assertEqual(batcher.predict('x', stream=True), ('stream', 'x'))
+            self.assertEqual(batcher.model_name, 'model')
+        with self.assertRaises(RuntimeError):
+            batcher.submit('x')
+
+    def test_identical_requests(self):
+        vlm = FakeVLM()
+        stats_a, stats_b = [], []
+        with VLMBatcher(vlm, window_seconds=0.1) as batcher:
+            futures = [
+                batcher.submit('same', role='Operator', call_stats=stats_a),
+                batcher.submit('same', role='SpeculativeOperator', call_stats=stats_b),
+                batcher.submit('other'),
+            ]
+            self.assertEqual([f.result() for f in futures], [('response', 'same'), ('response', 'same'), ('response', 'other')])
+        self.assertEqual(vlm.calls, 2)
+        self.assertEqual(batcher.num_sent, 2)
+        self.assertFalse(stats_a[0].cached)
+        self.assertEqual((stats_b[0].role, stats_b[0].cached), ('SpeculativeOperator', True))
+
+    def test_sampled_requests(self):
+        # Callers sampling with a temperature expect independent samples.
+        vlm = FakeVLM()
+        vlm.temperature = 0.7
+        with VLMBatcher(vlm, window_seconds=0.1) as batcher:
+            futures = [batcher.submit('same'), batcher.submit('same')]
+            self.assertEqual([f.result() for f in futures], [('response', 'same')] * 2)
+        self.assertEqual(vlm.calls, 2)
+
+    def test_request_key(self):
+        def messages(url, text='click'):
+            return [{'role': 'system', 'content': 'You are an agent.'},
+                    {'role': 'user', 'content': [{'type': 'text', 'text': text}, {'type': 'image_url', 'image_url': {'url': url}}]}]
+        key = _request_key(messages('data:image/png;base64,AAAA'), {'role': 'Operator'})
+        self.assertEqual(key, _request_key(messages('data:image/png;base64,AAAA'), {'role': 'Planner', 'call_stats': []}))
+        self.assertNotEqual(key, _request_key(messages('data:image/png;base64,AAAB'), {}))
+        self.assertNotEqual(key, _request_key(messages('data:image/png;base64,AAAA', 'swipe'), {}))
+        self.assertNotEqual(key, _request_key(messages('data:image/png;base64,AAAA'), {'max_tokens': 8}))
+
+    def test_close_drains(self):
+        batcher = VLMBatcher(FakeVLM(), window_seconds=10.0)
+        future = batcher.submit('x')
+        batcher.close()
+        self.assertEqual(future.result(timeout=1), ('response', 'x'))
+
+    def test_concurrency_limit(self):
+        vlm = FakeVLM()
+        with VLMBatcher(vlm, window_seconds=0.05, max_concurrency=2) as batcher:
+            batcher.predict_many(list(range(6)))
+        self.assertEqual(vlm.max_in_flight, 2)
+
+    def test_submit_while_closing(self):
+        batcher = VLMBatcher(FakeVLM(delay=0.0), window_seconds=0.001)
+        futures, stop = [], threading.Event()
+
+        def run():
+            while not stop.is_set():
+                try:
+                    futures.append(batcher.submit('x'))
+                except RuntimeError:
+                    return
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        batcher.close()
+        stop.set()
+        for t in threads:
+            t.join()
+        # Every accepted request is answered, none is left hanging.
+        self.assertTrue(all(f.result(timeout=1) == ('response', 'x') for f in futures))
+
+
+if __name__ == '__main__':
+    unittest.main()
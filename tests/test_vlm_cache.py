@@ -0,0 +1,101 @@
+import os
+import time
+import tempfile
+import unittest
+from PIL import Image
+from openai.types.chat import ChatCompletion
+from mobile_use.utils import encode_image_url
+from mobile_use.vlm import VLMWrapper
+from mobile_use.vlm_cache import VLMCache
+
+
+def make_response(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        'id': 'chatcmpl-1',
+        'object': 'chat.completion',
+        'created': 0,
+        'model': 'qwen2.5-vl-72b-instruct',
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'stop',
+            'message': {'role': 'assistant', 'content': content},
+        }],
+    })
+
+
+def make_messages(image: Image.Image, text: str = 'What is on the screen?'):
+    return [{
+        'role': 'user',
+        'content': [
+            {'type': 'text', 'text': text},
+            {'type': 'image_url', 'image_url': {'url': encode_image_url(image)}},
+        ],
+    }]
+
+
+class TestVLMCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image = Image.new('RGB', (16, 16), (10, 20, 30))
+        self.params = {'max_tokens': 128, 'temperature': 0.0}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        cache = VLMCache(self.tmp.name)
+        key = cache.key('model', self.params, make_messages(self.image))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, make_response('hello'))
+        response = VLMCache(self.tmp.name).get(key)
+        self.assertEqual(response.choices[0].message.content, 'hello')
+
+    def test_image_hashed_by_pixels(self):
+        cache = VLMCache(self.tmp.name)
+        png = make_messages(self.image)
+        rgba = make_messages(self.image)
+        rgba[0]['content'][1]['image_url']['url'] = encode_image_url(self.image.convert('RGBA'))
+        self.assertNotEqual(png[0]['content'][1]['image_url']['url'], rgba[0]['content'][1]['image_url']['url'])
+        self.assertNotEqual(cache.key('model', self.params, png), cache.key('model', self.params, rgba))
+        other = make_messages(self.image.copy())
+        self.assertEqual(cache.key('model', self.params, png), cache.key('model', self.params, other))
+        self.assertNotEqual(cache.key('model', self.params, png), cache.key('model', self.params, make_messages(self.image, 'x')))
+
+    def test_modes(self):
+        cache = VLMCache(self.tmp.name, mode='read_only')
+        key = cache.key('model', self.params, make_messages(self.image))
+        cache.put(key, make_response('hello'))
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(VLMCache(self.tmp.name, mode='bypass').key('model', self.params, make_messages(self.image)))
+        self.assertIsNone(cache.key('model', {'temperature': 0.7}, make_messages(self.image)))
+        with self.assertRaises(ValueError):
+            VLMCache(self.tmp.name, mode='write_only')
+
+    def test_lru_eviction(self):
+        entry_size = len(make_response('x' * 1000).model_dump_json())
+        cache = VLMCache(self.tmp.name, max_size_bytes=entry_size * 3)
+        keys = [cache.key('model', self.params, make_messages(self.image, str(i))) for i in range(4)]
+        for i, key in enumerate(keys[:3]):
+            cache.put(key, make_response('x' * 1000))
+            os.utime(cache._path(key), (time.time() - 100 + i, time.time() - 100 + i))
+        # Touch the oldest one, the second becomes the least recently used.
+        self.assertIsNotNone(cache.get(keys[0]))
+        cache.put(keys[3], make_response('x' * 1000))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[3]))
+
+    def test_vlm_wrapper(self):
+        calls = []
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            return make_response('hello')
+
+        vlm = VLMWrapper(model_name='model', api_key='EMPTY', base_url='http://127.0.0.1:1/v1', cache=VLMCache(self.tmp.name), share_client=False)
+        vlm.client.chat.completions.create = create
+        for _ in range(2):
+            response = vlm.predict(make_messages(self.image), stop=['Summary'])
+            self.assertEqual(response.choices[0].message.content, 'hello')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(vlm.cache.hits, 1)
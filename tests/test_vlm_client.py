@@ -0,0 +1,51 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mobile_use.vlm import VLMWrapper
+from mobile_use.vlm_client import get_client, pool_stats
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({
+            'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'model',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'hi'}}],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ChatHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/v1'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared_client(self):
+        self.assertIs(get_client(self.base_url, 'key-a'), get_client(self.base_url, 'key-a'))
+        self.assertIsNot(get_client(self.base_url, 'key-a'), get_client(self.base_url, 'key-b'))
+
+    def test_connection_reuse(self):
+        messages = [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}]
+        for _ in range(3):
+            # A new wrapper per task, as webui does.
+            vlm = VLMWrapper(model_name='model', api_key='EMPTY', base_url=self.base_url)
+            self.assertEqual(vlm.predict(messages).choices[0].message.content, 'hi')
+        stats = [s for s in pool_stats() if s['base_url'] == self.base_url]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['requests'], 3)
+        self.assertEqual(stats[0]['connections'], 1)
@@ -0,0 +1,181 @@
+import time
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from openai.types.chat import ChatCompletion
+from mobile_use.vlm_router import VLMRouter
+
+
+def completion(content):
+    return ChatCompletion.model_validate({
+        'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'model',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+    })
+
+
+class FakeCompletions:
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(f'{self.name} is down')
+        return completion(self.name)
+
+
+class FakeStream:
+    def __init__(self, chunks, fail=False):
+        self.chunks = chunks
+        self.fail = fail
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.fail:
+            raise ConnectionError('stream broken')
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingCompletions(FakeCompletions):
+    def __init__(self, name, fail=False):
+        super().__init__(name)
+        self.stream_fail = fail
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return FakeStream(['a', 'b'], fail=self.stream_fail)
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        self.chat = mock.Mock()
+        self.chat.completions = FakeCompletions(*args, **kwargs)
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(f'{self.name} is down')
+        return completion(self.name)
+
+
+MESSAGES = [{'role': 'user', 'content': [{'type': 'text', 'text': 'hi'}]}]
+
+
+class TestVLMRouter(unittest.TestCase):
+    def make_router(self, clients, **kwargs):
+        endpoints = [{'base_url': f'http://127.0.0.1:{9000 + i}/v1'} for i in range(len(clients))]
+        kwargs.setdefault('backoff_base_seconds', 0.0)
+        router = VLMRouter(model_name='model', endpoints=endpoints, **kwargs)
+        for endpoint, client in zip(router.endpoints, clients):
+            endpoint.client = client
+        return router
+
+    def test_least_outstanding(self):
+        a, b = FakeClient('a', delay=0.2), FakeClient('b', delay=0.2)
+        router = self.make_router([a, b])
+        threads = [threading.Thread(target=router.predict, args=(MESSAGES,)) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(a.chat.completions.calls, 1)
+        self.assertEqual(b.chat.completions.calls, 1)
+        self.assertTrue(all(e.outstanding == 0 for e in router.endpoints))
+
+    def test_circuit_breaker(self):
+        a, b = FakeClient('a', fail=True), FakeClient('b')
+        router = self.make_router([a, b], max_retry=3, failure_threshold=1, recovery_seconds=60)
+        for _ in range(3):
+            self.assertEqual(router.predict(MESSAGES).choices[0].message.content, 'b')
+        # `a` failed once and is out of rotation.
+        self.assertEqual(a.chat.completions.calls, 1)
+        self.assertGreater(router.endpoints[0].open_until, time.time())
+
+    def test_all_failing(self):
+        router = self.make_router([FakeClient('a', fail=True)], max_retry=2)
+        with self.assertRaises(ConnectionError):
+            router.predict(MESSAGES)
+
+    def test_backoff_bounds(self):
+        router = self.make_router([FakeClient('a')], backoff_base_seconds=1.0, backoff_max_seconds=3.0)
+        for attempt in range(6):
+            self.assertLessEqual(router._backoff(attempt), min(3.0, 2 ** attempt))
+
+    def test_hedge(self):
+        slow, fast = FakeClient('slow', delay=1.0), FakeClient('fast')
+        router = self.make_router([slow, fast], hedge=True, hedge_min_samples=1)
+        router._latencies.append(0.05)
+        # Both endpoints are idle, the first one is picked and hedged on the second.
+        start = time.time()
+        self.assertEqual(router.predict(MESSAGES).choices[0].message.content, 'fast')
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(router.num_hedged, 1)
+
+    def test_async_hedge(self):
+        router = self.make_router([FakeClient('a'), FakeClient('b')], hedge=True, hedge_min_samples=1)
+        router._latencies.append(0.05)
+        fakes = {
+            router.endpoints[0].base_url: AsyncFakeCompletions('slow', delay=1.0),
+            router.endpoints[1].base_url: AsyncFakeCompletions('fast'),
+        }
+
+        def get_async_client(base_url, api_key, http2=False):
+            client = mock.Mock()
+            client.chat.completions = fakes[base_url]
+            client.with_options.return_value = client
+            return client
+
+        with mock.patch('mobile_use.vlm_router.get_async_client', get_async_client):
+            response = asyncio.run(router.apredict(MESSAGES))
+        self.assertEqual(response.choices[0].message.content, 'fast')
+        self.assertEqual(router.num_hedged, 1)
+        self.assertTrue(all(e.outstanding == 0 for e in router.endpoints))
+
+    def test_stream_outstanding(self):
+        client = FakeClient('a')
+        client.chat.completions = StreamingCompletions('a')
+        router = self.make_router([client])
+        endpoint = router.endpoints[0]
+        stream = router.predict(MESSAGES, stream=True)
+        self.assertEqual(endpoint.outstanding, 1)
+        self.assertEqual(list(stream), ['a', 'b'])
+        self.assertEqual(endpoint.outstanding, 0)
+        self.assertEqual(len(router._latencies), 1)
+        stream.close()
+        self.assertEqual(endpoint.outstanding, 0)
+
+        # Closed early.
+        stream = router.predict(MESSAGES, stream=True)
+        next(iter(stream))
+        self.assertEqual(endpoint.outstanding, 1)
+        stream.close()
+        self.assertEqual(endpoint.outstanding, 0)
+
+    def test_stream_failure(self):
+        client = FakeClient('a')
+        client.chat.completions = StreamingCompletions('a', fail=True)
+        router = self.make_router([client], failure_threshold=1)
+        with self.assertRaises(ConnectionError):
+            list(router.predict(MESSAGES, stream=True))
+        self.assertEqual(router.endpoints[0].outstanding, 0)
+        self.assertEqual(router.endpoints[0].failures, 1)
+
+    def test_no_sdk_retries(self):
+        router = VLMRouter(model_name='model', endpoints=[{'base_url': 'http://127.0.0.1:9000/v1'}])
+        self.assertEqual(router.endpoints[0].client.max_retries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()